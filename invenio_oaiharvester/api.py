@@ -19,14 +19,40 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-from sickle import Sickle
+import sys
+import threading
+import uuid
+from copy import deepcopy
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+import six
+from invenio.base.globals import cfg
+from lxml import etree
+from sickle.iterator import OAIResponseIterator
+from sickle.models import Record
+from sickle.oaiexceptions import (
+    BadResumptionToken,
+    NoRecordsMatch,
+    NoSetHierarchy,
+)
+from six.moves.queue import Full, Queue
+from six.moves.urllib.parse import urlparse
+
+from .client import PooledSickle
 from .errors import NameOrUrlMissing, WrongDateCombination
-from .utils import get_oaiharvest_object
+from .utils import (
+    OAI_DAY_GRANULARITY,
+    format_oai_date,
+    get_oaiharvest_object,
+    get_set_names,
+    parse_oai_date,
+    split_date_range,
+)
 
 
 def list_records(metadata_prefix=None, from_date=None, until_date=None,
-                 url=None, name=None, setSpec=None):
+                 url=None, name=None, setSpec=None, prefetch=None):
     """Harvest records from an OAI repo, based on datestamp and/or set parameters.
 
     :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
@@ -35,12 +61,36 @@ def list_records(metadata_prefix=None, from_date=None, until_date=None,
     :param url: The The url to be used to create the endpoint.
     :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
     :param setSpec: The 'set' criteria for the harvesting (optional).
+    :param prefetch: The number of pages to fetch ahead on a background thread
+                     (defaults to OAIHARVESTER_PREFETCH_PAGES, 0 disables it).
     :return: An iterator of harvested records.
     """
+    request, metadata_prefix, dates = _get_list_arguments(
+        metadata_prefix, from_date, until_date, url, name, setSpec)
+
+    if prefetch is None:
+        prefetch = cfg.get("OAIHARVESTER_PREFETCH_PAGES", 0)
+
+    if prefetch > 0:
+        params = dict(dates, metadataPrefix=metadata_prefix, set=setSpec,
+                      verb='ListRecords')
+        return prefetch_records(request, params, prefetch)
+
+    return request.ListRecords(metadataPrefix=metadata_prefix,
+                               set=setSpec,
+                               **dates)
+
+
+def _get_list_arguments(metadata_prefix, from_date, until_date, url, name,
+                        setSpec=None):
+    """Return the client, the metadata prefix and the dates of a list request."""
+    lastrun = None
     if url:
-        request = Sickle(url)
+        request = PooledSickle(url)
     elif name:
         request, _metadata_prefix, lastrun = get_from_oai_name(name)
+        if from_date is None:
+            lastrun = get_watermark(name, setSpec, request) or lastrun
 
         # In case we provide a prefix, we don't want it to be
         # overwritten by the one we get from the name variable.
@@ -50,7 +100,8 @@ def list_records(metadata_prefix=None, from_date=None, until_date=None,
         raise NameOrUrlMissing("Retry using the parameters -n <name> or -u <url>.")
 
     # By convention, when we have a url we have no lastrun, and when we use
-    # the name we can either have from_date (if provided) or lastrun.
+    # the name we can either have from_date (if provided), the watermark of
+    # the source or lastrun.
     dates = {
         'from': lastrun if from_date is None else from_date,
         'until': until_date
@@ -63,22 +114,580 @@ def list_records(metadata_prefix=None, from_date=None, until_date=None,
     if metadata_prefix is None:
         metadata_prefix = "oai_dc"
 
-    return request.ListRecords(metadataPrefix=metadata_prefix,
-                               set=setSpec,
-                               **dates)
+    return request, metadata_prefix, dates
+
+
+def list_changed_records(metadata_prefix=None, from_date=None, until_date=None,
+                         url=None, name=None, setSpec=None, ledger=None,
+                         concurrency=None, batch_size=100):
+    """Harvest only the records which are new or changed since the last harvest.
+
+    The identifiers are listed with ListIdentifiers and compared with the
+    datestamps of the ledger. Only the records missing from the ledger or
+    with another datestamp are fetched with GetRecord. Deleted records are
+    passed on from their header alone.
+
+    Without a ledger or with an empty one, every record would be fetched on
+    its own, so they are listed with ListRecords instead. The harvest is not
+    checkpointed.
+
+    :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
+    :param from_date: The lower bound date for the harvesting (optional).
+    :param until_date: The upper bound date for the harvesting (optional).
+    :param url: The The url to be used to create the endpoint.
+    :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param setSpec: The 'set' criteria for the harvesting (optional).
+    :param ledger: A mapping of the OAI identifiers already harvested to
+                   their datestamp, or a RecordLedger (optional).
+    :param concurrency: The number of GetRecord requests to run in parallel
+                        (defaults to OAIHARVESTER_GETRECORD_CONCURRENCY).
+    :param batch_size: The number of records to fetch at once.
+    :return: An iterator of harvested records.
+    """
+    is_empty = getattr(ledger, 'is_empty', None)
+    if ledger is None or (is_empty() if is_empty else not ledger):
+        for record in list_records(metadata_prefix, from_date, until_date,
+                                   url, name, setSpec):
+            yield record
+        return
+
+    request, metadata_prefix, dates = _get_list_arguments(
+        metadata_prefix, from_date, until_date, url, name, setSpec)
+    get_datestamps = getattr(ledger, 'get_datestamps', None)
+    if get_datestamps is None:
+        def get_datestamps(identifiers):
+            return dict((identifier, ledger.get(identifier))
+                        for identifier in identifiers)
+
+    def fetch(identifiers):
+        return get_records(identifiers, metadata_prefix,
+                           url=request.endpoint, concurrency=concurrency)
+
+    try:
+        headers = request.ListIdentifiers(metadataPrefix=metadata_prefix,
+                                          set=setSpec, ignore_deleted=False,
+                                          **dates)
+    except NoRecordsMatch:
+        return
+
+    def select(batch):
+        datestamps = get_datestamps([header.identifier for header in batch])
+        return [header.identifier for header in batch
+                if datestamps.get(header.identifier) != header.datestamp]
+
+    batch = []
+    for header in headers:
+        if header.deleted:
+            record = etree.Element(request.oai_namespace + 'record')
+            record.append(deepcopy(header.xml))
+            yield Record(record)
+            continue
+        batch.append(header)
+        if len(batch) >= batch_size:
+            for record in fetch(select(batch)):
+                yield record
+            batch = []
+    for record in fetch(select(batch)):
+        yield record
+
+
+def list_records_in_windows(metadata_prefix=None, from_date=None, until_date=None,
+                            url=None, name=None, setSpec=None, windows=1,
+                            max_window_records=None, concurrency=None):
+    """Harvest records by splitting the date range into windows harvested in parallel.
+
+    Every window is an independent ListRecords chain, run on a thread pool
+    and merged into a single iterator. The windows are never finer than the
+    granularity announced by the endpoint in Identify.
+
+    :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
+    :param from_date: The lower bound date for the harvesting (optional).
+    :param until_date: The upper bound date for the harvesting (optional).
+    :param url: The The url to be used to create the endpoint.
+    :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param setSpec: The 'set' criteria for the harvesting (optional).
+    :param windows: The number of equally sized windows to start from.
+    :param max_window_records: Split further any window holding more records
+                               than this (defaults to OAIHARVESTER_WINDOW_MAX_RECORDS).
+    :param concurrency: The number of windows harvested in parallel
+                        (capped by the endpoint concurrency limit).
+    :return: An iterator of harvested records.
+    """
+    lastrun = None
+    if url:
+        request = PooledSickle(url)
+    elif name:
+        request, _metadata_prefix, lastrun = get_from_oai_name(name)
+        if metadata_prefix is None:
+            metadata_prefix = _metadata_prefix
+    else:
+        raise NameOrUrlMissing("Retry using the parameters -n <name> or -u <url>.")
+
+    if metadata_prefix is None:
+        metadata_prefix = "oai_dc"
+
+    identify = request.Identify()
+    granularity = getattr(identify, 'granularity', OAI_DAY_GRANULARITY)
+    if from_date is None and name:
+        from_date = get_watermark(name, setSpec, request) or lastrun
+    if from_date is None:
+        from_date = identify.earliestDatestamp
+    if until_date is None:
+        until_date = datetime.utcnow()
+
+    date_windows = split_date_range(from_date, until_date, windows, granularity)
+
+    if max_window_records is None:
+        max_window_records = cfg.get("OAIHARVESTER_WINDOW_MAX_RECORDS")
+    if max_window_records:
+        date_windows = _refine_windows(request, date_windows, granularity,
+                                       max_window_records,
+                                       metadataPrefix=metadata_prefix,
+                                       set=setSpec)
+
+    limit = get_endpoint_concurrency(request.endpoint)
+    concurrency = min(concurrency or len(date_windows), limit)
+
+    def harvest_window(window):
+        def harvest():
+            try:
+                for record in list_records(metadata_prefix, window[0],
+                                           window[1], request.endpoint,
+                                           setSpec=setSpec, prefetch=0):
+                    yield record
+            except NoRecordsMatch:
+                return
+        return harvest
+
+    return merge_harvests([harvest_window(window) for window in date_windows],
+                          concurrency, url=request.endpoint)
+
+
+def list_records_in_sets(metadata_prefix=None, from_date=None, until_date=None,
+                         url=None, name=None, sets=None, concurrency=None):
+    """Harvest several sets of an OAI repo in parallel.
+
+    The sets are taken from ``sets``, then from the ``setspecs`` of the
+    OaiHARVEST object, and are otherwise discovered with ListSets. Records
+    belonging to more than one set are only returned once.
+
+    :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
+    :param from_date: The lower bound date for the harvesting (optional).
+    :param until_date: The upper bound date for the harvesting (optional).
+    :param url: The The url to be used to create the endpoint.
+    :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param sets: A list of setSpecs to harvest (optional).
+    :param concurrency: The number of sets harvested in parallel
+                        (capped by the endpoint concurrency limit).
+    :return: An iterator of harvested records.
+    """
+    lastrun = None
+    setspecs = None
+    if url:
+        request = PooledSickle(url)
+    elif name:
+        request, _metadata_prefix, lastrun = get_from_oai_name(name)
+        setspecs = get_oaiharvest_object(name).setspecs
+        if metadata_prefix is None:
+            metadata_prefix = _metadata_prefix
+    else:
+        raise NameOrUrlMissing("Retry using the parameters -n <name> or -u <url>.")
+
+    if not sets:
+        sets = resolve_sets(request, setspecs)
+
+    limit = get_endpoint_concurrency(request.endpoint)
+    concurrency = min(concurrency or len(sets), limit)
+
+    def harvest_set(set_spec):
+        set_from_date = from_date
+        if set_from_date is None:
+            # Every set continues from its own watermark.
+            if name:
+                set_from_date = get_watermark(name, set_spec, request)
+            set_from_date = set_from_date or lastrun
+
+        def harvest():
+            try:
+                for record in list_records(metadata_prefix, set_from_date,
+                                           until_date, request.endpoint,
+                                           setSpec=set_spec, prefetch=0):
+                    yield record
+            except NoRecordsMatch:
+                return
+        return harvest
+
+    return unique_records(
+        merge_harvests([harvest_set(set_spec) for set_spec in sets],
+                       concurrency, url=request.endpoint)
+    )
+
+
+def get_harvested_sets(url=None, name=None, sets=None):
+    """Return the sets harvested by :func:`list_records_in_sets`.
+
+    :param url: The The url to be used to create the endpoint.
+    :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param sets: A list of setSpecs to harvest (optional).
+    :return: A list of setSpecs, ``[None]`` if the repository has no sets.
+    """
+    if sets:
+        return list(sets)
+    setspecs = None
+    if url:
+        request = PooledSickle(url)
+    elif name:
+        request = get_from_oai_name(name)[0]
+        setspecs = get_oaiharvest_object(name).setspecs
+    else:
+        raise NameOrUrlMissing("Retry using the parameters -n <name> or -u <url>.")
+    return resolve_sets(request, setspecs)
+
+
+def resolve_sets(request, setspecs=None):
+    """Return the sets of a source, discovered with ListSets if not given.
+
+    :param request: The Sickle client of the endpoint.
+    :param setspecs: A comma or space separated string of setSpecs (optional).
+    :return: A list of setSpecs, ``[None]`` if the repository has no sets.
+    """
+    sets = get_set_names(setspecs)
+    if not sets:
+        try:
+            sets = [oai_set.setSpec for oai_set in request.ListSets()]
+        except NoSetHierarchy:
+            sets = [None]
+    return sets
+
+
+def unique_records(records):
+    """Skip records whose identifier has already been seen.
+
+    :param records: An iterator of harvested records.
+    :return: An iterator of harvested records.
+    """
+    seen = set()
+    for record in records:
+        identifier = record.header.identifier
+        if identifier in seen:
+            continue
+        seen.add(identifier)
+        yield record
+
+
+def _refine_windows(request, date_windows, granularity, max_records, **params):
+    """Split date windows in two until each holds at most ``max_records``.
+
+    The size of a window is read from the ``completeListSize`` of its first
+    ListIdentifiers page; windows of unknown size are kept as they are.
+    """
+    refined = []
+    pending = list(reversed(date_windows))
+    while pending:
+        window = pending.pop()
+        size = _count_records(request, window, **params)
+        halves = split_date_range(window[0], window[1], 2, granularity)
+        if size is None or size <= max_records or len(halves) < 2:
+            refined.append(window)
+        else:
+            pending.extend(reversed(halves))
+    return refined
+
+
+def _count_records(request, window, **params):
+    """Return the number of records announced by the endpoint for a window."""
+    params = dict(params, verb='ListIdentifiers')
+    params['from'], params['until'] = window
+    response = request.harvest(**params)
+    error = response.xml.find('.//' + request.oai_namespace + 'error')
+    if error is not None:
+        return 0 if error.attrib.get('code') == 'noRecordsMatch' else None
+    token = response.xml.find('.//' + request.oai_namespace + 'resumptionToken')
+    if token is None:
+        return len(response.xml.findall('.//' + request.oai_namespace + 'header'))
+    size = token.attrib.get('completeListSize')
+    return int(size) if size else None
+
+
+_ITEM, _ERROR, _DONE = range(3)
+
+
+def _put_until_stopped(queue, item, stop):
+    """Put an item in a bounded queue unless the consumer has gone away."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
 
 
-def get_records(identifiers, metadata_prefix=None, url=None, name=None):
+def merge_harvests(harvests, concurrency=1, url=None, buffer_size=1000):
+    """Run several harvests on a thread pool and merge their records.
+
+    :param harvests: A list of callables, each returning an iterator of records.
+    :param concurrency: The number of harvests running at the same time.
+    :param url: The endpoint harvested, used to apply its concurrency limit.
+    :param buffer_size: The maximum number of records waiting to be consumed.
+    :return: An iterator of harvested records, in completion order.
+    """
+    records = Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    semaphore = None
+    if url is not None:
+        semaphore = _get_endpoint_semaphore(url, get_endpoint_concurrency(url))
+
+    def drain(harvest):
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            for record in harvest():
+                if not _put_until_stopped(records, (_ITEM, record), stop):
+                    return
+        except Exception:
+            _put_until_stopped(records, (_ERROR, sys.exc_info()), stop)
+        else:
+            _put_until_stopped(records, (_DONE, None), stop)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    pool = ThreadPool(max(min(concurrency, len(harvests)), 1))
+    for harvest in harvests:
+        pool.apply_async(drain, (harvest, ))
+    pool.close()
+
+    remaining = len(harvests)
+    try:
+        while remaining:
+            kind, payload = records.get()
+            if kind == _DONE:
+                remaining -= 1
+            elif kind == _ERROR:
+                six.reraise(*payload)
+            else:
+                yield payload
+    finally:
+        stop.set()
+        pool.terminate()
+
+
+def prefetch_records(request, params, depth=1):
+    """Iterate over records while the following pages are fetched in the background.
+
+    A background thread follows the resumption tokens and queues up to
+    ``depth`` responses ahead of the consumer, so that the network time of
+    page N+1 overlaps the processing time of page N.
+
+    The first page is fetched before returning, so that OAI errors such as
+    ``NoRecordsMatch`` are raised by the call itself.
+
+    :param request: The Sickle object used to issue the requests.
+    :param params: The OAI arguments of the first request (incl. the verb).
+    :param depth: The maximum number of pages waiting to be consumed.
+    :return: An iterator of harvested records.
+    """
+    responses = OAIResponseIterator(request, params)
+    return _iter_prefetched_records(request, params['verb'],
+                                    prefetch_responses(responses, depth))
+
+
+def _iter_prefetched_records(request, verb, responses):
+    """Iterate over the records of the responses of a list request."""
+    element = request.oai_namespace + 'record'
+    mapper = request.class_mapping[verb]
+    for response, dummy in responses:
+        for item in response.xml.iterfind('.//' + element):
+            yield mapper(item)
+
+
+def prefetch_responses(responses, depth=1):
+    """Iterate over the pages of a list request, fetched in the background.
+
+    :param responses: An OAIResponseIterator, whose first page is fetched.
+    :param depth: The maximum number of pages waiting to be consumed
+                  (0 fetches every page once the previous one is consumed).
+    :return: An iterator of (response, resumption token of the next page)
+             tuples.
+    """
+    def get_token():
+        return getattr(responses.resumption_token, 'token', None) or None
+
+    if depth <= 0:
+        for response in responses:
+            yield response, get_token()
+        return
+
+    pages = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def fetch_pages():
+        try:
+            for response in responses:
+                # The iterator moves on to the next token with the next page.
+                item = (_ITEM, (response, get_token()))
+                if not _put_until_stopped(pages, item, stop):
+                    return
+        except Exception:
+            _put_until_stopped(pages, (_ERROR, sys.exc_info()), stop)
+        else:
+            _put_until_stopped(pages, (_DONE, None), stop)
+
+    fetcher = threading.Thread(target=fetch_pages)
+    fetcher.daemon = True
+    fetcher.start()
+
+    try:
+        while True:
+            kind, payload = pages.get()
+            if kind == _DONE:
+                break
+            elif kind == _ERROR:
+                six.reraise(*payload)
+            yield payload
+    finally:
+        stop.set()
+
+
+def get_checkpoint(metadata_prefix=None, from_date=None, until_date=None,
+                   url=None, name=None, setSpec=None, output='stdout',
+                   workflow=None, directory=None, owner=None):
+    """Return the interrupted checkpoint of a harvest, or start a new one.
+
+    Interrupted checkpoints still saved by another run within
+    OAIHARVESTER_CHECKPOINT_LEASE seconds are left to it.
+
+    :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
+    :param from_date: The lower bound date for the harvesting (optional).
+    :param until_date: The upper bound date for the harvesting (optional).
+    :param url: The The url to be used to create the endpoint.
+    :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param setSpec: The 'set' criteria for the harvesting (optional).
+    :param output: The type of the output (stdout, workflow, dir/directory).
+    :param workflow: The workflow that should process the output.
+    :param directory: The directory that we want to send the harvesting results.
+    :param owner: The id of the run harvesting, e.g. its task id (optional).
+    :return: An OaiHARVESTCHECKPOINT object, owned by the run.
+    """
+    from .models import OaiHARVESTCHECKPOINT
+
+    source = None
+    if url:
+        baseurl = url
+    elif name:
+        source = get_oaiharvest_object(name)
+        baseurl = source.baseurl
+        if metadata_prefix is None:
+            metadata_prefix = source.metadataprefix
+        if from_date is None:
+            from_date = get_watermark(name, setSpec) or source.lastrun
+    else:
+        raise NameOrUrlMissing("Retry using the parameters -n <name> or -u <url>.")
+
+    if metadata_prefix is None:
+        metadata_prefix = "oai_dc"
+    if from_date is not None and not isinstance(from_date, six.string_types):
+        from_date = format_oai_date(parse_oai_date(from_date))
+
+    filters = {
+        'baseurl': baseurl,
+        'metadataprefix': metadata_prefix,
+        'setspec': setSpec,
+        'from_date': from_date,
+        'until_date': until_date,
+        'output': output,
+        'workflow': workflow,
+        'directory': directory,
+    }
+    if owner is None:
+        owner = uuid.uuid4().hex
+    checkpoint = OaiHARVESTCHECKPOINT.claim_unfinished(
+        owner, cfg.get("OAIHARVESTER_CHECKPOINT_LEASE"), **filters)
+    if checkpoint is None:
+        checkpoint = OaiHARVESTCHECKPOINT(
+            id_oaiHARVEST=source.id if source is not None else None,
+            records=0,
+            files=[],
+            owner=owner,
+            **filters
+        )
+        checkpoint.save()
+    return checkpoint
+
+
+def checkpointed_records(checkpoint, prefetch=None):
+    """Iterate over the records of a harvest, saving its progress page by page.
+
+    The harvest starts from the resumption token stored in the checkpoint.
+    If the token has expired, the harvest starts over from the ``from``
+    date of the checkpoint: the records are not listed in datestamp order,
+    so no later date is safe. Progress is saved once all the records of a
+    page have been consumed. The page filters of the checkpoint are applied
+    to the records of each page at once.
+
+    :param checkpoint: An OaiHARVESTCHECKPOINT object.
+    :param prefetch: The number of pages to fetch ahead on a background thread
+                     (defaults to OAIHARVESTER_PREFETCH_PAGES, 0 disables it).
+    :return: An iterator of harvested records.
+    """
+    if prefetch is None:
+        prefetch = cfg.get("OAIHARVESTER_PREFETCH_PAGES", 0)
+
+    request = PooledSickle(checkpoint.baseurl)
+    params = {
+        'verb': 'ListRecords',
+        'metadataPrefix': checkpoint.metadataprefix,
+        'set': checkpoint.setspec,
+        'from': checkpoint.from_date,
+        'until': checkpoint.until_date,
+    }
+    element = request.oai_namespace + 'record'
+    mapper = request.class_mapping['ListRecords']
+    try:
+        try:
+            if checkpoint.resumption_token:
+                responses = OAIResponseIterator(request, {
+                    'verb': 'ListRecords',
+                    'resumptionToken': checkpoint.resumption_token,
+                })
+            else:
+                responses = OAIResponseIterator(request, params)
+        except BadResumptionToken:
+            responses = OAIResponseIterator(request, params)
+
+        for response, token in prefetch_responses(responses, prefetch):
+            page = [mapper(item)
+                    for item in response.xml.iterfind('.//' + element)]
+            count = len(page)
+            last_datestamp = max([record.header.datestamp
+                                  for record in page] or [None])
+            for page_filter in checkpoint.page_filters:
+                page = page_filter(page)
+            for record in page:
+                yield record
+            checkpoint.update_progress(token, last_datestamp, count)
+    except NoRecordsMatch:
+        pass
+    checkpoint.finish()
+
+
+def get_records(identifiers, metadata_prefix=None, url=None, name=None,
+                concurrency=None, ordered=True):
     """Harvest specific records from an OAI repo, based on their unique identifiers.
 
     :param metadata_prefix: The prefix for the metadata return (defaults to 'oai_dc').
     :param identifiers: A list of unique identifiers for records to be harvested.
     :param url: The The url to be used to create the endpoint.
     :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
+    :param concurrency: The number of GetRecord requests to run in parallel
+                        (defaults to OAIHARVESTER_GETRECORD_CONCURRENCY).
+    :param ordered: Whether to yield the records in the order of the identifiers
+                    or as soon as they are fetched (only with concurrency > 1).
     :return: An iterator of harvested records.
     """
     if url:
-        request = Sickle(url)
+        request = PooledSickle(url)
     elif name:
         request, _metadata_prefix, _ = get_from_oai_name(name)
 
@@ -92,12 +701,108 @@ def get_records(identifiers, metadata_prefix=None, url=None, name=None):
     if metadata_prefix is None:
         metadata_prefix = "oai_dc"
 
-    for identifier in identifiers:
+    if concurrency is None:
+        concurrency = cfg.get("OAIHARVESTER_GETRECORD_CONCURRENCY", 1)
+
+    def get_record(identifier):
         arguments = {
             'identifier': identifier,
             'metadataPrefix': metadata_prefix
         }
-        yield request.GetRecord(**arguments)
+        return request.GetRecord(**arguments)
+
+    if concurrency <= 1:
+        for identifier in identifiers:
+            yield get_record(identifier)
+        return
+
+    limit = get_endpoint_concurrency(request.endpoint)
+    semaphore = _get_endpoint_semaphore(request.endpoint, limit)
+
+    def get_record_limited(identifier):
+        with semaphore:
+            return get_record(identifier)
+
+    pool = ThreadPool(min(concurrency, limit))
+    try:
+        if ordered:
+            results = pool.imap(get_record_limited, identifiers)
+        else:
+            results = pool.imap_unordered(get_record_limited, identifiers)
+        for record in results:
+            yield record
+    finally:
+        pool.terminate()
+
+
+def get_endpoint_concurrency(url):
+    """Return the maximum number of parallel requests allowed for an endpoint.
+
+    :param url: The base url of the OAI-PMH endpoint.
+    """
+    overrides = cfg.get("OAIHARVESTER_ENDPOINT_CONCURRENCY") or {}
+    limit = overrides.get(url, cfg.get("OAIHARVESTER_MAX_CONCURRENCY_PER_ENDPOINT", 1))
+    return max(int(limit), 1)
+
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def _get_semaphore(key, limit):
+    """Return the process-wide semaphore registered under a key."""
+    with _semaphores_lock:
+        if key not in _semaphores:
+            _semaphores[key] = threading.BoundedSemaphore(limit)
+        return _semaphores[key]
+
+
+def _get_endpoint_semaphore(url, limit):
+    """Return the process-wide semaphore guarding requests to an endpoint."""
+    return _get_semaphore(('endpoint', url), limit)
+
+
+def get_host_semaphore(url):
+    """Return the process-wide semaphore limiting the sources harvested on a host.
+
+    :param url: The base url of the OAI-PMH endpoint.
+    """
+    limit = max(int(cfg.get("OAIHARVESTER_MAX_SOURCES_PER_HOST", 1)), 1)
+    return _get_semaphore(('host', urlparse(url).netloc), limit)
+
+
+_granularities = {}
+
+
+def get_watermark(name, setSpec=None, request=None):
+    """Return the date to continue the harvest of a source from.
+
+    This is the latest datestamp received by the previous harvests of the
+    source (or of one of its sets), at the granularity of the endpoint.
+
+    :param name: The name of the OaiHARVEST object.
+    :param setSpec: The set harvested (optional).
+    :param request: The Sickle object of the endpoint (optional).
+    :return: An OAI-PMH date string, or None if the source has no watermark.
+    """
+    from .models import OaiHARVESTWATERMARK
+
+    if not cfg.get("OAIHARVESTER_WATERMARKS"):
+        return None
+    source = get_oaiharvest_object(name)
+    datestamp = OaiHARVESTWATERMARK.get_datestamp(source.id, setSpec)
+    if datestamp is None or 'T' not in datestamp:
+        return datestamp
+
+    # Endpoints with a day granularity reject datestamps with a time.
+    if request is None:
+        request = PooledSickle(source.baseurl)
+    granularity = _granularities.get(request.endpoint)
+    if granularity is None:
+        granularity = getattr(request.Identify(), 'granularity',
+                              OAI_DAY_GRANULARITY)
+        _granularities[request.endpoint] = granularity
+    return format_oai_date(parse_oai_date(datestamp), granularity)
 
 
 def get_from_oai_name(name):
@@ -105,11 +810,11 @@ def get_from_oai_name(name):
 
     :param name: name of the source (OaiHARVEST.name)
 
-    :return: (Sickle obj, metadataprefix, lastrun)
+    :return: (PooledSickle obj, metadataprefix, lastrun)
     """
     obj = get_oaiharvest_object(name)
 
-    req = Sickle(obj.baseurl)
+    req = PooledSickle(obj.baseurl)
     metadata_prefix = obj.metadataprefix
     lastrun = obj.lastrun
     return req, metadata_prefix, lastrun
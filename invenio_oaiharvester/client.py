@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""OAI-PMH client issuing its requests through pooled HTTP sessions."""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from sickle import Sickle
+from sickle.response import OAIResponse
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url, pool_size=10):
+    """Return the HTTP session shared by all the clients of an endpoint.
+
+    Sessions are kept for the lifetime of the process, so that connections
+    are reused across pages and harvests, and ask for compressed responses.
+
+    :param url: The base url of the OAI-PMH endpoint.
+    :param pool_size: The number of connections kept alive to the endpoint.
+    :return: A :class:`requests.Session` object.
+    """
+    with _sessions_lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[url] = session
+        return session
+
+
+class PooledSickle(Sickle):
+
+    """Sickle client using the shared session of its endpoint."""
+
+    def __init__(self, endpoint, session=None, **kwargs):
+        """Initialize the client.
+
+        :param endpoint: The base url of the OAI-PMH endpoint.
+        :param session: The HTTP session to use (defaults to the shared one).
+        """
+        super(PooledSickle, self).__init__(endpoint, **kwargs)
+        self.session = session or get_session(endpoint)
+
+    def harvest(self, **kwargs):
+        """Make HTTP requests to the OAI server.
+
+        :param kwargs: OAI HTTP parameters.
+        :rtype: :class:`sickle.OAIResponse`
+        """
+        http_response = self._request_with_session(kwargs)
+        for _ in range(self.max_retries):
+            if http_response.status_code != 503:
+                break
+            try:
+                retry_after = int(http_response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                retry_after = 20
+            logger.info("HTTP 503! Retrying after %d seconds...", retry_after)
+            time.sleep(retry_after)
+            http_response = self._request_with_session(kwargs)
+        http_response.raise_for_status()
+        if getattr(self, 'encoding', None):
+            http_response.encoding = self.encoding
+        return OAIResponse(http_response, params=kwargs)
+
+    def _request_with_session(self, kwargs):
+        """Issue a single request through the shared session."""
+        options = getattr(self, 'request_args', None)
+        if options is None:
+            options = {
+                'timeout': getattr(self, 'timeout', None),
+                'auth': getattr(self, 'auth', None),
+            }
+        if self.http_method == 'GET':
+            return self.session.get(self.endpoint, params=kwargs, **options)
+        return self.session.post(self.endpoint, data=kwargs, **options)
@@ -37,3 +37,146 @@ OAIHARVESTER_STORAGEDIR = os.path.join(CFG_DATADIR, "oaiharvester", "storage")
 
 OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP = "system_control_number.value"
 """Path to the arXiv ID value used by sample post-process tasks."""
+
+OAIHARVESTER_GETRECORD_CONCURRENCY = 1
+"""Number of GetRecord requests issued in parallel by ``api.get_records``."""
+
+OAIHARVESTER_MAX_CONCURRENCY_PER_ENDPOINT = 4
+"""Maximum number of parallel requests sent to a single OAI-PMH endpoint."""
+
+OAIHARVESTER_ENDPOINT_CONCURRENCY = {}
+"""Per-endpoint overrides of the parallel requests limit, keyed by base URL.
+
+E.g. ``{"http://export.arxiv.org/oai2": 2}``.
+"""
+
+OAIHARVESTER_PREFETCH_PAGES = 1
+"""Number of ListRecords pages fetched ahead on a background thread.
+
+Set to ``0`` to fetch the next page only once the current one is consumed.
+"""
+
+OAIHARVESTER_WINDOW_MAX_RECORDS = None
+"""Maximum number of records in a date window of a partitioned harvest.
+
+Windows announcing more records are split in two, down to the granularity
+of the endpoint. ``None`` keeps the windows equally sized.
+"""
+
+OAIHARVESTER_CHECKPOINTS = False
+"""Save the progress of ListRecords harvests so that they can be resumed."""
+
+OAIHARVESTER_CHECKPOINT_LEASE = 3600
+"""Seconds after which a checkpoint its run stopped saving can be taken over.
+
+Until then, another run with the same arguments starts its own checkpoint.
+"""
+
+OAIHARVESTER_MAX_CONCURRENT_SOURCES = 8
+"""Number of sources harvested at the same time by ``harvest_sources``."""
+
+OAIHARVESTER_MAX_SOURCES_PER_HOST = 2
+"""Number of sources of a same host harvested at the same time.
+
+A source holds its slot for its whole harvest. This is not a limit on the
+connections to the host: every source may still send up to
+OAIHARVESTER_MAX_CONCURRENCY_PER_ENDPOINT parallel requests.
+"""
+
+OAIHARVESTER_WORKFLOW_BATCH_SIZE = 1
+"""Number of records passed to a single workflow run by the workflow output."""
+
+OAIHARVESTER_WORKFLOW_FLUSH_INTERVAL = 10
+"""Seconds after which an incomplete batch of records is sent anyway."""
+
+OAIHARVESTER_WORKFLOW_QUEUE = "celery"
+"""Name of the broker queue the workflow runs are sent to."""
+
+OAIHARVESTER_WORKFLOW_MAX_QUEUE_LENGTH = None
+"""Pause the harvest while the workflow queue holds more messages than this.
+
+``None`` never pauses.
+"""
+
+OAIHARVESTER_OUTPUT_COMPRESSION = None
+"""Compression of the files written to a directory (``"gzip"`` or ``"xz"``)."""
+
+OAIHARVESTER_OUTPUT_MAX_BYTES = None
+"""Size in bytes after which a new file is started in a directory output."""
+
+OAIHARVESTER_OUTPUT_INDEX = True
+"""Write an identifier index next to every file of a directory output."""
+
+OAIHARVESTER_COLLECT_PROCESSES = 1
+"""Number of processes scanning files in ``utils.collect_identifiers``."""
+
+OAIHARVESTER_ARXIV_CACHE_DIR = os.path.join(CFG_DATADIR, "oaiharvester", "arxiv")
+"""Path to the cache of files downloaded from arXiv, shared by all records.
+
+Files are cached under the identifier of their version, resolved with
+OAIHARVESTER_ARXIV_API_URL for unversioned identifiers. Downloads in
+progress are kept next to it, in ``<OAIHARVESTER_ARXIV_CACHE_DIR>.download``.
+"""
+
+OAIHARVESTER_ARXIV_API_URL = "http://export.arxiv.org/api/query"
+"""URL of the arXiv API, asked for the current version of a record."""
+
+OAIHARVESTER_ARXIV_API_TIMEOUT = 30
+"""Time in seconds after which a request to the arXiv API is abandoned."""
+
+OAIHARVESTER_ARXIV_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+"""Size in bytes above which the least recently used arXiv files are removed."""
+
+OAIHARVESTER_EXTRACTION_PROCESSES = 0
+"""Number of processes running reference and plot extraction (0: inline).
+
+Celery prefork workers cannot start child processes: only use a pool where
+the workflows run in threads or in a ``solo`` worker.
+"""
+
+OAIHARVESTER_EXTRACTION_TIMEOUT = 600
+"""Time in seconds after which a reference or plot extraction is aborted."""
+
+OAIHARVESTER_EXTRACTION_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+"""Address space limit in bytes of an extraction process (None: unlimited)."""
+
+OAIHARVESTER_EXTRACTION_MAX_TASKS_PER_CHILD = 20
+"""Number of extractions after which an extraction process is replaced."""
+
+OAIHARVESTER_MATCH_BATCH_SIZE = 100
+"""Number of identifiers looked up by a single query in batch matching."""
+
+OAIHARVESTER_IDENTIFIER_INDEX = None
+"""Path of the local index of the identifiers of ingested records.
+
+Once it holds the identifiers of all the records of the database
+(``inveniomanage oaiharvester index``), record matching only searches for
+the identifiers found in it. The records created since, by any means, are
+added before each match.
+"""
+
+OAIHARVESTER_IDENTIFIER_INDEX_CAPACITY = 1000000
+"""Number of identifiers the Bloom filter of the identifier index is sized for."""
+
+OAIHARVESTER_IDENTIFIER_INDEX_KEYS = [("control_number", "control_number")]
+"""Record keys and search fields of the identifiers kept in the index."""
+
+OAIHARVESTER_INGEST_BATCH_SIZE = 500
+"""Number of records created in a single transaction by the ingest output."""
+
+OAIHARVESTER_XSLT_PRELOAD = ["oaidc2marcxml.xsl", "authorlist2marcxml.xsl"]
+"""Stylesheets compiled when a worker process starts."""
+
+OAIHARVESTER_LEDGER = False
+"""Skip the records of a named source which did not change since their last
+harvest, according to their datestamp and the hash of their metadata.
+
+The ledger is kept per source, whatever the output: only list harvests use
+it, and ``--force`` passes on every record, e.g. to fill a new output.
+"""
+
+OAIHARVESTER_WATERMARKS = True
+"""Continue the harvests of a named source from the latest datestamp received
+by its previous harvests (per set), rather than from its last run.
+
+Only the list harvests started without a from date move the watermarks."""
@@ -34,6 +34,10 @@ class WrongDateCombination(Exception):
     """'Until' date is larger that 'from' date."""
 
 
+class WrongDateFormat(Exception):
+    """Date is neither in 'YYYY-MM-DD' nor in 'YYYY-MM-DDThh:mm:ssZ' format."""
+
+
 class IdentifiersOrDates(Exception):
     """Identifiers cannot be used in combination with dates."""
 
@@ -44,3 +48,11 @@ class WrongOutputIdentifier(Exception):
 
 class WorkflowNotFound(Exception):
     """Workflow not found. Try '-o workflow -w <workflow name> or provide a name (-n <name>)."""
+
+
+class CheckpointNotFound(Exception):
+    """No interrupted harvest found. Try '-c <checkpoint id>' or '-n <name>'."""
+
+
+class CheckpointInUse(Exception):
+    """The interrupted harvest is being resumed by another run."""
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Local index of the identifiers of the records already ingested."""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import math
+import os
+import sqlite3
+import struct
+import threading
+
+import six
+
+from invenio.base.globals import cfg
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_identifier_key(field, value):
+    """Return the key of a value of a search field in the index."""
+    return "{0}:{1}".format(field or "", value)
+
+
+class IdentifierIndex(object):
+
+    """Persistent set of identifiers, fronted by an in-memory Bloom filter.
+
+    The exact set is kept in a SQLite database, which can be shared by
+    several processes.  Its Bloom filter is saved next to it and catches
+    up with the identifiers added by other processes before each lookup,
+    so that most identifiers which are not in the set are ruled out without
+    reading from disk.
+
+    Until the identifiers of the records already in the database are added
+    (see :attr:`complete`), a missing identifier proves nothing. Records
+    created outside of the harvester are added by
+    ``tasks.records.sync_identifier_index``.
+    """
+
+    def __init__(self, path, capacity=1000000, error_rate=0.01):
+        """Open the index, creating it if needed.
+
+        :param path: The path of the SQLite database.
+        :param capacity: The number of identifiers the Bloom filter is sized
+            for.
+        :param error_rate: The false positive rate of the Bloom filter at
+            its capacity.
+        """
+        self.path = path
+        self.bloom_path = path + ".bloom"
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS identifiers "
+            "(value TEXT PRIMARY KEY)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS settings "
+            "(name TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.connection.commit()
+        self._complete = False
+
+        self.bits, self.last_rowid = self._load_bloom()
+        self.unsaved = 0
+        self._catch_up()
+
+    def _load_bloom(self):
+        """Return the saved Bloom filter and the last identifier it holds."""
+        try:
+            with open(self.bloom_path, "rb") as fd:
+                size, hashes, last_rowid = (
+                    int(value) for value in fd.readline().split())
+                bits = bytearray(fd.read())
+        except (IOError, OSError, ValueError):
+            return bytearray((self.size + 7) // 8), 0
+        if size != self.size or hashes != self.hashes or \
+                len(bits) != (self.size + 7) // 8:
+            # Sized for another capacity, rebuild it from the exact set.
+            return bytearray((self.size + 7) // 8), 0
+        return bits, last_rowid
+
+    def _positions(self, key):
+        """Return the positions of the bits of a key in the Bloom filter."""
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.size
+                for i in range(self.hashes)]
+
+    def _add_to_bloom(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def _in_bloom(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def _catch_up(self):
+        """Add the identifiers stored since the last lookup to the filter."""
+        cursor = self.connection.execute(
+            "SELECT rowid, value FROM identifiers WHERE rowid > ? "
+            "ORDER BY rowid", (self.last_rowid,)
+        )
+        for rowid, value in cursor:
+            self._add_to_bloom(value)
+            self.last_rowid = rowid
+            self.unsaved += 1
+
+    def add(self, keys):
+        """Add identifiers to the index.
+
+        :param keys: The identifiers, see :func:`get_identifier_key`.
+        """
+        keys = [(key, ) for key in keys]
+        if not keys:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO identifiers (value) VALUES (?)",
+                    keys
+                )
+            self._catch_up()
+            if self.unsaved >= 10000:
+                self._save()
+
+    def filter(self, keys):
+        """Return the identifiers which are in the index.
+
+        :param keys: The identifiers, see :func:`get_identifier_key`.
+        :return: A set with the identifiers found.
+        """
+        with self.lock:
+            self._catch_up()
+            candidates = [key for key in set(keys) if self._in_bloom(key)]
+            found = set()
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                cursor = self.connection.execute(
+                    "SELECT value FROM identifiers WHERE value IN "
+                    "({0})".format(", ".join(["?"] * len(chunk))), chunk
+                )
+                found.update(value for value, in cursor)
+        return found
+
+    @property
+    def complete(self):
+        """Whether the index holds the identifiers of all ingested records."""
+        if not self._complete:
+            self._complete = self.get_setting("complete") == "1"
+        return self._complete
+
+    def mark_complete(self):
+        """Record that the records of the database were all added."""
+        self.set_setting("complete", "1")
+        self._complete = True
+
+    def get_setting(self, name):
+        """Return a value stored with the index, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM settings WHERE name = ?", (name, )
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, name, value):
+        """Store a value with the index."""
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO settings (name, value) "
+                    "VALUES (?, ?)", (name, value)
+                )
+
+    def __contains__(self, key):
+        """Check if an identifier is in the index."""
+        return bool(self.filter([key]))
+
+    def _save(self):
+        temporary = self.bloom_path + ".part"
+        with open(temporary, "wb") as fd:
+            fd.write("{0} {1} {2}\n".format(
+                self.size, self.hashes, self.last_rowid).encode("ascii"))
+            fd.write(six.binary_type(self.bits))
+        os.rename(temporary, self.bloom_path)
+        self.unsaved = 0
+
+    def close(self):
+        """Save the Bloom filter and close the index."""
+        with self.lock:
+            self._catch_up()
+            if self.unsaved:
+                self._save()
+            self.connection.close()
+
+
+def get_identifier_index():
+    """Return the identifier index of the process.
+
+    :return: An :class:`IdentifierIndex`, or None if
+        OAIHARVESTER_IDENTIFIER_INDEX is not set.
+    """
+    global _index
+    path = cfg.get("OAIHARVESTER_IDENTIFIER_INDEX")
+    if not path:
+        return None
+    with _index_lock:
+        if _index is None or _index.path != path:
+            _index = IdentifierIndex(
+                path,
+                capacity=cfg.get("OAIHARVESTER_IDENTIFIER_INDEX_CAPACITY",
+                                 1000000)
+            )
+        return _index
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Ledger of the last harvested version of the records of a source."""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+
+from lxml import etree
+
+OAI_NAMESPACE = "{http://www.openarchives.org/OAI/2.0/}"
+
+
+def get_record_hash(record):
+    """Return the hash of the metadata of a harvested record.
+
+    :param record: A harvested record.
+    :return: The SHA-1 of the canonical metadata, or None if the record is
+             deleted.
+    """
+    if record.header.deleted:
+        return None
+    metadata = record.xml.find('.//' + OAI_NAMESPACE + 'metadata')
+    if metadata is None:
+        metadata = record.xml
+    return hashlib.sha1(etree.tostring(metadata, method='c14n')).hexdigest()
+
+
+class OutputFlush(object):
+
+    """Flushes the output of a harvest which has no checkpoint.
+
+    The outputs register their flush callbacks with it, as they would with
+    an OaiHARVESTCHECKPOINT.
+    """
+
+    def __init__(self):
+        """Initialize the flush callbacks."""
+        self.flush_callbacks = []
+
+    def add_files(self, paths):
+        """Ignore the files written by the output, nothing is resumed."""
+
+    def flush(self):
+        """Ask the output to persist everything it has received so far."""
+        for callback in self.flush_callbacks:
+            callback()
+
+
+class RecordLedger(object):
+
+    """Skips unchanged records and remembers the records seen.
+
+    The entries of the records passed on are only written by
+    :meth:`commit`, which is called once the output has persisted them:
+    after every page of a checkpointed harvest, after every batch otherwise.
+    """
+
+    def __init__(self, id_oaiHARVEST, batch_size=1000, force=False):
+        """Initialize the ledger of a source.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param batch_size: The number of records looked up at once.
+        :param force: Pass on every record, still remembering them.
+        """
+        self.id_oaiHARVEST = id_oaiHARVEST
+        self.batch_size = batch_size
+        self.force = force
+        self.pending = {}
+        self.skipped = 0
+
+    def is_empty(self):
+        """Check if no record of the source was harvested yet."""
+        from .models import OaiHARVESTLEDGER
+        return not OaiHARVESTLEDGER.has_entries(self.id_oaiHARVEST)
+
+    def get_datestamps(self, identifiers):
+        """Return the datestamps of the records last harvested.
+
+        :param identifiers: The OAI identifiers of the records.
+        :return: A dictionary of identifiers to datestamps.
+        """
+        from .models import OaiHARVESTLEDGER
+        entries = OaiHARVESTLEDGER.get_entries(self.id_oaiHARVEST,
+                                               identifiers)
+        return dict((identifier, datestamp)
+                    for identifier, (datestamp, dummy) in entries.items())
+
+    def filter(self, records, checkpoint=None, output=None):
+        """Pass on the records which are new or changed.
+
+        A record is skipped when both its datestamp and the hash of its
+        metadata are the ones of its last harvest.
+
+        With a checkpoint, the records of each page are looked up at once,
+        as a page filter: holding records back across pages would let the
+        checkpoint move past records the output has not seen yet.
+        Otherwise, the records are looked up by batch, and the entries of a
+        batch are committed once the output has consumed and flushed it.
+
+        :param records: An iterator of harvested records.
+        :param checkpoint: An OaiHARVESTCHECKPOINT object to register with,
+                           after the output (optional).
+        :param output: The OutputFlush of the output, without a checkpoint
+                       (optional, the entries are then only committed by the
+                       caller).
+        :return: An iterator of harvested records.
+        """
+        if checkpoint is None:
+            return self._filter_records(records, output)
+
+        def filter_page(page):
+            if self.commit not in checkpoint.flush_callbacks:
+                # The output has registered its own callbacks by now.
+                checkpoint.flush_callbacks.append(self.commit)
+            return list(self._filter_batch(page))
+
+        checkpoint.page_filters.append(filter_page)
+        return records
+
+    def _filter_records(self, records, output=None):
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) < self.batch_size:
+                continue
+            for changed in self._filter_batch(batch):
+                yield changed
+            if output is not None:
+                # The output has consumed the records of the batch.
+                output.flush()
+                self.commit()
+            batch = []
+        for changed in self._filter_batch(batch):
+            yield changed
+
+    def _filter_batch(self, batch):
+        from .models import OaiHARVESTLEDGER
+
+        if not batch:
+            return
+        entries = {}
+        if not self.force:
+            entries = OaiHARVESTLEDGER.get_entries(
+                self.id_oaiHARVEST,
+                [record.header.identifier for record in batch]
+            )
+        for record in batch:
+            identifier = record.header.identifier
+            entry = (record.header.datestamp, get_record_hash(record))
+            if not self.force and \
+                    self.pending.get(identifier,
+                                     entries.get(identifier)) == entry:
+                self.skipped += 1
+                continue
+            self.pending[identifier] = entry
+            yield record
+
+    def discard(self, identifiers):
+        """Forget the records passed on which the output could not keep.
+
+        They are then not skipped by the next harvest.
+
+        :param identifiers: The OAI identifiers of the records.
+        """
+        for identifier in identifiers:
+            self.pending.pop(identifier, None)
+
+    def commit(self):
+        """Write the entries of the records passed on since the last commit."""
+        from .models import OaiHARVESTLEDGER
+        OaiHARVESTLEDGER.update_entries(self.id_oaiHARVEST, self.pending)
+        self.pending = {}
+
+
+class HighWaterMark(object):
+
+    """Tracks the latest datestamp received from a source, per set.
+
+    The watermarks are only moved forward by :meth:`commit`, which is
+    called once the harvest is complete and its output flushed, and never
+    past the datestamp of a record the output could not keep.
+    """
+
+    def __init__(self, id_oaiHARVEST, sets=None):
+        """Initialize the tracking of a harvest.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param sets: The sets harvested (None for the whole source).
+        """
+        self.id_oaiHARVEST = id_oaiHARVEST
+        self.sets = sets
+        self.latest = {}
+        self.earliest_rejected = None
+
+    def _get_keys(self, header):
+        if self.sets is None:
+            return ['']
+        # Set hierarchies: a record of physics:hep-th belongs to physics.
+        keys = [set_spec for set_spec in self.sets
+                if any(spec == set_spec or spec.startswith(set_spec + ':')
+                       for spec in header.setSpecs)]
+        if not keys and len(self.sets) == 1:
+            # Every record listed for the set belongs to it, even without
+            # a setSpec in its header.
+            keys = list(self.sets)
+        return keys
+
+    def track(self, records):
+        """Pass on the records, remembering their latest datestamp.
+
+        :param records: An iterator of harvested records.
+        :return: An iterator of harvested records.
+        """
+        from .utils import parse_oai_date
+
+        for record in records:
+            datestamp = record.header.datestamp
+            if datestamp:
+                value = parse_oai_date(datestamp)
+                for key in self._get_keys(record.header):
+                    if key not in self.latest or value > self.latest[key][0]:
+                        self.latest[key] = (value, datestamp)
+            yield record
+
+    def hold_back(self, datestamps):
+        """Keep the watermarks at the datestamps of records not kept.
+
+        As the harvests include their ``from`` date, the next one starts
+        with the earliest of these records.
+
+        :param datestamps: The datestamps of the records the output could
+                           not keep.
+        """
+        from .utils import parse_oai_date
+
+        for datestamp in datestamps:
+            if not datestamp:
+                continue
+            value = parse_oai_date(datestamp)
+            if self.earliest_rejected is None or \
+                    value < self.earliest_rejected[0]:
+                self.earliest_rejected = (value, datestamp)
+
+    def commit(self):
+        """Move the watermarks to the latest datestamps received."""
+        from .models import OaiHARVESTWATERMARK
+        if not self.latest:
+            return
+        datestamps = {}
+        for key, latest in self.latest.items():
+            if self.earliest_rejected is not None and \
+                    latest[0] > self.earliest_rejected[0]:
+                # Whatever the set of the rejected record.
+                latest = self.earliest_rejected
+            datestamps[key] = latest[1]
+        OaiHARVESTWATERMARK.advance(self.id_oaiHARVEST, datestamps)
@@ -19,16 +19,21 @@
 
 """CLI tool to harvest records from an OAI-PMH repository.
 
-The output can be directed to files in a directory, passed into a "workflow"
-or printed to stdout (default).
+The output can be directed to files in a directory, passed into a "workflow",
+created as records in bulk ("ingest") or printed to stdout (default).
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
 
 from invenio.ext.script import Manager
 
-from .errors import IdentifiersOrDates
-from .tasks import get_specific_records, list_records_from_dates
+from .errors import CheckpointNotFound, IdentifiersOrDates
+from .tasks import (
+    get_specific_records,
+    harvest_sources,
+    list_records_from_dates,
+    resume_harvest,
+)
 
 manager = Manager(description=__doc__)
 
@@ -48,16 +53,27 @@ manager = Manager(description=__doc__)
 @manager.option('-u', '--url', dest='url', default=None,
                 help="The upper bound date for the harvesting (optional).")
 @manager.option('-o', '--output', dest='output', default='stdout',
-                help="The type of the output (stdout, workflow, dir/directory).")
+                help="The type of the output (stdout, workflow, dir/directory, ingest).")
 @manager.option('-w', '--workflow', dest='workflow', default=None,
                 help="The workflow that should process the output.")
 @manager.option('-d', '--dir', dest='directory', default='records_harvested',
                 help="The directory that we want to send the harvesting results.")
+@manager.option('-p', '--windows', dest='windows', default=None, type=int,
+                help="The number of date windows to harvest in parallel (optional).")
+@manager.option('-a', '--all-sets', dest='all_sets', action='store_true', default=False,
+                help="Harvest every set in parallel, the comma-separated ones in -s if given.")
+@manager.option('-c', '--changed', dest='changed', action='store_true', default=False,
+                help="Only fetch the records which are new or changed (ListIdentifiers + GetRecord).")
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help="Pass on the records which did not change since their last harvest.")
 def get(metadata_prefix, name, setSpec, identifiers, from_date,
-        until_date, url, output, workflow, directory):
+        until_date, url, output, workflow, directory, windows, all_sets,
+        changed, force):
     """Harvest records from an OAI repository immediately, without scheduling."""
     begin_harvesting_action(metadata_prefix, name, setSpec, identifiers, from_date,
-                            until_date, url, output, workflow, directory, is_queue=False)
+                            until_date, url, output, workflow, directory,
+                            is_queue=False, windows=windows, all_sets=all_sets,
+                            changed=changed, force=force)
 
 
 @manager.option('-m', '--metadataprefix', dest='metadata_prefix', default=None,
@@ -75,20 +91,99 @@ def get(metadata_prefix, name, setSpec, identifiers, from_date,
 @manager.option('-u', '--url', dest='url', default=None,
                 help="The upper bound date for the harvesting (optional).")
 @manager.option('-o', '--output', dest='output', default='stdout',
-                help="The type of the output (stdout, workflow, dir/directory).")
+                help="The type of the output (stdout, workflow, dir/directory, ingest).")
 @manager.option('-w', '--workflow', dest='workflow', default=None,
                 help="The workflow that should process the output.")
 @manager.option('-d', '--dir', dest='directory', default='records_harvested',
                 help="The directory that we want to send the harvesting results.")
+@manager.option('-p', '--windows', dest='windows', default=None, type=int,
+                help="The number of date windows to harvest in parallel (optional).")
+@manager.option('-a', '--all-sets', dest='all_sets', action='store_true', default=False,
+                help="Harvest every set in parallel, the comma-separated ones in -s if given.")
+@manager.option('-c', '--changed', dest='changed', action='store_true', default=False,
+                help="Only fetch the records which are new or changed (ListIdentifiers + GetRecord).")
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help="Pass on the records which did not change since their last harvest.")
 def queue(metadata_prefix, name, setSpec, identifiers, from_date,
-          until_date, url, output, workflow, directory):
+          until_date, url, output, workflow, directory, windows, all_sets,
+          changed, force):
     """Schedule a run to harvest records from an OAI repository."""
     begin_harvesting_action(metadata_prefix, name, setSpec, identifiers, from_date,
-                            until_date, url, output, workflow, directory, is_queue=True)
+                            until_date, url, output, workflow, directory,
+                            is_queue=True, windows=windows, all_sets=all_sets,
+                            changed=changed, force=force)
+
+
+@manager.option('-c', '--checkpoint', dest='checkpoint_id', default=None, type=int,
+                help="The id of the checkpoint of the harvest to resume.")
+@manager.option('-n', '--name', dest='name', default=None,
+                help="Resume the last interrupted harvest of this OaiHARVEST object.")
+@manager.option('-q', '--queue', dest='is_queue', action='store_true', default=False,
+                help="Schedule the harvest instead of running it immediately.")
+def resume(checkpoint_id, name, is_queue):
+    """Resume an interrupted harvest from its last completed page."""
+    from .models import OaiHARVEST, OaiHARVESTCHECKPOINT
+
+    if checkpoint_id is None:
+        checkpoint = None
+        if name is not None:
+            checkpoint = OaiHARVESTCHECKPOINT.get(
+                OaiHARVESTCHECKPOINT.harvest.has(OaiHARVEST.name == name),
+                finished=False
+            ).order_by(OaiHARVESTCHECKPOINT.modified.desc()).first()
+        if checkpoint is None:
+            raise CheckpointNotFound("No interrupted harvest found. "
+                                     "Try '-c <checkpoint id>' or '-n <name>'.")
+        checkpoint_id = checkpoint.id
+
+    if is_queue:
+        job = resume_harvest.delay(checkpoint_id)
+        print("Scheduled job {0}".format(job.id))
+    else:
+        resume_harvest(checkpoint_id)
+
+
+@manager.option('-n', '--names', dest='names', default=None,
+                help="Comma-separated names of the OaiHARVEST objects (defaults to all).")
+@manager.option('-o', '--output', dest='output', default='dir',
+                help="The type of the output (stdout, workflow, dir/directory, ingest).")
+@manager.option('-w', '--workflow', dest='workflow', default=None,
+                help="The workflow that should process the output.")
+@manager.option('-d', '--dir', dest='directory', default='records_harvested',
+                help="The directory that we want to send the harvesting results.")
+@manager.option('-c', '--concurrency', dest='concurrency', default=None, type=int,
+                help="The number of sources harvested at the same time.")
+@manager.option('-q', '--queue', dest='is_queue', action='store_true', default=False,
+                help="Schedule the harvest instead of running it immediately.")
+def sources(names, output, workflow, directory, concurrency, is_queue):
+    """Harvest several sources concurrently from their last run."""
+    if names:
+        names = [name.strip() for name in names.split(",")]
+    params = (names, output, workflow, directory, concurrency)
+    if is_queue:
+        job = harvest_sources.delay(*params)
+        print("Scheduled job {0}".format(job.id))
+    else:
+        harvest_sources(*params)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', default=1000, type=int,
+                help="The number of records read at once.")
+def index(batch_size):
+    """Fill the identifier index with the records already in the database."""
+    from .tasks.records import rebuild_identifier_index
+
+    count = rebuild_identifier_index(batch_size)
+    if count is None:
+        print("OAIHARVESTER_IDENTIFIER_INDEX is not set.")
+    else:
+        print("Indexed the identifiers of {0} records.".format(count))
 
 
 def begin_harvesting_action(metadata_prefix, name, setSpec, identifiers, from_date,
-                            until_date, url, output, workflow, directory, is_queue=False):
+                            until_date, url, output, workflow, directory, is_queue=False,
+                            windows=None, all_sets=False, changed=False,
+                            force=False):
     """Select the right method for harvesting according to the parameters.
 
     Then run it immediately or queue it with Celery.
@@ -104,6 +199,10 @@ def begin_harvesting_action(metadata_prefix, name, setSpec, identifiers, from_da
     :param workflow: The workflow that should process the output.
     :param directory: The directory that we want to send the harvesting results.
     :param is_queue: Boolean to check whether the harvest should be queued or run immediately.
+    :param windows: The number of date windows to harvest in parallel (optional).
+    :param all_sets: Harvest every set in parallel, the ones in setSpec if given.
+    :param changed: Only fetch the records which are new or changed.
+    :param force: Pass on the records which did not change since their last harvest.
     """
     if identifiers is None:
         # If no identifiers are provided, a harvest is scheduled:
@@ -112,10 +211,13 @@ def begin_harvesting_action(metadata_prefix, name, setSpec, identifiers, from_da
         params = (metadata_prefix, from_date, until_date, url,
                   name, setSpec, output, workflow, directory)
         if is_queue:
-            job = list_records_from_dates.delay(*params)
+            job = list_records_from_dates.delay(*params, windows=windows,
+                                                all_sets=all_sets,
+                                                changed=changed, force=force)
             print("Scheduled job {0}".format(job.id))
         else:
-            list_records_from_dates(*params)
+            list_records_from_dates(*params, windows=windows, all_sets=all_sets,
+                                    changed=changed, force=force)
     else:
         if (from_date is not None) or (until_date is not None):
             raise IdentifiersOrDates("Identifiers cannot be used in combination with dates.")
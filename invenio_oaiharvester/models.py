@@ -21,8 +21,11 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+from datetime import datetime, timedelta
+
 from invenio.ext.sqlalchemy import db
 from invenio.ext.sqlalchemy.utils import session_manager
+from sqlalchemy.orm import reconstructor
 
 
 def get_default_arguments():
@@ -87,4 +90,302 @@ class OaiHARVEST(db.Model):
         db.session.add(self)
 
 
-__all__ = ('OaiHARVEST',)
+class OaiHARVESTCHECKPOINT(db.Model):
+
+    """Represents the progress of a ListRecords harvest.
+
+    The resumption token and the last datestamp are saved once every page
+    has been handed over to the output, so that an interrupted harvest can
+    continue from the last completed page.
+    """
+
+    __tablename__ = 'oaiHARVESTCHECKPOINT'
+
+    id = db.Column(db.Integer(15, unsigned=True), nullable=False,
+                   primary_key=True, autoincrement=True)
+    id_oaiHARVEST = db.Column(db.MediumInteger(9, unsigned=True),
+                              db.ForeignKey(OaiHARVEST.id), nullable=True)
+    baseurl = db.Column(db.String(255), nullable=False, server_default='')
+    metadataprefix = db.Column(db.String(255), nullable=False,
+                               server_default='oai_dc')
+    setspec = db.Column(db.String(255), nullable=True)
+    from_date = db.Column(db.String(20), nullable=True)
+    until_date = db.Column(db.String(20), nullable=True)
+    output = db.Column(db.String(20), nullable=False, server_default='stdout')
+    workflow = db.Column(db.String(255), nullable=True)
+    directory = db.Column(db.String(255), nullable=True)
+    resumption_token = db.Column(db.Text, nullable=True)
+    last_datestamp = db.Column(db.String(20), nullable=True)
+    records = db.Column(db.Integer(15, unsigned=True), nullable=False,
+                        default=0)
+    files = db.Column(db.MarshalBinary(default_value=[], force_type=list),
+                      nullable=False)
+    finished = db.Column(db.Boolean, nullable=False, default=False)
+    owner = db.Column(db.String(255), nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    modified = db.Column(db.DateTime, nullable=False, default=datetime.now,
+                         onupdate=datetime.now)
+
+    harvest = db.relationship(OaiHARVEST, backref='checkpoints')
+
+    def __init__(self, **kwargs):
+        """Initialize the checkpoint, its flush callbacks and page filters."""
+        super(OaiHARVESTCHECKPOINT, self).__init__(**kwargs)
+        self.init_on_load()
+
+    @reconstructor
+    def init_on_load(self):
+        """Initialize the flush callbacks and page filters, not persisted.
+
+        A page filter is called with the records of each page and returns
+        the ones to pass on to the output.
+        """
+        self.flush_callbacks = []
+        self.page_filters = []
+
+    @classmethod
+    def get(cls, *criteria, **filters):
+        """Wrapper for filter and filter_by functions of SQLAlchemy."""
+        return cls.query.filter(*criteria).filter_by(**filters)
+
+    @classmethod
+    def get_unfinished(cls, **filters):
+        """Return the most recent unfinished checkpoint matching the filters."""
+        return cls.get(finished=False, **filters).order_by(
+            cls.modified.desc()
+        ).first()
+
+    @classmethod
+    def claim_unfinished(cls, owner, lease, **filters):
+        """Claim the most recent unfinished checkpoint free for the owner.
+
+        :param owner: The id of the run claiming the checkpoint.
+        :param lease: The seconds after which a checkpoint which was not
+                      saved by its owner is free to claim.
+        :return: An OaiHARVESTCHECKPOINT object, or None.
+        """
+        for checkpoint in cls.get(finished=False, **filters).order_by(
+                cls.modified.desc()):
+            if checkpoint.claim(owner, lease):
+                return checkpoint
+        return None
+
+    def is_claimed(self, owner, lease):
+        """Check if another run, still saving its progress, owns the checkpoint.
+
+        :param owner: The id of the run asking.
+        :param lease: The seconds after which a checkpoint which was not
+                      saved by its owner is free to claim.
+        """
+        return self.owner not in (None, owner) and \
+            self.modified >= datetime.now() - timedelta(seconds=lease)
+
+    def claim(self, owner, lease):
+        """Take the checkpoint over for a run, unless another run owns it.
+
+        The owner is only changed if the checkpoint was not saved since it
+        was read, so that two runs cannot claim it at the same time.
+
+        :param owner: The id of the run claiming the checkpoint.
+        :param lease: The seconds after which a checkpoint which was not
+                      saved by its owner is free to claim.
+        :return: True if the checkpoint now belongs to the owner.
+        """
+        if self.is_claimed(owner, lease):
+            return False
+        if self.owner == owner:
+            return True
+        claimed = self.query.filter(
+            OaiHARVESTCHECKPOINT.id == self.id,
+            OaiHARVESTCHECKPOINT.owner == self.owner,
+            OaiHARVESTCHECKPOINT.modified == self.modified,
+        ).update({'owner': owner, 'modified': datetime.now()},
+                 synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(self)
+        return claimed == 1 and self.owner == owner
+
+    def add_files(self, paths):
+        """Register files written by the output."""
+        self.files = self.files + [path for path in paths
+                                   if path not in self.files]
+
+    def flush(self):
+        """Ask the output to persist everything it has received so far."""
+        for callback in self.flush_callbacks:
+            callback()
+
+    def update_progress(self, resumption_token, last_datestamp, records):
+        """Save the state reached after a completed page.
+
+        :param resumption_token: The token of the next page (None if last).
+        :param last_datestamp: The latest datestamp seen in the page.
+        :param records: The number of records in the page.
+        """
+        self.flush()
+        self.resumption_token = resumption_token
+        if last_datestamp and (self.last_datestamp is None or
+                               last_datestamp > self.last_datestamp):
+            self.last_datestamp = last_datestamp
+        self.records += records
+        self.save()
+
+    def finish(self):
+        """Mark the harvest as completed."""
+        self.flush()
+        self.resumption_token = None
+        self.finished = True
+        self.save()
+
+    @session_manager
+    def save(self):
+        """Save object to persistent storage."""
+        db.session.add(self)
+
+
+class OaiHARVESTLEDGER(db.Model):
+
+    """Represents the last harvested version of a record of a source.
+
+    Holds the datestamp and a hash of the metadata of every record seen,
+    so that reharvested records which have not changed can be skipped.
+    """
+
+    __tablename__ = 'oaiHARVESTLEDGER'
+
+    id_oaiHARVEST = db.Column(db.MediumInteger(9, unsigned=True),
+                              db.ForeignKey(OaiHARVEST.id), nullable=False,
+                              primary_key=True)
+    identifier = db.Column(db.String(255), nullable=False, primary_key=True)
+    datestamp = db.Column(db.String(20), nullable=True)
+    hash = db.Column(db.String(40), nullable=True)
+    modified = db.Column(db.DateTime, nullable=False, default=datetime.now,
+                         onupdate=datetime.now)
+
+    @classmethod
+    def get_entries(cls, id_oaiHARVEST, identifiers):
+        """Return the entries of some records of a source.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param identifiers: The OAI identifiers of the records.
+        :return: A dictionary of identifiers to (datestamp, hash) tuples.
+        """
+        entries = {}
+        identifiers = list(identifiers)
+        for start in range(0, len(identifiers), 500):
+            query = db.session.query(
+                cls.identifier, cls.datestamp, cls.hash
+            ).filter(
+                cls.id_oaiHARVEST == id_oaiHARVEST,
+                cls.identifier.in_(identifiers[start:start + 500])
+            )
+            for identifier, datestamp, hash_ in query:
+                entries[identifier] = (datestamp, hash_)
+        return entries
+
+    @classmethod
+    def has_entries(cls, id_oaiHARVEST):
+        """Check if any record of a source was harvested.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        """
+        return db.session.query(cls.identifier).filter(
+            cls.id_oaiHARVEST == id_oaiHARVEST
+        ).first() is not None
+
+    @classmethod
+    def update_entries(cls, id_oaiHARVEST, entries):
+        """Insert or update the entries of some records of a source at once.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param entries: A dictionary of identifiers to (datestamp, hash).
+        """
+        if not entries:
+            return
+        existing = cls.get_entries(id_oaiHARVEST, entries.keys())
+        now = datetime.now()
+        rows = [{'b_id': id_oaiHARVEST, 'b_identifier': identifier,
+                 'b_datestamp': datestamp, 'b_hash': hash_, 'b_modified': now}
+                for identifier, (datestamp, hash_) in entries.items()]
+        table = cls.__table__
+        new_rows = [row for row in rows
+                    if row['b_identifier'] not in existing]
+        changed_rows = [row for row in rows
+                        if row['b_identifier'] in existing]
+        if new_rows:
+            db.session.execute(table.insert().values(
+                id_oaiHARVEST=db.bindparam('b_id'),
+                identifier=db.bindparam('b_identifier'),
+                datestamp=db.bindparam('b_datestamp'),
+                hash=db.bindparam('b_hash'),
+                modified=db.bindparam('b_modified'),
+            ), new_rows)
+        if changed_rows:
+            db.session.execute(table.update().where(db.and_(
+                table.c.id_oaiHARVEST == db.bindparam('b_id'),
+                table.c.identifier == db.bindparam('b_identifier'),
+            )).values(
+                datestamp=db.bindparam('b_datestamp'),
+                hash=db.bindparam('b_hash'),
+                modified=db.bindparam('b_modified'),
+            ), changed_rows)
+        db.session.commit()
+
+
+class OaiHARVESTWATERMARK(db.Model):
+
+    """Represents the latest datestamp harvested from a source and set.
+
+    The set is empty for harvests of the whole source.
+    """
+
+    __tablename__ = 'oaiHARVESTWATERMARK'
+
+    id_oaiHARVEST = db.Column(db.MediumInteger(9, unsigned=True),
+                              db.ForeignKey(OaiHARVEST.id), nullable=False,
+                              primary_key=True)
+    setspec = db.Column(db.String(255), nullable=False, primary_key=True,
+                        server_default='')
+    datestamp = db.Column(db.String(20), nullable=False)
+    modified = db.Column(db.DateTime, nullable=False, default=datetime.now,
+                         onupdate=datetime.now)
+
+    @classmethod
+    def get_datestamp(cls, id_oaiHARVEST, setspec=None):
+        """Return the latest datestamp harvested from a source and set.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param setspec: The set (None for the whole source).
+        :return: The datestamp, or None if nothing was harvested yet.
+        """
+        watermark = cls.query.get((id_oaiHARVEST, setspec or ''))
+        return watermark.datestamp if watermark is not None else None
+
+    @classmethod
+    @session_manager
+    def advance(cls, id_oaiHARVEST, datestamps):
+        """Move the watermarks of a source forward.
+
+        A watermark is only changed if the new datestamp is later.
+
+        :param id_oaiHARVEST: The id of the OaiHARVEST object.
+        :param datestamps: A dictionary of sets ('' for the whole source) to
+                           the latest datestamp harvested.
+        """
+        from .utils import parse_oai_date
+
+        for setspec, datestamp in datestamps.items():
+            watermark = cls.query.get((id_oaiHARVEST, setspec))
+            if watermark is None:
+                watermark = cls(id_oaiHARVEST=id_oaiHARVEST, setspec=setspec,
+                                datestamp=datestamp)
+            elif parse_oai_date(datestamp) > \
+                    parse_oai_date(watermark.datestamp):
+                watermark.datestamp = datestamp
+            else:
+                continue
+            db.session.add(watermark)
+
+
+__all__ = ('OaiHARVEST', 'OaiHARVESTCHECKPOINT', 'OaiHARVESTLEDGER',
+           'OaiHARVESTWATERMARK')
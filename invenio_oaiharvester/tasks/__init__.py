@@ -19,22 +19,60 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-from invenio.celery import celery
+import os
+import sys
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from celery.signals import worker_process_init
+from flask import current_app
 
-from invenio.modules.workflows.api import start_delayed
+from invenio.base.globals import cfg
+from invenio.celery import celery
 
-from ..api import get_records, list_records
-from ..errors import WrongOutputIdentifier
+from ..api import (
+    checkpointed_records,
+    get_checkpoint,
+    get_harvested_sets,
+    get_host_semaphore,
+    get_records,
+    list_changed_records,
+    list_records,
+    list_records_in_sets,
+    list_records_in_windows,
+)
+from ..errors import (
+    CheckpointInUse,
+    CheckpointNotFound,
+    WrongOutputIdentifier,
+)
+from ..ledger import HighWaterMark, OutputFlush, RecordLedger
 from ..utils import (
     write_to_dir,
     print_to_stdout,
     get_workflow_name,
+    get_dir_ledger,
     get_identifier_names,
+    get_oaiharvest_object,
+    get_set_names,
+    ingest_records,
     print_total_records,
     print_files_created,
+    send_to_workflow,
+    warm_xslt_cache,
 )
 
 
+@worker_process_init.connect
+def warm_worker_caches(**kwargs):
+    """Compile the stylesheets of OAIHARVESTER_XSLT_PRELOAD in each worker."""
+    flask_app = getattr(celery.loader, 'flask_app', None)
+    if flask_app is None:
+        return
+    with flask_app.app_context():
+        warm_xslt_cache()
+
+
 @celery.task
 def get_specific_records(identifiers, metadata_prefix, url,
                          name, output, workflow, directory):
@@ -45,7 +83,8 @@ def get_specific_records(identifiers, metadata_prefix, url,
     :param identifiers: A list of unique identifiers for records to be harvested.
     :param url: The The url to be used to create the endpoint.
     :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
-    :param output: The type of the output (stdout, workflow, dir/directory).
+    :param output: The type of the output (stdout, workflow, dir/directory,
+                   ingest).
     :param workflow: The workflow that should process the output.
     :param directory: The directory that we want to send the harvesting results.
     """
@@ -54,49 +93,250 @@ def get_specific_records(identifiers, metadata_prefix, url,
                      get_records(identifiers, metadata_prefix, url, name))
 
 
-@celery.task
+@celery.task(acks_late=True)
 def list_records_from_dates(metadata_prefix, from_date, until_date, url,
-                            name, setSpec, output, workflow, directory):
+                            name, setSpec, output, workflow, directory,
+                            windows=None, all_sets=False, changed=False,
+                            force=False):
     """Call the module API, in order to harvest records from an OAI repo,
     based on datestamp and/or set parameters.
 
     :param metadata_prefix: The prefix for the metadata return (e.g. 'oai_dc') (required).
     :param from_date: The lower bound date for the harvesting (optional).
+                      Without it, a named source is harvested from its
+                      watermark or last run and the watermark is moved.
     :param until_date: The upper bound date for the harvesting (optional).
     :param url: The The url to be used to create the endpoint.
     :param name: The name of the OaiHARVEST object that we want to use to create the endpoint.
     :param setSpec: The 'set' criteria for the harvesting (optional).
-    :param output: The type of the output (stdout, workflow, dir/directory).
+    :param output: The type of the output (stdout, workflow, dir/directory,
+                   ingest).
     :param workflow: The workflow that should process the output.
     :param directory: The directory that we want to send the harvesting results.
+    :param windows: The number of date windows to harvest in parallel (optional).
+    :param all_sets: Harvest every set in parallel, the ones in setSpec if given.
+    :param changed: Only fetch the records which are new or changed since
+                    they were last harvested to the output. Such a harvest
+                    is not checkpointed.
+    :param force: Pass on the records which did not change since their last
+                  harvest, with OAIHARVESTER_LEDGER.
+    """
+    sets = [setSpec] if setSpec else None
+    checkpoint = None
+    ledger = get_ledger(name, force)
+    if changed:
+        changed_ledger = ledger
+        if force:
+            # Compare with nothing, every record is passed on.
+            changed_ledger = None
+        elif ledger is None and output in ('dir', 'directory'):
+            changed_ledger = get_dir_ledger(directory)
+        records = list_changed_records(metadata_prefix, from_date,
+                                       until_date, url, name, setSpec,
+                                       ledger=changed_ledger)
+    elif all_sets:
+        # Resolved here, so that the watermarks only move for these sets.
+        set_names = get_harvested_sets(url, name, get_set_names(setSpec))
+        sets = None if set_names == [None] else set_names
+        records = list_records_in_sets(metadata_prefix, from_date, until_date,
+                                       url, name, sets=set_names)
+    elif windows:
+        records = list_records_in_windows(metadata_prefix, from_date,
+                                          until_date, url, name, setSpec,
+                                          windows=windows)
+    elif cfg.get("OAIHARVESTER_CHECKPOINTS"):
+        # Continues an interrupted harvest with the same parameters, if any.
+        checkpoint = get_checkpoint(metadata_prefix, from_date, until_date,
+                                    url, name, setSpec, output, workflow,
+                                    directory,
+                                    owner=list_records_from_dates.request.id)
+        records = checkpointed_records(checkpoint)
+    else:
+        records = list_records(metadata_prefix, from_date, until_date, url,
+                               name, setSpec)
+
+    watermark = None
+    if from_date is None:
+        # Started from the watermark or the last run, move it forward.
+        watermark = get_high_water_mark(name, sets)
+    schedule_harvest(output, workflow, directory, name, records,
+                     checkpoint=checkpoint, ledger=ledger, watermark=watermark)
+
+
+@celery.task(acks_late=True)
+def resume_harvest(checkpoint_id):
+    """Continue an interrupted harvest from its last completed page.
+
+    :param checkpoint_id: The id of the OaiHARVESTCHECKPOINT object.
     """
-    schedule_harvest(
-        output, workflow, directory, name,
-        list_records(metadata_prefix, from_date, until_date, url, name, setSpec)
-    )
+    from ..models import OaiHARVESTCHECKPOINT
+    checkpoint = OaiHARVESTCHECKPOINT.query.get(checkpoint_id)
+    if checkpoint is None:
+        raise CheckpointNotFound("No checkpoint with id {0}.".format(
+            checkpoint_id))
+    if not checkpoint.claim(resume_harvest.request.id or uuid.uuid4().hex,
+                            cfg.get("OAIHARVESTER_CHECKPOINT_LEASE")):
+        raise CheckpointInUse("Checkpoint {0} is used by another run.".format(
+            checkpoint_id))
+    name = checkpoint.harvest.name if checkpoint.harvest else None
+    # The checkpoint does not tell if the harvest started from the
+    # watermark, so it is left where it is.
+    schedule_harvest(checkpoint.output, checkpoint.workflow,
+                     checkpoint.directory, name,
+                     checkpointed_records(checkpoint),
+                     checkpoint=checkpoint, ledger=get_ledger(name))
+
 
+@celery.task
+def harvest_sources(names=None, output='dir', workflow=None,
+                    directory='records_harvested', concurrency=None):
+    """Harvest several OaiHARVEST sources concurrently from a single process.
+
+    Every source is harvested from its last run on its own thread and sent
+    to its own output, files going to a subdirectory named after the
+    source. The number of sources harvested at once on the same host is
+    limited by OAIHARVESTER_MAX_SOURCES_PER_HOST; the requests of each of
+    them are limited separately, by the endpoint concurrency.
 
-def schedule_harvest(output, workflow, directory, name, records):
+    :param names: The names of the OaiHARVEST objects (defaults to all).
+    :param output: The type of the output (stdout, workflow, dir/directory,
+                   ingest).
+    :param workflow: The workflow that should process the output.
+    :param directory: The directory that we want to send the harvesting results.
+    :param concurrency: The number of sources harvested at the same time
+                        (defaults to OAIHARVESTER_MAX_CONCURRENT_SOURCES).
+    :return: A dictionary of the sources that failed with their error.
+    """
+    from ..models import OaiHARVEST
+
+    if not names:
+        names = [source.name for source in OaiHARVEST.query.all()]
+    if concurrency is None:
+        concurrency = cfg.get("OAIHARVESTER_MAX_CONCURRENT_SOURCES", 1)
+
+    app = current_app._get_current_object()
+
+    def harvest_source(name):
+        with app.app_context():
+            try:
+                source = get_oaiharvest_object(name)
+                with get_host_semaphore(source.baseurl):
+                    list_records_from_dates(None, None, None, None, name,
+                                            None, output, workflow,
+                                            os.path.join(directory, name))
+            except Exception as e:
+                app.logger.exception("Harvesting {0} failed.".format(name))
+                return name, repr(e)
+        return name, None
+
+    pool = ThreadPool(max(min(concurrency, len(names)), 1))
+    try:
+        results = pool.map(harvest_source, names)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = dict((name, error) for name, error in results if error)
+    if failures:
+        current_app.logger.warning("{0} of {1} sources failed: {2}".format(
+            len(failures), len(names), ", ".join(sorted(failures))))
+    return failures
+
+
+def get_ledger(name, force=False):
+    """Return the ledger of a named source, with OAIHARVESTER_LEDGER.
+
+    :param name: The name of the OaiHARVEST object (optional).
+    :param force: Pass on every record, still remembering them.
+    :return: A RecordLedger, or None.
+    """
+    if name and cfg.get("OAIHARVESTER_LEDGER"):
+        return RecordLedger(get_oaiharvest_object(name).id, force=force)
+    return None
+
+
+def get_high_water_mark(name, sets=None):
+    """Return the tracking of the watermarks of a named source.
+
+    :param name: The name of the OaiHARVEST object (optional).
+    :param sets: The sets harvested (None for the whole source).
+    :return: A HighWaterMark with OAIHARVESTER_WATERMARKS, or None.
+    """
+    if name and cfg.get("OAIHARVESTER_WATERMARKS"):
+        return HighWaterMark(get_oaiharvest_object(name).id, sets)
+    return None
+
+
+def schedule_harvest(output, workflow, directory, name, records,
+                     checkpoint=None, ledger=None, watermark=None):
     """Select the output method, depending on the provided parameters.
 
     Default is stdout.
 
-    :param output: The type of the output (stdout, workflow, dir/directory).
+    :param output: The type of the output (stdout, workflow, dir/directory,
+                   ingest).
     :param workflow: The workflow that should process the output.
     :param directory: The directory that we want to send the harvesting results.
     :param name: The name of the OaiHARVEST object.
     :param records: An iterator of harvested records.
+    :param checkpoint: The OaiHARVESTCHECKPOINT object of the harvest (optional).
+    :param ledger: The RecordLedger skipping the records which did not
+                   change since their last harvest (optional).
+    :param watermark: The HighWaterMark to move to the latest datestamp
+                      received, once the output holds every record
+                      (optional).
     """
+    if watermark is not None:
+        records = watermark.track(records)
+
+    # The outputs register their flush callbacks with it.
+    pages = checkpoint
+    if ledger is not None:
+        if checkpoint is None:
+            # Lets the ledger commit its entries batch by batch.
+            pages = OutputFlush()
+            records = ledger.filter(records, output=pages)
+        else:
+            records = ledger.filter(records, checkpoint=checkpoint)
+
     if output == 'stdout':
+        if pages is not None:
+            pages.flush_callbacks.append(sys.stdout.flush)
         total = print_to_stdout(records)
         print_total_records(total)
     elif output == 'dir' or output == 'directory':
-        files_created, total = write_to_dir(records, directory)
+        files_created, total = write_to_dir(records, directory,
+                                            checkpoint=pages)
         print_files_created(files_created)
         print_total_records(total)
     elif output == 'workflow':
         workflow_name = get_workflow_name(workflow, name)
-        for record in records:
-            start_delayed(workflow_name, [record.raw])
+        send_to_workflow(records, workflow_name, checkpoint=pages)
+    elif output == 'ingest':
+        def on_rejected(keys):
+            if ledger is not None:
+                ledger.discard(identifier for identifier, dummy in keys)
+            if watermark is not None:
+                watermark.hold_back(datestamp for dummy, datestamp in keys)
+
+        created, failed, skipped = ingest_records(records, checkpoint=pages,
+                                                  on_rejected=on_rejected)
+        print_total_records(created)
+        if failed:
+            current_app.logger.warning(
+                "{0} records could not be created.".format(len(failed)))
+        if skipped:
+            current_app.logger.warning(
+                "{0} records in an unsupported format skipped, first: "
+                "{1}.".format(len(skipped), skipped[0][0]))
     else:
         raise WrongOutputIdentifier('Output type not recognized.')
+
+    if ledger is not None:
+        ledger.commit()
+        if ledger.skipped:
+            current_app.logger.info(
+                "{0} unchanged records skipped.".format(ledger.skipped))
+    if watermark is not None:
+        # Only now that the output holds every record of the harvest.
+        watermark.commit()
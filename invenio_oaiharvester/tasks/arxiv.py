@@ -21,21 +21,564 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import multiprocessing
 import os
 import re
+import shutil
+import signal
+import tarfile
+import tempfile
+import threading
+import time
 
 from functools import wraps
 
+import six
+
 from invenio.base.globals import cfg
 
 
 REGEXP_AUTHLIST = re.compile(
     "<collaborationauthorlist.*?>.*?</collaborationauthorlist>", re.DOTALL)
+AUTHLIST_MARKER = b"<collaborationauthorlist"
 REGEXP_REFS = re.compile(
     "<record.*?>.*?<controlfield .*?>.*?</controlfield>(.*?)</record>",
     re.DOTALL)
 
 
+ARXIV_FILE_KINDS = ('pdf', 'tarball')
+
+REGEXP_ARXIV_ID = re.compile(
+    r"(\d{4}\.\d{4,5}|[a-z-]+(?:\.[A-Z]{2})?/\d{7})(v\d+)?$")
+
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+
+
+def get_arxiv_id(data):
+    """Return the arXiv identifier of a record.
+
+    :param data: The record as JSON.
+    :return: The first value at OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP that is
+             an arXiv identifier, or None.
+    """
+    path = cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP').split('.')
+    values = [data]
+    for key in path:
+        found = []
+        for value in values:
+            value = value.get(key) if hasattr(value, 'get') else None
+            if isinstance(value, (list, tuple)):
+                found.extend(value)
+            elif value is not None:
+                found.append(value)
+        values = found
+    for value in values:
+        if isinstance(value, six.string_types) and \
+                REGEXP_ARXIV_ID.search(value.strip()):
+            return value
+    return None
+
+
+def get_object_arxiv_id(obj):
+    """Return the arXiv identifier of the current version of a record.
+
+    The version is resolved once per workflow object, and kept in its
+    extra data for the following tasks.
+
+    :param obj: The workflow object of the record.
+    :return: The versioned identifier, else the identifier of the record,
+             or None.
+    """
+    if "_result" not in obj.extra_data:
+        obj.extra_data["_result"] = {}
+    result = obj.extra_data["_result"]
+    if "arxiv_id" not in result:
+        arxiv_id = get_arxiv_id(obj.data)
+        if arxiv_id:
+            arxiv_id = get_arxiv_version(arxiv_id) or arxiv_id
+        result["arxiv_id"] = arxiv_id
+    return result["arxiv_id"]
+
+
+def get_arxiv_file(arxiv_id, kind, directory, resolve=True):
+    """Return the path of a file of an arXiv record, downloading it if needed.
+
+    The files are kept in OAIHARVESTER_ARXIV_CACHE_DIR under their versioned
+    identifier, so that every task and every run working on the same
+    version share a single download. Unversioned identifiers, as harvested,
+    are first resolved to their current version with the arXiv API. The
+    files are linked (or copied) out of the cache into ``directory``, so
+    that evicting them does not remove the files workflow objects still
+    refer to. The files of identifiers which cannot be resolved are
+    downloaded without the cache.
+
+    :param arxiv_id: The arXiv identifier of the record.
+    :param kind: The kind of file, 'pdf' or 'tarball'.
+    :param directory: The directory to put the file in.
+    :param resolve: Ask the arXiv API for the version of unversioned
+                    identifiers, see get_object_arxiv_id().
+    :return: The path of the file, or None if it could not be downloaded.
+    """
+    if not arxiv_id:
+        return None
+    _makedirs(directory)
+    versioned_id = get_arxiv_version(arxiv_id, lookup=resolve)
+    if versioned_id is None:
+        return _download_arxiv_file(arxiv_id, kind, directory)
+
+    cached = get_cached_arxiv_file(versioned_id, kind)
+    if cached is None:
+        return None
+    path = os.path.join(directory, os.path.basename(cached))
+    if not os.path.exists(path):
+        try:
+            os.link(cached, path)
+        except OSError:
+            # Not on the same filesystem.
+            shutil.copy2(cached, path)
+    return path
+
+
+def get_arxiv_version(arxiv_id, lookup=True):
+    """Return the identifier of the current version of an arXiv record.
+
+    :param arxiv_id: The arXiv identifier of the record, as harvested
+                     (e.g. ``oai:arXiv.org:1507.03011``).
+    :param lookup: Ask the arXiv API for the version of an unversioned
+                   identifier.
+    :return: The versioned identifier (e.g. ``1507.03011v2``), or None if
+             it cannot be resolved.
+    """
+    from lxml import etree
+    from requests import RequestException
+
+    from ..client import get_session
+
+    if not isinstance(arxiv_id, six.string_types):
+        return None
+    match = REGEXP_ARXIV_ID.search(arxiv_id.strip())
+    if match is None:
+        return None
+    if match.group(2):
+        return match.group(0)
+    if not lookup:
+        return None
+
+    url = cfg['OAIHARVESTER_ARXIV_API_URL']
+    try:
+        response = get_session(url).get(
+            url, params={'id_list': match.group(1), 'max_results': 1},
+            timeout=cfg.get('OAIHARVESTER_ARXIV_API_TIMEOUT'))
+        response.raise_for_status()
+        feed = etree.fromstring(response.content)
+    except (RequestException, etree.XMLSyntaxError):
+        return None
+    for entry_id in feed.iterfind(
+            '{0}entry/{0}id'.format(ATOM_NAMESPACE)):
+        version = REGEXP_ARXIV_ID.search((entry_id.text or '').strip())
+        if version and version.group(1) == match.group(1) and \
+                version.group(2):
+            return version.group(0)
+    return None
+
+
+def get_cached_arxiv_file(arxiv_id, kind):
+    """Return the path of a file of an arXiv record in the cache.
+
+    Downloads the file into the cache if needed.
+
+    :param arxiv_id: The versioned arXiv identifier of the record.
+    :param kind: The kind of file, 'pdf' or 'tarball'.
+    :return: The path of the file, or None if it could not be downloaded.
+    """
+    cache_dir = cfg['OAIHARVESTER_ARXIV_CACHE_DIR']
+    key = re.sub(r'[^\w.-]', '_', arxiv_id)
+    entry = os.path.join(cache_dir, kind, key)
+
+    cached = _get_cached_file(entry)
+    if cached:
+        # Mark the entry as recently used.
+        os.utime(entry, None)
+        return cached
+
+    _makedirs(os.path.join(cache_dir, kind))
+    # Downloads are kept out of the cache until complete.
+    download_root = cache_dir.rstrip(os.sep) + '.download'
+    _makedirs(download_root)
+    download_dir = tempfile.mkdtemp(prefix=key + '_', dir=download_root)
+    try:
+        path = _download_arxiv_file(arxiv_id, kind, download_dir)
+        if path is None:
+            return None
+        try:
+            os.rename(download_dir, entry)
+        except OSError:
+            # Another worker stored the same file in the meantime.
+            cached = _get_cached_file(entry)
+            if not cached:
+                raise
+            return cached
+        download_dir = None
+    finally:
+        if download_dir is not None:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    evict_arxiv_cache(cache_dir, keep=entry)
+    return os.path.join(entry, os.path.basename(path))
+
+
+def _download_arxiv_file(arxiv_id, kind, directory):
+    """Download a file of an arXiv record into a directory."""
+    from invenio.utils.plotextractor.api import (
+        get_pdf_from_arxiv,
+        get_tarball_from_arxiv
+    )
+
+    download = {
+        'pdf': get_pdf_from_arxiv,
+        'tarball': get_tarball_from_arxiv,
+    }[kind]
+    path = download(arxiv_id, directory)
+    if not path or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _makedirs(directory):
+    """Create a directory, unless it exists."""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def get_workflow_storage_dir(eng):
+    """Return the directory where the files of a workflow run are kept.
+
+    :param eng: BibWorkflowEngine processing the objects.
+    """
+    return os.path.join(
+        cfg.get('OAIHARVESTER_STORAGEDIR', cfg.get('CFG_TMPSHAREDDIR')),
+        str(eng.uuid)
+    )
+
+
+def _get_cached_file(entry):
+    """Return the downloaded file of a cache entry, if any."""
+    if not os.path.isdir(entry):
+        return None
+    for filename in sorted(os.listdir(entry)):
+        path = os.path.join(entry, filename)
+        if os.path.isfile(path):
+            return path
+
+
+def evict_arxiv_cache(cache_dir, keep=None):
+    """Remove the least recently used files until the cache fits its size.
+
+    :param cache_dir: The directory of the cache.
+    :param keep: An entry that must not be removed.
+    """
+    max_size = cfg.get('OAIHARVESTER_ARXIV_CACHE_MAX_SIZE')
+    if max_size is None:
+        return
+
+    entries = []
+    total = 0
+    for kind in ARXIV_FILE_KINDS:
+        kind_dir = os.path.join(cache_dir, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for key in os.listdir(kind_dir):
+            entry = os.path.join(kind_dir, key)
+            size = 0
+            for dirpath, dummy, filenames in os.walk(entry):
+                for filename in filenames:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+    for dummy, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def find_authorlist_in_tarball(tarball, chunk_size=64 * 1024):
+    """Return the first XML member of a tarball holding an author list.
+
+    The members are streamed from the tarball, without extracting it, and
+    each XML-like member is searched chunk by chunk for the
+    ``<collaborationauthorlist`` tag.
+
+    :param tarball: The path of the tarball.
+    :param chunk_size: The number of bytes read from a member at once.
+    :return: The content of the member, or None if there is none.
+    :raises tarfile.ReadError: if the file is not a tarball.
+    """
+    overlap = len(AUTHLIST_MARKER) - 1
+    with tarfile.open(tarball, "r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            fd = archive.extractfile(member)
+            chunks = []
+            tail = b""
+            while True:
+                chunk = fd.read(chunk_size)
+                if not chunk:
+                    break
+                if not chunks and not member.name.lower().endswith(".xml") \
+                        and not chunk.lstrip().startswith(b"<?xml"):
+                    break
+                chunks.append(chunk)
+                window = tail + chunk
+                if AUTHLIST_MARKER in window:
+                    chunks.append(fd.read())
+                    return b"".join(chunks)
+                tail = window[-overlap:]
+    return None
+
+
+_extraction_pool = None
+_pending_extractions = {}
+_extraction_lock = threading.Lock()
+
+EXTRACTION_RESULT_TTL = 3600
+"""Seconds a completed extraction is kept for the object waiting for it."""
+
+
+def _init_extraction_process(memory_limit):
+    """Set up a process of the extraction pool."""
+    from invenio.base.factory import create_app
+
+    create_app().app_context().push()
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _extract_references(pdf):
+    """Return the references of a PDF as MARCXML."""
+    from invenio.legacy.refextract.api import extract_references_from_file_xml
+    return extract_references_from_file_xml(pdf)
+
+
+def _extract_plots(tarball):
+    """Return the plots of a tarball as MARCXML."""
+    from invenio.utils.plotextractor.api import get_marcxml_plots_from_tarball
+    return get_marcxml_plots_from_tarball(tarball)
+
+
+_EXTRACTORS = {
+    'references': _extract_references,
+    'plots': _extract_plots,
+}
+
+
+def _run_extraction(kind, path, timeout):
+    """Run an extraction in a process of the pool, aborting it if too slow."""
+    from invenio.utils.shell import Timeout
+
+    def _on_alarm(signum, frame):
+        raise Timeout()
+
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.alarm(timeout or 0)
+    try:
+        return _EXTRACTORS[kind](path)
+    finally:
+        signal.alarm(0)
+
+
+def get_extraction_pool():
+    """Return the process pool running reference and plot extraction."""
+    global _extraction_pool
+    with _extraction_lock:
+        if _extraction_pool is None:
+            _extraction_pool = multiprocessing.Pool(
+                processes=cfg['OAIHARVESTER_EXTRACTION_PROCESSES'],
+                initializer=_init_extraction_process,
+                initargs=(cfg.get('OAIHARVESTER_EXTRACTION_MEMORY_LIMIT'),),
+                maxtasksperchild=cfg.get(
+                    'OAIHARVESTER_EXTRACTION_MAX_TASKS_PER_CHILD')
+            )
+        return _extraction_pool
+
+
+def reset_extraction_pool():
+    """Terminate the extraction pool and all its pending extractions."""
+    global _extraction_pool
+    with _extraction_lock:
+        pool, _extraction_pool = _extraction_pool, None
+        _pending_extractions.clear()
+    if pool is not None:
+        pool.terminate()
+
+
+def _retire_extraction_pool(pool):
+    """Replace a pool with a stuck process, once its other jobs are done.
+
+    New extractions go to a new pool at once. The old pool is terminated
+    in the background, after the extractions other objects are waiting for
+    have completed or timed out.
+    """
+    global _extraction_pool
+    with _extraction_lock:
+        if _extraction_pool is pool:
+            _extraction_pool = None
+        pending = [entry[1] for entry in _pending_extractions.values()
+                   if entry[0] is pool]
+    pool.close()
+    timeout = cfg.get('OAIHARVESTER_EXTRACTION_TIMEOUT')
+
+    def terminate_when_done():
+        for result in pending:
+            result.wait(timeout + 30 if timeout else None)
+        pool.terminate()
+
+    thread = threading.Thread(target=terminate_when_done)
+    thread.daemon = True
+    thread.start()
+
+
+def _prune_extractions():
+    """Forget the results nobody claimed in time.
+
+    Must be called with ``_extraction_lock`` held.
+    """
+    now = time.time()
+    timeout = cfg.get('OAIHARVESTER_EXTRACTION_TIMEOUT') or 0
+    for key, entry in list(_pending_extractions.items()):
+        pool, result, since = entry
+        if result.ready():
+            if pool is not None:
+                # From now on, count the time since the result is ready.
+                entry[0], entry[2] = None, now
+            elif now - since > EXTRACTION_RESULT_TTL:
+                del _pending_extractions[key]
+        elif timeout and now - since > timeout + 60:
+            # Lost with a terminated pool.
+            del _pending_extractions[key]
+
+
+def submit_extraction(kind, path):
+    """Start an extraction in the pool, unless it is already running.
+
+    :param kind: The kind of extraction, 'references' or 'plots'.
+    :param path: The path of the PDF or the tarball to extract from.
+    :return: A tuple with the pool the extraction was started in (None once
+        it is done) and its pending result.
+    """
+    pool = get_extraction_pool()
+    with _extraction_lock:
+        _prune_extractions()
+        entry = _pending_extractions.get((kind, path))
+        if entry is None:
+            result = pool.apply_async(
+                _run_extraction,
+                (kind, path, cfg.get('OAIHARVESTER_EXTRACTION_TIMEOUT'))
+            )
+            entry = [pool, result, time.time()]
+            _pending_extractions[(kind, path)] = entry
+        return entry[0], entry[1]
+
+
+def run_extraction(kind, path):
+    """Return the result of an extraction, running it in the pool.
+
+    Runs inline when OAIHARVESTER_EXTRACTION_PROCESSES is 0.
+
+    :param kind: The kind of extraction, 'references' or 'plots'.
+    :param path: The path of the PDF or the tarball to extract from.
+    :raises invenio.utils.shell.Timeout: if the extraction took too long.
+    """
+    from invenio.utils.shell import Timeout
+
+    if not cfg.get('OAIHARVESTER_EXTRACTION_PROCESSES'):
+        return _EXTRACTORS[kind](path)
+
+    timeout = cfg.get('OAIHARVESTER_EXTRACTION_TIMEOUT')
+    pool, pending = submit_extraction(kind, path)
+    try:
+        # Leave the process some time to abort by itself.
+        return pending.get(timeout + 30 if timeout else None)
+    except multiprocessing.TimeoutError:
+        # The process is stuck outside of Python, replace the pool.
+        with _extraction_lock:
+            _pending_extractions.pop((kind, path), None)
+        if pool is not None:
+            _retire_extraction_pool(pool)
+        raise Timeout()
+    finally:
+        with _extraction_lock:
+            entry = _pending_extractions.get((kind, path))
+            if entry is not None and entry[1] is pending:
+                del _pending_extractions[(kind, path)]
+
+
+def prefetch_extractions(objects, eng, kinds=('references', 'plots')):
+    """Start the extractions of several records at once.
+
+    The later arxiv_refextract and arxiv_plot_extract steps of each object
+    then only wait for the results, so that the extraction of the following
+    records runs while one record is processed. Without extraction
+    processes, only the files are downloaded.
+
+    :param objects: The workflow objects of the records.
+    :param eng: BibWorkflowEngine processing the objects.
+    :param kinds: The kinds of extraction to start.
+    """
+    files = {'references': 'pdf', 'plots': 'tarball'}
+    for obj in objects:
+        if "_result" not in obj.extra_data:
+            obj.extra_data["_result"] = {}
+        for kind in kinds:
+            name = files[kind]
+            path = obj.extra_data["_result"].get(name)
+            if not path:
+                path = get_arxiv_file(
+                    get_object_arxiv_id(obj),
+                    name, get_workflow_storage_dir(eng),
+                    resolve=False
+                )
+                obj.extra_data["_result"][name] = path
+            if path and cfg.get('OAIHARVESTER_EXTRACTION_PROCESSES'):
+                submit_extraction(kind, path)
+
+
+def arxiv_prefetch_extractions(kinds=('references', 'plots')):
+    """Start the extractions of all the records of the workflow run.
+
+    To be placed before arxiv_refextract and arxiv_plot_extract, once the
+    records are converted to JSON: the first object starts the extractions
+    of the whole run (see :func:`prefetch_extractions`).
+
+    :param kinds: The kinds of extraction to start.
+    """
+    @wraps(arxiv_prefetch_extractions)
+    def _arxiv_prefetch_extractions(obj, eng):
+        from .records import get_run_objects
+
+        # Records which are not converted yet are left to their own turn.
+        objects = [other for other in get_run_objects(obj, eng)
+                   if hasattr(other.data, 'get')]
+        prefetch_extractions(objects, eng, kinds)
+    return _arxiv_prefetch_extractions
+
+
+def _read_files(paths):
+    """Yield the content of each file, reading one file at a time."""
+    for path in paths:
+        with open(path, "r") as fd:
+            yield fd.read()
+
+
 def _attach_files_to_obj(obj, new_ffts):
     """Given a SmartJSON representation, add any missing fft entries to obj."""
     if not new_ffts or new_ffts.get("fft") is None:
@@ -62,19 +605,14 @@ def arxiv_fulltext_download(doctype='arXiv'):
         :param obj: Bibworkflow Object to process
         :param eng: BibWorkflowEngine processing the object
         """
-        from invenio.utils.plotextractor.api import get_pdf_from_arxiv
-
-        if "result" not in obj.extra_data:
+        if "_result" not in obj.extra_data:
             obj.extra_data["_result"] = {}
 
         if "pdf" not in obj.extra_data["_result"]:
-            extract_path = os.path.join(
-                cfg.get('OAIHARVESTER_STORAGEDIR', cfg.get('CFG_TMPSHAREDDIR')),
-                str(eng.uuid)
-            )
-            pdf = get_pdf_from_arxiv(
-                obj.data.get(cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP')),
-                extract_path
+            pdf = get_arxiv_file(
+                get_object_arxiv_id(obj),
+                'pdf', get_workflow_storage_dir(eng),
+                resolve=False
             )
 
             if pdf:
@@ -111,10 +649,6 @@ def arxiv_fulltext_download(doctype='arXiv'):
 
 def arxiv_plot_extract(obj, eng):
     """Extract plots from an arXiv archive."""
-    from invenio.utils.plotextractor.api import (
-        get_tarball_from_arxiv,
-        get_marcxml_plots_from_tarball
-    )
     from invenio.modules.workflows.utils import convert_marcxml_to_bibfield
     from invenio.utils.shell import Timeout
 
@@ -122,13 +656,10 @@ def arxiv_plot_extract(obj, eng):
         obj.extra_data["_result"] = {}
 
     if "tarball" not in obj.extra_data["_result"]:
-        extract_path = os.path.join(
-            cfg.get('OAIHARVESTER_STORAGEDIR', cfg.get('CFG_TMPSHAREDDIR')),
-            str(eng.uuid)
-        )
-        tarball = get_tarball_from_arxiv(
-            obj.data.get(cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP')),
-            extract_path
+        tarball = get_arxiv_file(
+            get_object_arxiv_id(obj),
+            'tarball', get_workflow_storage_dir(eng),
+            resolve=False
         )
         if tarball is None:
             obj.log.error("No tarball found")
@@ -137,12 +668,17 @@ def arxiv_plot_extract(obj, eng):
     else:
         tarball = obj.extra_data["_result"]["tarball"]
 
+    marcxml = None
     try:
-        marcxml = get_marcxml_plots_from_tarball(tarball)
+        marcxml = run_extraction('plots', tarball)
     except Timeout:
         eng.log.error(
             'Timeout during tarball extraction on {0}'.format(tarball)
         )
+    except MemoryError:
+        eng.log.error(
+            'Out of memory during tarball extraction on {0}'.format(tarball)
+        )
     if marcxml:
         # We store the path to the directory the tarball contents lives
         new_dict = convert_marcxml_to_bibfield(marcxml)
@@ -164,9 +700,8 @@ def arxiv_refextract(obj, eng):
     :param obj: Bibworkflow Object to process
     :param eng: BibWorkflowEngine processing the object
     """
-    from invenio.legacy.refextract.api import extract_references_from_file_xml
-    from invenio.utils.plotextractor.api import get_pdf_from_arxiv
     from invenio.modules.workflows.utils import convert_marcxml_to_bibfield
+    from invenio.utils.shell import Timeout
 
     if "_result" not in obj.extra_data:
         obj.extra_data["_result"] = {}
@@ -177,20 +712,26 @@ def arxiv_refextract(obj, eng):
         pdf = None
 
     if not pdf:
-        extract_path = os.path.join(
-            cfg.get('OAIHARVESTER_STORAGEDIR', cfg.get('CFG_TMPSHAREDDIR')),
-            str(eng.uuid)
-        )
-        pdf = get_pdf_from_arxiv(
-            obj.data.get(cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP')),
-            extract_path
+        pdf = get_arxiv_file(
+            get_object_arxiv_id(obj),
+            'pdf', get_workflow_storage_dir(eng),
+            resolve=False
         )
         obj.extra_data["_result"]["pdf"] = pdf
 
     if pdf and os.path.isfile(pdf):
-        references_xml = extract_references_from_file_xml(
-            obj.extra_data["_result"]["pdf"]
-        )
+        try:
+            references_xml = run_extraction('references', pdf)
+        except Timeout:
+            eng.log.error(
+                'Timeout during reference extraction on {0}'.format(pdf)
+            )
+            return
+        except MemoryError:
+            eng.log.error(
+                'Out of memory during reference extraction on {0}'.format(pdf)
+            )
+            return
         if references_xml:
             updated_xml = '<?xml version="1.0" encoding="UTF-8"?>\n' \
                           '<collection>\n' + references_xml + \
@@ -221,65 +762,65 @@ def arxiv_author_list(stylesheet="authorlist2marcxml.xsl"):
     @wraps(arxiv_author_list)
     def _author_list(obj, eng):
         from invenio.legacy.bibrecord import create_records, record_xml_output
-        from invenio.legacy.bibconvert.xslt_engine import convert
-        from invenio.utils.plotextractor.api import get_tarball_from_arxiv
         from invenio.utils.plotextractor.cli import get_defaults
         from invenio.modules.workflows.utils import convert_marcxml_to_bibfield
         from invenio.utils.plotextractor.converter import untar
         from invenio.utils.shell import Timeout
 
-        from ..utils import find_matching_files
+        from ..utils import find_matching_files, xslt_convert
 
-        identifiers = obj.data.get(cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP'), "")
         if "_result" not in obj.extra_data:
             obj.extra_data["_result"] = {}
         if "tarball" not in obj.extra_data["_result"]:
-            extract_path = os.path.join(
-                cfg.get('OAIHARVESTER_STORAGEDIR', cfg.get('CFG_TMPSHAREDDIR')),
-                str(eng.uuid)
-            )
-            tarball = get_tarball_from_arxiv(
-                obj.data.get(cfg.get('OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP')),
-                extract_path
+            tarball = get_arxiv_file(
+                get_object_arxiv_id(obj),
+                'tarball', get_workflow_storage_dir(eng),
+                resolve=False
             )
             if tarball is None:
                 obj.log.error("No tarball found")
                 return
+            obj.extra_data["_result"]["tarball"] = tarball
         else:
             tarball = obj.extra_data["_result"]["tarball"]
 
         # FIXME
         tarball = str(tarball)
-        sub_dir, dummy = get_defaults(tarball,
-                                      cfg['CFG_TMPDIR'], "")
-
         try:
-            untar(tarball, sub_dir)
-            obj.log.info("Extracted tarball to: {0}".format(sub_dir))
-        except Timeout:
-            eng.log.error('Timeout during tarball extraction on %s' % (
-                obj.extra_data["_result"]["tarball"]))
+            xml_contents = [find_authorlist_in_tarball(tarball)]
+        except tarfile.ReadError:
+            # Not a tarball, fall back to extracting the file.
+            sub_dir, dummy = get_defaults(tarball,
+                                          cfg['CFG_TMPDIR'], "")
+
+            try:
+                untar(tarball, sub_dir)
+                obj.log.info("Extracted tarball to: {0}".format(sub_dir))
+            except Timeout:
+                eng.log.error('Timeout during tarball extraction on %s' % (
+                    obj.extra_data["_result"]["tarball"]))
+
+            xml_files_list = find_matching_files(sub_dir, ["xml"])
 
-        xml_files_list = find_matching_files(sub_dir, ["xml"])
+            obj.log.info("Found xmlfiles: {0}".format(xml_files_list))
 
-        obj.log.info("Found xmlfiles: {0}".format(xml_files_list))
+            xml_contents = _read_files(xml_files_list)
 
         authors = ""
 
-        for xml_file in xml_files_list:
-            xml_file_fd = open(xml_file, "r")
-            xml_content = xml_file_fd.read()
-            xml_file_fd.close()
+        for xml_content in xml_contents:
+            if not xml_content:
+                continue
 
             match = REGEXP_AUTHLIST.findall(xml_content)
             if match:
                 obj.log.info("Found a match for author extraction")
-                authors = convert(xml_content, stylesheet)
+                authors = xslt_convert(xml_content, stylesheet)
                 authorlist_record = create_records(authors)
                 if len(authorlist_record) == 1:
                     if authorlist_record[0][0] is None:
                         eng.log.error("Error parsing authorlist record for id: %s" % (
-                            identifiers,))
+                            get_object_arxiv_id(obj),))
                     authorlist_record = authorlist_record[0][0]
 
                 author_xml = record_xml_output(authorlist_record)
@@ -21,21 +21,83 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import logging
 import StringIO
 from functools import wraps
 
 import six
 from werkzeug.utils import import_string
 
+logger = logging.getLogger(__name__)
 
-def convert_record_to_json(obj, eng):
-    """Convert one record from MARCXML to JSON."""
+
+_processors = {}
+
+
+def get_marcxml_processor():
+    """Return the processor converting MARCXML to JSON records.
+
+    The processor is resolved once per process.
+    """
     from invenio.base.globals import cfg
-    source = StringIO.StringIO(obj.data)
 
     processor = cfg["RECORD_PROCESSORS"]["marcxml"]
     if isinstance(processor, six.string_types):
-        processor = import_string(processor)
+        if processor not in _processors:
+            _processors[processor] = import_string(processor)
+        processor = _processors[processor]
+    return processor
+
+
+def get_run_objects(obj, eng):
+    """Return the objects of the workflow run, from the current one on.
+
+    The objects of a run go through the whole workflow one after the other:
+    when a batch step runs for an object, the following ones have not
+    reached it yet, and are handled by it at once.
+
+    :param obj: The workflow object being processed.
+    :param eng: BibWorkflowEngine processing the objects.
+    """
+    get_objects = getattr(eng, 'getObjects', None)
+    if get_objects is None:
+        return [obj]
+    objects = [other for dummy, other in get_objects()]
+    for position, other in enumerate(objects):
+        if other is obj:
+            return objects[position:]
+    return [obj]
+
+
+def convert_record(stylesheet="oaidc2marcxml.xsl"):
+    """Convert the record with a stylesheet, compiled once per process.
+
+    :param stylesheet: The name or the path of the stylesheet.
+    """
+    @wraps(convert_record)
+    def _convert_record(obj, eng):
+        from ..utils import xslt_convert
+
+        try:
+            obj.data = xslt_convert(obj.data, stylesheet)
+        except Exception as e:
+            msg = "Could not convert record: {0}".format(e)
+            obj.log.error(msg)
+            raise
+    return _convert_record
+
+
+def convert_record_to_json(obj, eng):
+    """Convert one record from MARCXML to JSON.
+
+    Records already converted by convert_records_to_json() are left as is.
+    """
+    if not isinstance(obj.data, six.string_types + (six.binary_type, )):
+        return
+
+    source = StringIO.StringIO(obj.data)
+
+    processor = get_marcxml_processor()
 
     for record in processor(source):
         # Should only be one.
@@ -44,10 +106,533 @@ def convert_record_to_json(obj, eng):
     source.close()
 
 
+def convert_records(stylesheet=None):
+    """Convert the records of the whole workflow run to JSON at once.
+
+    The XML records of the current object and of the following ones (see
+    get_run_objects()) are converted with the stylesheet, if any, and then
+    to JSON as a single collection. A following record which cannot be
+    converted is left as it is, to fail on its own turn. Follow this step
+    with convert_record_to_json, which converts one by one the records
+    left as MARCXML.
+
+    :param stylesheet: The name or the path of the stylesheet converting
+        the records to MARCXML (optional).
+    """
+    @wraps(convert_records)
+    def _convert_records(obj, eng):
+        from ..utils import xslt_convert
+
+        originals = []
+        for other in get_run_objects(obj, eng):
+            if not isinstance(other.data, six.string_types +
+                              (six.binary_type, )):
+                continue
+            original = other.data
+            if stylesheet:
+                try:
+                    other.data = xslt_convert(original, stylesheet)
+                except Exception as e:
+                    if other is obj:
+                        obj.log.error(
+                            "Could not convert record: {0}".format(e))
+                        raise
+                    continue
+            originals.append((other, original))
+
+        convert_records_to_json([other for other, dummy in originals])
+        for other, original in originals:
+            if other is not obj and \
+                    isinstance(other.data, six.string_types +
+                               (six.binary_type, )):
+                other.data = original
+    return _convert_records
+
+
+def convert_records_to_json(objects):
+    """Convert the MARCXML records of several workflow objects to JSON.
+
+    The records are passed to the processor as a single collection, and
+    each object gets the JSON of its record (objects without a record are
+    left as they are).
+
+    :param objects: workflow objects holding MARCXML records.
+    """
+    from lxml import etree
+
+    pending = []
+    for obj in objects:
+        if not isinstance(obj.data, six.string_types + (six.binary_type, )):
+            continue
+        data = obj.data
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        try:
+            root = etree.fromstring(data)
+        except etree.XMLSyntaxError:
+            continue
+        if etree.QName(root).localname == "record":
+            record = root
+        else:
+            record = next((child for child in root
+                           if isinstance(child.tag, six.string_types) and
+                           etree.QName(child).localname == "record"), None)
+        if record is not None:
+            pending.append((obj, etree.tostring(record)))
+
+    converted = marcxml_records_to_json([marcxml for obj, marcxml in pending])
+    for (obj, dummy), record in zip(pending, converted):
+        if record is not None:
+            obj.data = record
+
+
+def marcxml_records_to_json(marcxml_records):
+    """Convert MARCXML records to JSON, passing them as a single collection.
+
+    If the collection cannot be converted as a whole, the records are
+    converted one by one.
+
+    :param marcxml_records: MARCXML ``record`` elements as strings.
+    :return: The JSON of each record, or None for records which could not
+             be converted.
+    """
+    from ..utils import MARC_NAMESPACE
+
+    if not marcxml_records:
+        return []
+    processor = get_marcxml_processor()
+    collection = (b'<collection xmlns="' + MARC_NAMESPACE.encode('ascii') +
+                  b'">' + b''.join(marcxml_records) + b'</collection>')
+    try:
+        converted = list(processor(six.BytesIO(collection)))
+        if len(converted) == len(marcxml_records):
+            return converted
+    except Exception:
+        pass
+
+    converted = []
+    for marcxml in marcxml_records:
+        try:
+            converted.append(next(iter(processor(six.BytesIO(marcxml))),
+                                  None))
+        except Exception:
+            logger.exception("Converting a record to JSON failed.")
+            converted.append(None)
+    return converted
+
+
+OAI_DC_NAMESPACE = "http://www.openarchives.org/OAI/2.0/oai_dc/"
+DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
+OAI_NAMESPACE = "http://www.openarchives.org/OAI/2.0/"
+
+
+def oai_dc_to_json(xml):
+    """Return the record JSON of an OAI_DC record.
+
+    The Dublin Core elements are mapped in a single pass to the MARC21
+    based fields that the OAI_DC -> MARCXML -> JSON conversion yields.
+
+    :param xml: The OAI_DC record as a string or an element, either the
+                whole OAI-PMH record or only its ``oai_dc:dc`` element.
+    :return: The record as a dictionary.
+    """
+    from lxml import etree
+
+    if isinstance(xml, six.string_types + (six.binary_type, )):
+        if isinstance(xml, six.text_type):
+            xml = xml.encode("utf-8")
+        xml = etree.fromstring(xml)
+
+    values = {}
+    dc = xml if xml.tag == "{%s}dc" % OAI_DC_NAMESPACE else \
+        xml.find(".//{%s}dc" % OAI_DC_NAMESPACE)
+    for element in (dc if dc is not None else []):
+        if not isinstance(element.tag, six.string_types) or \
+                not element.tag.startswith("{%s}" % DC_NAMESPACE):
+            continue
+        text = (element.text or "").strip()
+        if text:
+            name = element.tag[len(DC_NAMESPACE) + 2:]
+            values.setdefault(name, []).append(text)
+
+    record = {}
+    identifiers = [identifier.text.strip() for identifier in
+                   xml.findall(".//{%s}header/{%s}identifier" % (
+                       OAI_NAMESPACE, OAI_NAMESPACE))
+                   if identifier.text]
+    urls = []
+    for identifier in values.get("identifier", []):
+        if identifier.startswith(("http://", "https://")):
+            urls.append(identifier)
+        else:
+            identifiers.append(identifier)
+
+    if values.get("title"):
+        record["title_statement"] = [{"title": values["title"][0]}]
+    creators = values.get("creator", []) + values.get("contributor", [])
+    if creators:
+        record["main_entry_personal_name"] = [{"personal_name": creators[0]}]
+    if creators[1:]:
+        record["added_entry_personal_name"] = [
+            {"personal_name": creator} for creator in creators[1:]]
+    if values.get("description"):
+        record["summary"] = [{"summary": [description]}
+                             for description in values["description"]]
+    if values.get("subject"):
+        record["subject_added_entry_topical_term"] = [{
+            "topical_term_or_geographic_name_entry_element": values["subject"]
+        }]
+    if values.get("publisher") or values.get("date"):
+        imprint = {}
+        if values.get("publisher"):
+            imprint["name_of_publisher_distributor"] = values["publisher"]
+        if values.get("date"):
+            imprint["date_of_publication_distribution"] = values["date"]
+        record["publication_distribution_imprint"] = [imprint]
+    if values.get("language"):
+        record["language_code"] = [{
+            "language_code_of_text_sound_track_or_separate_title":
+            values["language"]
+        }]
+    if identifiers:
+        record["system_control_number"] = [
+            {"value": identifier} for identifier in identifiers]
+    if urls:
+        record["electronic_location_and_access"] = [
+            {"uniform_resource_identifier": [url]} for url in urls]
+    return record
+
+
+def convert_oai_dc_to_json(obj, eng):
+    """Convert one record from OAI_DC to JSON, without going through MARCXML."""
+    obj.data = oai_dc_to_json(obj.data)
+
+
 def create_record(obj, eng):
     """Create record with Record API."""
     from invenio_records.api import create_record
-    create_record(obj.data)
+    record = create_record(obj.data)
+    index_record_identifiers([record])
+
+
+def bulk_create_records(records, batch_size=None):
+    """Create records with Record API, a batch per transaction.
+
+    When a batch fails, its records are created one by one, so that a bad
+    record does not prevent the others from being created.  Records whose
+    identifiers are already in the identifier index are skipped.
+
+    :param records: An iterator of records as JSON.
+    :param batch_size: The number of records per transaction
+                       (defaults to OAIHARVESTER_INGEST_BATCH_SIZE).
+    :return: A tuple with the number of records created and the list of
+             (record, exception) of those that failed.
+    """
+    from invenio.base.globals import cfg
+
+    if batch_size is None:
+        batch_size = cfg.get("OAIHARVESTER_INGEST_BATCH_SIZE", 500)
+
+    created = 0
+    failed = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            created += _create_batch(batch, failed)
+            batch = []
+    if batch:
+        created += _create_batch(batch, failed)
+    return created, failed
+
+
+def _create_batch(batch, failed):
+    """Create a batch of records, isolating the records which fail."""
+    batch = _skip_indexed_records(batch)
+    try:
+        created = _create_in_transaction(batch)
+    except Exception:
+        logger.warning("Creating a batch of %d records failed, "
+                       "creating them one by one.", len(batch))
+        created = []
+        for record in batch:
+            try:
+                created.extend(_create_in_transaction([record]))
+            except Exception as e:
+                logger.exception("Creating a record failed.")
+                failed.append((record, e))
+    index_record_identifiers(created)
+    return len(created)
+
+
+def _create_in_transaction(batch):
+    """Create records in a single transaction."""
+    from invenio.ext.sqlalchemy import db
+    from invenio_records.api import create_record
+
+    try:
+        with db.session.begin_nested():
+            created = [create_record(record) for record in batch]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return created
+
+
+def _skip_indexed_records(batch):
+    """Return the records of a batch which are not in the identifier index."""
+    from invenio.base.globals import cfg
+    from ..identifiers import get_identifier_index, get_identifier_key
+
+    index = get_identifier_index()
+    if index is None:
+        return batch
+    keys = cfg.get("OAIHARVESTER_IDENTIFIER_INDEX_KEYS") or \
+        [("control_number", "control_number")]
+    records_keys = [[get_identifier_key(field, val)
+                     for field, val in _get_match_values(record, keys)]
+                    for record in batch]
+    known = index.filter(key for record_keys in records_keys
+                         for key in record_keys)
+    if not known:
+        return batch
+    logger.info("Skipping %d records already ingested.", len(known))
+    return [record for record, record_keys in zip(batch, records_keys)
+            if not known.intersection(record_keys)]
+
+
+def index_record_identifiers(records):
+    """Add the identifiers of ingested records to the identifier index."""
+    from invenio.base.globals import cfg
+    from ..identifiers import get_identifier_index, get_identifier_key
+
+    index = get_identifier_index()
+    if index is None:
+        return
+    keys = cfg.get("OAIHARVESTER_IDENTIFIER_INDEX_KEYS") or \
+        [("control_number", "control_number")]
+    index.add(get_identifier_key(field, val)
+              for record in records if record is not None
+              for field, val in _get_match_values(record, keys))
+
+
+def rebuild_identifier_index(batch_size=1000):
+    """Add the identifiers of the records of the database to the index.
+
+    Once done, the identifiers missing from the index are no longer searched
+    for when matching records.
+
+    :param batch_size: number of records read at once.
+    :return: the number of records read, None without an index.
+    """
+    from invenio_records.models import RecordMetadata
+    from ..identifiers import get_identifier_index
+
+    index = get_identifier_index()
+    if index is None:
+        return None
+    count = _add_records_to_index(
+        index, RecordMetadata.query.order_by(RecordMetadata.id), batch_size)
+    index.mark_complete()
+    return count
+
+
+def sync_identifier_index(batch_size=1000):
+    """Return the complete identifier index, with the latest records added.
+
+    The identifiers of the records created since the last sync, whichever
+    way, are added first: the index only stays complete that way.
+
+    :param batch_size: number of records read at once.
+    :return: the index, or None without an index or before it is complete.
+    """
+    from ..identifiers import get_identifier_index
+
+    index = get_identifier_index()
+    if index is None or not index.complete:
+        return None
+
+    from invenio_records.models import RecordMetadata
+    last_id = int(index.get_setting("last_record_id") or 0)
+    _add_records_to_index(
+        index,
+        RecordMetadata.query.filter(RecordMetadata.id > last_id).order_by(
+            RecordMetadata.id),
+        batch_size)
+    return index
+
+
+def _add_records_to_index(index, query, batch_size):
+    """Add the identifiers of the records of a query, ordered by id."""
+    count = 0
+    last_id = None
+    batch = []
+    for metadata in query.yield_per(batch_size):
+        batch.append(metadata.json)
+        last_id = metadata.id
+        if len(batch) >= batch_size:
+            index_record_identifiers(batch)
+            index.set_setting("last_record_id", str(last_id))
+            count += len(batch)
+            batch = []
+    index_record_identifiers(batch)
+    count += len(batch)
+    if last_id is not None:
+        index.set_setting("last_record_id", str(last_id))
+    return count
+
+
+def _get_match_values(data, keys):
+    """Return the (search_field, value) pairs to match a record with."""
+    from invenio_records.api import Record
+
+    try:
+        record = Record(data.dumps())
+    except AttributeError:
+        record = Record(data)
+
+    for key, field in keys:
+        values = record[key] if key in record else None
+        if values:
+            if not isinstance(values, list):
+                values = [values]
+            for val in values:
+                yield field, val
+
+
+def _get_query_string(field, val):
+    """Return the query string matching a value of a field."""
+    if field:
+        return '{0}:"{1}"'.format(field, val)
+    return '"{0}"'.format(val)
+
+
+def _get_match_key(keys, collection):
+    """Return the key under which the match of a record is stored."""
+    return repr((keys, collection))
+
+
+def _find_matching_values(key, field, values, collection):
+    """Return the values of a field having a match in the database.
+
+    The values are looked up with a single OR query, and the matching ones
+    are read from the records it returns.
+    """
+    from invenio.modules.search.api import Query
+
+    recids = Query(" or ".join(_get_query_string(field, val)
+                               for val in values)).search(
+        collection=collection)
+    if len(recids) == 0:
+        return set()
+    if len(values) == 1:
+        return set(values)
+    values = set(values)
+    return set(val for record in _get_records_json(recids)
+               for dummy, val in _get_match_values(record, [(key, field)])
+               if val in values)
+
+
+def _get_records_json(recids):
+    """Return the JSON of the records with the given ids, in one query."""
+    from invenio_records.models import RecordMetadata
+
+    return [metadata.json for metadata in RecordMetadata.query.filter(
+        RecordMetadata.id.in_(list(recids)))]
+
+
+def batch_match_records(objects, keys_to_check=None, collection=None,
+                        batch_size=None):
+    """Match several records with the database at once.
+
+    Stores the result for each object, so that quick_match_record() with
+    the same arguments does not need to search again.
+
+    :param objects: workflow objects to match
+    :param keys_to_check: list of tuples [(record_key, search_field), ..]
+    :param collection: collection to search in. None by default.
+    :param batch_size: number of values in a single query.
+    :return: list of booleans, True if the object has matches.
+    """
+    from invenio.base.globals import cfg
+    from ..identifiers import get_identifier_key
+
+    keys = keys_to_check or [("control_number", "control_number")]
+    if batch_size is None:
+        batch_size = cfg.get("OAIHARVESTER_MATCH_BATCH_SIZE", 100)
+
+    objects_values = []
+    key_values = {}
+    for obj in objects:
+        values = []
+        for key, field in keys:
+            for dummy, val in _get_match_values(obj.data, [(key, field)]):
+                values.append((field, val))
+                key_values.setdefault((key, field), set()).add(val)
+        objects_values.append(values)
+
+    index = sync_identifier_index()
+    if index is not None:
+        # Only search for the values which may already be ingested.
+        known = index.filter(get_identifier_key(field, val)
+                             for (key, field), values
+                             in six.iteritems(key_values)
+                             for val in values)
+        key_values = dict(
+            ((key, field), set(val for val in values
+                               if get_identifier_key(field, val) in known))
+            for (key, field), values in six.iteritems(key_values)
+        )
+
+    matched = set()
+    for (key, field), values in six.iteritems(key_values):
+        values = sorted(values)
+        for start in range(0, len(values), batch_size):
+            matched.update(
+                (field, val) for val in _find_matching_values(
+                    key, field, values[start:start + batch_size], collection)
+            )
+
+    match_key = _get_match_key(keys, collection)
+    results = []
+    seen = set()
+    for obj, values in zip(objects, objects_values):
+        result = any(value in matched for value in values)
+        if not seen.intersection(values):
+            obj.extra_data.setdefault("_result", {}).setdefault(
+                "quick_match", {})[match_key] = result
+        # Otherwise an earlier object of the batch may create the record
+        # in the meantime, leave it to quick_match_record().
+        seen.update(values)
+        results.append(result)
+    return results
+
+
+def match_records(keys_to_check=None, collection=None):
+    """Match the records of the whole workflow run with the database at once.
+
+    Place it before quick_match_record() with the same arguments, which then
+    uses the stored results (see batch_match_records()). The records which
+    are not converted to JSON yet are left to quick_match_record().
+
+    :param keys_to_check: list of tuples [(record_key, search_field), ..]
+    :param collection: collection to search in. None by default.
+    """
+    @wraps(match_records)
+    def _match_records(obj, eng):
+        keys = keys_to_check or [("control_number", "control_number")]
+        match_key = _get_match_key(keys, collection)
+        objects = [
+            other for other in get_run_objects(obj, eng)
+            if not isinstance(other.data, six.string_types +
+                              (six.binary_type, )) and
+            match_key not in other.extra_data.get("_result", {}).get(
+                "quick_match", {})
+        ]
+        if objects:
+            batch_match_records(objects, keys, collection)
+    return _match_records
 
 
 def quick_match_record(keys_to_check=None, collection=None):
@@ -60,6 +645,11 @@ def quick_match_record(keys_to_check=None, collection=None):
     would make a search for record["control_number"] using field
     "control_number".
 
+    If the record was already matched by batch_match_records(), its result
+    is used instead.  Values missing from the identifier index
+    (OAIHARVESTER_IDENTIFIER_INDEX) are not searched for, once it is
+    complete (see sync_identifier_index()).
+
     :param keys_to_check: list of tuples [(record_key, search_field), ..]
     :param collection: collection to search in. None by default.
 
@@ -72,28 +662,22 @@ def quick_match_record(keys_to_check=None, collection=None):
             # At least try the recid
             keys = [("control_number", "control_number")]
 
-        from invenio_records.api import Record
-        from invenio.modules.search.api import Query
+        match_key = _get_match_key(keys, collection)
+        matches = obj.extra_data.get("_result", {}).get("quick_match", {})
+        if match_key in matches:
+            return matches[match_key]
 
-        try:
-            record = Record(obj.data.dumps())
-        except AttributeError:
-            record = Record(obj.data)
+        from invenio.modules.search.api import Query
+        from ..identifiers import get_identifier_key
 
-        for key, field in keys:
-            values = record[key] if key in record else None
-            if values:
-                if not isinstance(values, list):
-                    values = [values]
-                for val in values:
-                    if field:
-                        query_string = '{0}:"{1}"'.format(field, val)
-                    else:
-                        query_string = '"{0}"'.format(val)
-
-                    query = Query(query_string)
-                    result = query.search(collection=collection)
-                    if len(result) > 0:
-                        return True
+        index = sync_identifier_index()
+        for field, val in _get_match_values(obj.data, keys):
+            if index is not None and \
+                    get_identifier_key(field, val) not in index:
+                continue
+            query = Query(_get_query_string(field, val))
+            result = query.search(collection=collection)
+            if len(result) > 0:
+                return True
         return False
     return _quick_match_record
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Add table to checkpoint harvests."""
+
+from invenio.ext.sqlalchemy import db
+
+from invenio.modules.upgrader.api import op
+
+
+depends_on = ['oaiharvester_2015_07_14_innodb']
+
+
+def info():
+    """Return upgrade recipe information."""
+    return "Add oaiHARVESTCHECKPOINT table."
+
+
+def do_upgrade():
+    """Carry out the upgrade."""
+    op.create_table(
+        'oaiHARVESTCHECKPOINT',
+        db.Column('id', db.Integer(15, unsigned=True), nullable=False,
+                  autoincrement=True),
+        db.Column('id_oaiHARVEST', db.MediumInteger(9, unsigned=True),
+                  nullable=True),
+        db.Column('baseurl', db.String(255), nullable=False,
+                  server_default=''),
+        db.Column('metadataprefix', db.String(255), nullable=False,
+                  server_default='oai_dc'),
+        db.Column('setspec', db.String(255), nullable=True),
+        db.Column('from_date', db.String(20), nullable=True),
+        db.Column('until_date', db.String(20), nullable=True),
+        db.Column('output', db.String(20), nullable=False,
+                  server_default='stdout'),
+        db.Column('workflow', db.String(255), nullable=True),
+        db.Column('directory', db.String(255), nullable=True),
+        db.Column('resumption_token', db.Text, nullable=True),
+        db.Column('last_datestamp', db.String(20), nullable=True),
+        db.Column('records', db.Integer(15, unsigned=True), nullable=False),
+        db.Column('files', db.LargeBinary, nullable=False),
+        db.Column('finished', db.Boolean, nullable=False),
+        db.Column('created', db.DateTime, nullable=False),
+        db.Column('modified', db.DateTime, nullable=False),
+        db.ForeignKeyConstraint(['id_oaiHARVEST'], ['oaiHARVEST.id']),
+        db.PrimaryKeyConstraint('id'),
+        mysql_charset='utf8',
+        mysql_engine='InnoDB'
+    )
+
+
+def estimate():
+    """Estimate running time of upgrade in seconds (optional)."""
+    return 1
+
+
+def pre_upgrade():
+    """Pre-upgrade checks."""
+    pass
+
+
+def post_upgrade():
+    """Post-upgrade checks."""
+    pass
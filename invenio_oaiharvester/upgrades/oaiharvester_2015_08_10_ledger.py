@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Add table holding the last harvested version of each record."""
+
+from invenio.ext.sqlalchemy import db
+
+from invenio.modules.upgrader.api import op
+
+
+depends_on = ['oaiharvester_2015_08_03_checkpoints']
+
+
+def info():
+    """Return upgrade recipe information."""
+    return "Add oaiHARVESTLEDGER table."
+
+
+def do_upgrade():
+    """Carry out the upgrade."""
+    op.create_table(
+        'oaiHARVESTLEDGER',
+        db.Column('id_oaiHARVEST', db.MediumInteger(9, unsigned=True),
+                  nullable=False),
+        db.Column('identifier', db.String(255), nullable=False),
+        db.Column('datestamp', db.String(20), nullable=True),
+        db.Column('hash', db.String(40), nullable=True),
+        db.Column('modified', db.DateTime, nullable=False),
+        db.ForeignKeyConstraint(['id_oaiHARVEST'], ['oaiHARVEST.id']),
+        db.PrimaryKeyConstraint('id_oaiHARVEST', 'identifier'),
+        mysql_charset='utf8',
+        mysql_engine='InnoDB'
+    )
+
+
+def estimate():
+    """Estimate running time of upgrade in seconds (optional)."""
+    return 1
+
+
+def pre_upgrade():
+    """Pre-upgrade checks."""
+    pass
+
+
+def post_upgrade():
+    """Post-upgrade checks."""
+    pass
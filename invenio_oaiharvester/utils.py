@@ -21,35 +21,142 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import gzip
+import io
+import logging
+import mmap
 import os
 import re
 import sys
-from datetime import datetime
+import threading
+import time
+from copy import deepcopy
+from datetime import date, datetime, timedelta
 
+import six
+from flask import current_app
 from lxml import etree
 
 from invenio.base.globals import cfg
-from invenio.utils.shell import run_shell_command
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 REGEXP_OAI_ID = re.compile("<identifier.*?>(.*?)<\/identifier>", re.DOTALL)
+REGEXP_OAI_ID_BYTES = re.compile(b"<identifier.*?>(.*?)</identifier>", re.DOTALL)
+
+MAGIC_FILE_TYPES = (
+    (0, b"%PDF", "pdf document"),
+    (0, b"%!PS", "postscript document text"),
+    (0, b"\x1f\x8b", "gzip compressed data"),
+    (0, b"BZh", "bzip2 compressed data"),
+    (0, b"\xfd7zXZ\x00", "xz compressed data"),
+    (0, b"PK\x03\x04", "zip archive data"),
+    (0, b"\x89PNG", "png image data"),
+    (0, b"\xff\xd8\xff", "jpeg image data"),
+    (0, b"GIF8", "gif image data"),
+    (257, b"ustar", "posix tar archive"),
+)
+"""Signatures (offset, magic bytes, description) used to sniff file types."""
+
+REGEXP_XML_ROOT = re.compile(br"<[A-Za-z_][\w.:-]*[\s/>]")
+
+INDEX_SUFFIX = ".idx"
+
+OAI_DAY_GRANULARITY = "YYYY-MM-DD"
+OAI_SECONDS_GRANULARITY = "YYYY-MM-DDThh:mm:ssZ"
+
+MARC_NAMESPACE = "http://www.loc.gov/MARC21/slim"
 
+logger = logging.getLogger(__name__)
 
-def record_extraction_from_file(path, oai_namespace="http://www.openarchives.org/OAI/2.0/"):
+_xslt_cache = {}
+_xslt_cache_lock = threading.Lock()
+
+
+def record_extraction_from_file(path, oai_namespace="http://www.openarchives.org/OAI/2.0/",
+                                stream=False):
     """Given a harvested file return a list of every record incl. headers.
 
+    The file is parsed incrementally, see :func:`record_extraction_iterator`.
+
     :param path: is the path of the file harvested
     :type path: str
 
     :param oai_namespace: optionally provide the OAI-PMH namespace
     :type oai_namespace: str
 
-    :return: return a list of XML records as string
-    :rtype: str
+    :param stream: return a generator instead of a list
+    :type stream: bool
+
+    :return: return a list (or generator) of XML records as string
+    :rtype: list
     """
-    list_of_records = []
-    with open(path) as xml_file:
-        list_of_records = record_extraction_from_string(xml_file.read(), oai_namespace)
-    return list_of_records
+    records = record_extraction_iterator(path, oai_namespace)
+    if stream:
+        return records
+    return list(records)
+
+
+def record_extraction_iterator(source, oai_namespace="http://www.openarchives.org/OAI/2.0/"):
+    """Given a OAI-PMH XML source yield every record incl. headers.
+
+    The source is parsed with ``etree.iterparse`` and every record is
+    detached from the tree once it has been serialized, so memory usage
+    stays flat regardless of the size of the source.
+
+    :param source: path or file-like object of the OAI-PMH XML
+    :type source: str or file
+
+    :param oai_namespace: optionally provide the OAI-PMH namespace
+    :type oai_namespace: str
+
+    :return: generator of XML records as string
+    :rtype: generator
+    """
+    if oai_namespace:
+        nsmap = {
+            None: oai_namespace
+        }
+        namespace_prefix = "{{{0}}}".format(oai_namespace)
+    else:
+        nsmap = cfg.get("OAIHARVESTER_DEFAULT_NAMESPACE_MAP")
+        namespace_prefix = ""
+    header_tags = (
+        "{0}responseDate".format(namespace_prefix),
+        "{0}request".format(namespace_prefix),
+    )
+    record_tag = "{0}record".format(namespace_prefix)
+
+    headers = []
+    context = etree.iterparse(source, events=("end",),
+                              tag=header_tags + (record_tag,))
+    for dummy, element in context:
+        if element.tag in header_tags:
+            headers.append(deepcopy(element))
+            continue
+
+        wrapper = etree.Element("OAI-PMH", nsmap=nsmap)
+        for header in headers:
+            wrapper.append(deepcopy(header))
+        # Appending moves the record out of the parsed tree.
+        wrapper.append(element)
+        yield etree.tostring(wrapper)
+        wrapper.clear()
+    del context
 
 
 def record_extraction_from_string(xml_string, oai_namespace="http://www.openarchives.org/OAI/2.0/"):
@@ -113,28 +220,56 @@ def identifier_extraction_from_string(xml_string, oai_namespace="http://www.open
         return node.text
 
 
-def collect_identifiers(harvested_file_list):
+def collect_identifiers(harvested_file_list, processes=None):
     """Collect all OAI PMH identifiers from each file in the list.
 
     Then adds them to a list of identifiers per file.
 
+    Files are memory-mapped and scanned without being decoded; with more
+    than one process they are spread over a process pool.
+
     :param harvested_file_list: list of filepaths to harvested files
+    :param processes: number of processes scanning the files
+                      (defaults to OAIHARVESTER_COLLECT_PROCESSES)
 
     :return list of lists, containing each files' identifier list
     """
-    result = []
-    for harvested_file in harvested_file_list:
-        try:
-            fd_active = open(harvested_file)
-        except IOError as e:
-            raise e
-        data = fd_active.read()
-        fd_active.close()
-        result.append(REGEXP_OAI_ID.findall(data))
-    return result
-
-
-def find_matching_files(basedir, filetypes):
+    if processes is None:
+        processes = cfg.get("OAIHARVESTER_COLLECT_PROCESSES", 1)
+    if processes <= 1 or len(harvested_file_list) <= 1:
+        return [_collect_file_identifiers(harvested_file)
+                for harvested_file in harvested_file_list]
+
+    from multiprocessing import Pool
+    pool = Pool(min(processes, len(harvested_file_list)))
+    try:
+        return pool.map(_collect_file_identifiers, harvested_file_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _collect_file_identifiers(harvested_file):
+    """Return the OAI PMH identifiers found in a single file."""
+    if harvested_file.endswith('.gz'):
+        with gzip.open(harvested_file, 'rb') as f:
+            matches = REGEXP_OAI_ID_BYTES.findall(f.read())
+    elif harvested_file.endswith('.xz'):
+        with lzma.open(harvested_file, 'rb') as f:
+            matches = REGEXP_OAI_ID_BYTES.findall(f.read())
+    else:
+        with open(harvested_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                matches = REGEXP_OAI_ID_BYTES.findall(mapping)
+            finally:
+                mapping.close()
+    return [match.decode('utf-8') for match in matches]
+
+
+def find_matching_files(basedir, filetypes, parallel_threshold=100, threads=8):
     """Try to find all files matching given filetypes.
 
     By looking at all the files and filenames in the given directory,
@@ -146,24 +281,230 @@ def find_matching_files(basedir, filetypes):
     :param filetypes: list of filetypes, extensions
     :type filetypes: list
 
-    :return: exitcode and any error messages as: (exitcode, err_msg)
-    :rtype: tuple
+    :param parallel_threshold: number of files above which the file types
+                               are detected on a thread pool
+    :type parallel_threshold: int
+
+    :param threads: number of threads detecting the file types
+    :type threads: int
+
+    :return: list of full paths of the matching files
+    :rtype: list
     """
+    paths = list(_walk_files(basedir))
+    if len(paths) > parallel_threshold:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            descriptions = pool.map(sniff_file_type, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        descriptions = [sniff_file_type(path) for path in paths]
+
     files_list = []
-    for dirpath, dummy0, filenames in os.walk(basedir):
-        for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
-            dummy1, cmd_out, dummy2 = run_shell_command(
-                'file %s', (full_path,)
-            )
-            for filetype in filetypes:
-                if cmd_out.lower().find(filetype) > -1:
-                    files_list.append(full_path)
-                elif filename.split('.')[-1].lower() == filetype:
-                    files_list.append(full_path)
+    for full_path, description in zip(paths, descriptions):
+        extension = os.path.basename(full_path).split('.')[-1].lower()
+        for filetype in filetypes:
+            if description.find(filetype) > -1:
+                files_list.append(full_path)
+            elif extension == filetype:
+                files_list.append(full_path)
     return files_list
 
 
+def _walk_files(basedir):
+    """Yield the full path of every file under a directory."""
+    if scandir is None:
+        for dirpath, dummy, filenames in os.walk(basedir):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+        return
+
+    pending = [basedir]
+    while pending:
+        try:
+            entries = list(scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
+
+def sniff_file_type(path):
+    """Describe the type of a file from its first bytes, like ``file`` does.
+
+    :param path: full path of the file
+    :type path: string
+
+    :return: lower-case description, e.g. 'pdf document' or 'xml document text'
+    :rtype: string
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(512)
+    except IOError:
+        return "unreadable"
+    if not head:
+        return "empty"
+
+    if head.startswith(b"\xc5\xd0\xd3\xc6"):
+        return "dos eps binary file"
+    if head.startswith(b"%!PS") and b"EPSF" in head.split(b"\n", 1)[0]:
+        # Encapsulated PostScript, as plots are.
+        return "postscript document text, type eps"
+    for offset, magic, description in MAGIC_FILE_TYPES:
+        if head[offset:offset + len(magic)] == magic:
+            return description
+
+    if b"\x00" in head:
+        return "data"
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if text.startswith(b"<?xml"):
+        return "xml document text"
+    if text[:14].lower().startswith((b"<!doctype html", b"<html")):
+        return "html document text"
+    if REGEXP_XML_ROOT.match(text):
+        return "xml document text"
+    if text.startswith((b"\\document", b"\\begin", b"%")):
+        return "latex document text"
+    return "ascii text"
+
+
+def parse_oai_date(value):
+    """Return a datetime from an OAI-PMH date string or a date object.
+
+    :param value: date as 'YYYY-MM-DD', 'YYYY-MM-DDThh:mm:ssZ' or date object.
+    :return: datetime
+    """
+    from invenio_oaiharvester.errors import WrongDateFormat
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    for date_format in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            continue
+    raise WrongDateFormat("Unrecognized date: {0}".format(value))
+
+
+def format_oai_date(value, granularity=OAI_DAY_GRANULARITY):
+    """Format a datetime according to the granularity of an OAI-PMH endpoint.
+
+    :param value: datetime to format.
+    :param granularity: granularity announced by the endpoint in Identify.
+    :return: OAI-PMH date string
+    """
+    if granularity == OAI_SECONDS_GRANULARITY:
+        return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return value.strftime("%Y-%m-%d")
+
+
+def split_date_range(from_date, until_date, parts,
+                     granularity=OAI_DAY_GRANULARITY):
+    """Split a date range into consecutive, non-overlapping windows.
+
+    Both bounds are inclusive (as ``from`` and ``until`` in OAI-PMH), and no
+    window is smaller than the granularity of the endpoint, so fewer than
+    ``parts`` windows can be returned for short ranges.
+
+    :param from_date: lower bound of the range.
+    :param until_date: upper bound of the range.
+    :param parts: number of windows wanted.
+    :param granularity: granularity announced by the endpoint in Identify.
+    :return: list of (from, until) tuples of OAI-PMH date strings
+    """
+    from invenio_oaiharvester.errors import WrongDateCombination
+    start = parse_oai_date(from_date)
+    end = parse_oai_date(until_date)
+    if granularity == OAI_SECONDS_GRANULARITY:
+        step = timedelta(seconds=1)
+        start = start.replace(microsecond=0)
+        end = end.replace(microsecond=0)
+    else:
+        step = timedelta(days=1)
+        start = datetime(start.year, start.month, start.day)
+        end = datetime(end.year, end.month, end.day)
+    if start > end:
+        raise WrongDateCombination("'Until' date larger than 'from' date.")
+
+    slots = int((end - start).total_seconds() // step.total_seconds()) + 1
+    parts = max(1, min(parts, slots))
+    windows = []
+    for index in range(parts):
+        lower = start + step * (slots * index // parts)
+        upper = start + step * (slots * (index + 1) // parts - 1)
+        windows.append((format_oai_date(lower, granularity),
+                        format_oai_date(upper, granularity)))
+    return windows
+
+
+def get_stylesheet_path(stylesheet):
+    """Return the path of a stylesheet from its name or path.
+
+    :param stylesheet: The name of a stylesheet registered with bibconvert,
+                       or the path of a stylesheet.
+    """
+    if os.path.isfile(stylesheet):
+        return os.path.abspath(stylesheet)
+    from invenio.legacy.bibconvert.registry import templates
+    return templates.get(stylesheet, stylesheet)
+
+
+def get_xslt(stylesheet):
+    """Return the compiled XSLT of a stylesheet.
+
+    Compiled stylesheets are kept for the lifetime of the process, and
+    compiled again only when the stylesheet file is modified.
+
+    :param stylesheet: The name or the path of the stylesheet.
+    :rtype: :class:`lxml.etree.XSLT`
+    """
+    path = get_stylesheet_path(stylesheet)
+    mtime = os.path.getmtime(path)
+    with _xslt_cache_lock:
+        cached = _xslt_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    xslt = etree.XSLT(etree.parse(path))
+    with _xslt_cache_lock:
+        _xslt_cache[path] = (mtime, xslt)
+    return xslt
+
+
+def warm_xslt_cache(stylesheets=None):
+    """Compile stylesheets ahead of their first use.
+
+    :param stylesheets: The names or paths of the stylesheets
+                        (defaults to OAIHARVESTER_XSLT_PRELOAD).
+    """
+    if stylesheets is None:
+        stylesheets = cfg.get("OAIHARVESTER_XSLT_PRELOAD", [])
+    for stylesheet in stylesheets:
+        try:
+            get_xslt(stylesheet)
+        except (IOError, OSError, etree.LxmlError):
+            logger.warning("Could not compile stylesheet %s.", stylesheet)
+
+
+def xslt_convert(xml, stylesheet):
+    """Transform XML with a stylesheet, using the compiled stylesheet cache.
+
+    :param xml: The XML document as a string.
+    :param stylesheet: The name or the path of the stylesheet.
+    :return: The result of the transformation as a string.
+    """
+    if isinstance(xml, six.text_type):
+        xml = xml.encode("utf-8")
+    return str(get_xslt(stylesheet)(etree.fromstring(xml)))
+
+
 def get_identifier_names(identifier):
     """Return list of identifiers from a comma-separated string."""
     if identifier:
@@ -181,6 +522,13 @@ def get_identifier_names(identifier):
         return stripped_idents
 
 
+def get_set_names(setspecs):
+    """Return list of set names from a comma or space separated string."""
+    if setspecs:
+        return [setspec for setspec in re.split(r"[\s,]+", setspecs) if setspec]
+    return []
+
+
 def update_lastrun(oaiharvest_object):
     """Update the 'lastrun' attribute of the OaiHARVEST object.
 
@@ -230,47 +578,549 @@ def check_or_create_dir(output_dir):
     return path
 
 
-def create_file_name(output_dir):
+def create_file_name(output_dir, suffix='.xml'):
     """Create a random file name.
 
     :param output_dir: The directory where the file should be created.
+    :param suffix: The extension of the file name.
     """
     from tempfile import NamedTemporaryFile
     prefix = 'oaiharvest_' + datetime.now().strftime('%Y-%m-%d') + '_'
 
     try:
-        temp = NamedTemporaryFile(prefix=prefix, suffix='.xml', dir=output_dir, mode='w+')
+        temp = NamedTemporaryFile(prefix=prefix, suffix=suffix, dir=output_dir, mode='w+')
         file_name = temp.name[:]
     finally:
         temp.close()
     return file_name
 
 
-def write_to_dir(records, output_dir, max_records=1000):
+class RecordFileWriter(object):
+
+    """Write records to files in a directory, rotating them when full.
+
+    A file is rotated once it holds ``max_records`` records or once
+    ``max_bytes`` bytes have been written to disk. Every file is written
+    under a temporary name and renamed once complete, so that any file
+    with its final name can safely be read.
+
+    :meth:`flush` makes the records written so far durable without
+    rotating the file. After a failure, :meth:`abort` only keeps these
+    records.
+    """
+
+    suffixes = {
+        None: '.xml',
+        'gzip': '.xml.gz',
+        'xz': '.xml.xz',
+    }
+
+    def __init__(self, output_path, max_records=1000, max_bytes=None,
+                 compression=None, index=False):
+        """Initialize the writer.
+
+        :param output_path: The directory where the files should be created.
+        :param max_records: The max number of records in a single file.
+        :param max_bytes: The max number of bytes of a single file (optional).
+        :param compression: The compression of the files (None, 'gzip' or 'xz').
+        :param index: Whether to write an index next to every file.
+        """
+        if compression not in self.suffixes:
+            raise ValueError("Unknown compression: {0}".format(compression))
+        if compression == 'xz' and lzma is None:
+            raise RuntimeError("xz compression requires the lzma module.")
+        self.output_path = output_path
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.index = index
+        self.files_created = []
+        self.on_file_created = []
+        self._raw = None
+        self._stream = None
+        self._name = None
+        self._index = None
+        self._offset = 0
+        self._records = 0
+        self._flushed = None
+
+    def _open(self):
+        self._name = create_file_name(self.output_path,
+                                      self.suffixes[self.compression])
+        self._raw = open(self._name + '.part', 'wb')
+        self._open_stream()
+        if self.index:
+            self._index = open(self._name + INDEX_SUFFIX + '.part', 'wb')
+        self._offset = 0
+        self._records = 0
+        self._flushed = None
+
+    def _open_stream(self):
+        if self.compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        elif self.compression == 'xz':
+            self._stream = lzma.LZMAFile(self._raw, mode='wb')
+        else:
+            self._stream = self._raw
+
+    def write(self, data, identifier=None, datestamp=None):
+        """Write a record to the current file, rotating it if full.
+
+        :param data: The record as XML.
+        :param identifier: The OAI identifier of the record, for the index.
+        :param datestamp: The datestamp of the record, for the index.
+        """
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        if self._stream is None:
+            self._open()
+        self._stream.write(data)
+        if self._index is not None and identifier:
+            line = "{0}\t{1}\t{2}\t{3}\n".format(
+                identifier, datestamp or "", self._offset, len(data))
+            self._index.write(line.encode('utf-8'))
+        self._offset += len(data)
+        self._records += 1
+        if self._records >= self.max_records or (
+                self.max_bytes and self._raw.tell() >= self.max_bytes):
+            self.close()
+
+    def flush(self):
+        """Write the records received so far to disk, keeping the file open.
+
+        A compressed stream is ended and a new one started in the same
+        file, as gzip and xz files may hold several streams one after the
+        other.
+        """
+        if self._stream is None:
+            return
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        index_size = None
+        if self._index is not None:
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            index_size = self._index.tell()
+        self._flushed = (self._raw.tell(), index_size)
+        if self._stream is not self._raw:
+            self._open_stream()
+
+    def close(self):
+        """Complete the current file, if any, and give it its final name."""
+        if self._stream is None:
+            return
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+        if self._index is not None:
+            self._index.close()
+        self._complete()
+
+    def abort(self):
+        """Complete the current file with the records flushed before a failure.
+
+        The records written since the last :meth:`flush` are dropped. A file
+        without any flushed record keeps its temporary name.
+        """
+        if self._stream is None:
+            return
+        if self._stream is not self._raw:
+            self._stream.close()
+        if self._flushed is not None:
+            self._raw.truncate(self._flushed[0])
+            if self._index is not None:
+                self._index.truncate(self._flushed[1])
+        self._raw.close()
+        if self._index is not None:
+            self._index.close()
+        if self._flushed is not None:
+            self._complete()
+        else:
+            self._raw = self._stream = self._name = self._index = None
+
+    def _complete(self):
+        os.rename(self._name + '.part', self._name)
+        if self._index is not None:
+            os.rename(self._name + INDEX_SUFFIX + '.part',
+                      self._name + INDEX_SUFFIX)
+            self._index = None
+        self.files_created.append(self._name)
+        for callback in self.on_file_created:
+            callback(self._name)
+        self._raw = self._stream = self._name = None
+
+
+def write_to_dir(records, output_dir, max_records=1000, checkpoint=None,
+                 max_bytes=None, compression=None, index=None):
     """Check if the output directory exists, and creates it if it does not.
 
     :param records: An iterator of harvested records.
     :param output_dir: The directory where the output should be sent.
     :param max_records: The max number of records to be written in a single file.
+    :param checkpoint: An OaiHARVESTCHECKPOINT object to register the files
+                       with (optional).
+    :param max_bytes: The max number of bytes to be written in a single file
+                      (defaults to OAIHARVESTER_OUTPUT_MAX_BYTES).
+    :param compression: The compression of the files, 'gzip' or 'xz'
+                        (defaults to OAIHARVESTER_OUTPUT_COMPRESSION).
+    :param index: Whether to write an identifier index next to every file
+                  (defaults to OAIHARVESTER_OUTPUT_INDEX).
     """
     output_path = check_or_create_dir(output_dir)
 
-    files_created = [create_file_name(output_path)]
+    if max_bytes is None:
+        max_bytes = cfg.get("OAIHARVESTER_OUTPUT_MAX_BYTES")
+    if compression is None:
+        compression = cfg.get("OAIHARVESTER_OUTPUT_COMPRESSION")
+    if index is None:
+        index = cfg.get("OAIHARVESTER_OUTPUT_INDEX", False)
+
+    writer = RecordFileWriter(output_path, max_records, max_bytes, compression,
+                              index)
+    if checkpoint is not None:
+        # Progress is only saved once the records are on disk.
+        checkpoint.flush_callbacks.append(writer.flush)
+        writer.on_file_created.append(lambda path: checkpoint.add_files([path]))
+
     total = 0  # total number of records processed
-    f = open(files_created[0], 'w+')
+    try:
+        for record in records:
+            writer.write(record.raw, record.header.identifier,
+                         record.header.datestamp)
+            total += 1
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.files_created, total
+
+
+def read_index(index_path):
+    """Iterate over the entries of the index of a harvested file.
+
+    :param index_path: The path of the index file.
+    :return: generator of (identifier, datestamp, offset, length) tuples
+    """
+    with io.open(index_path, encoding='utf-8') as index_file:
+        for line in index_file:
+            identifier, datestamp, offset, length = line.rstrip("\n").split("\t")
+            yield identifier, datestamp, int(offset), int(length)
+
+
+def read_record(path, offset, length):
+    """Read a single record out of a harvested file.
+
+    :param path: The path of the harvested file.
+    :param offset: The offset of the record in the uncompressed content.
+    :param length: The length in bytes of the record.
+    :return: The record as XML.
+    :rtype: str
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    elif path.endswith('.xz'):
+        with lzma.open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    else:
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = mapping[offset:offset + length]
+            finally:
+                mapping.close()
+    return data.decode('utf-8')
+
+
+_dir_indexes = {}
+_dir_indexes_lock = threading.Lock()
 
-    for record in records:
-        total += 1
-        if total % max_records == 0:
-            # we need a new file to write to
-            f.close()
-            files_created.append(create_file_name(output_path))
-            f = open(files_created[-1], 'w+')
 
-        f.write(record.raw)
+def _load_dir_index(path):
+    """Return the identifiers of a directory output, mapped to their record.
 
-    f.close()
-    return files_created, total
+    The index files are read once per process: later calls only read the
+    files written since. Must be called with ``_dir_indexes_lock`` held.
+
+    :param path: The path of the directory output.
+    :return: A dictionary of OAI identifiers to (mtime, path, datestamp,
+             offset, length) tuples, for the most recently written version.
+    """
+    index_paths = {}
+    for filename in os.listdir(path):
+        if filename.endswith(INDEX_SUFFIX):
+            index_path = os.path.join(path, filename)
+            index_paths[index_path] = os.path.getmtime(index_path)
+
+    loaded, entries = _dir_indexes.get(path, ({}, {}))
+    if any(index_path not in index_paths or mtime != index_paths[index_path]
+           for index_path, mtime in loaded.items()):
+        # A file has been removed or rewritten, start over.
+        loaded, entries = {}, {}
+    _dir_indexes[path] = (loaded, entries)
+
+    new_paths = sorted((mtime, index_path)
+                       for index_path, mtime in index_paths.items()
+                       if index_path not in loaded)
+    for mtime, index_path in new_paths:
+        record_path = index_path[:-len(INDEX_SUFFIX)]
+        for identifier, datestamp, offset, length in read_index(index_path):
+            current = entries.get(identifier)
+            if current is None or current[0] <= mtime:
+                entries[identifier] = (mtime, record_path, datestamp, offset,
+                                       length)
+        loaded[index_path] = mtime
+    return entries
+
+
+def get_dir_ledger(output_dir):
+    """Return the datestamps of the records harvested in a directory output.
+
+    :param output_dir: The directory where the output has been sent.
+    :return: A dictionary of OAI identifiers to the datestamp of their most
+             recently written version.
+    """
+    default = cfg['OAIHARVESTER_STORAGEDIR']
+    path = os.path.join(default, output_dir)
+    if not os.path.isdir(path):
+        return {}
+
+    with _dir_indexes_lock:
+        entries = _load_dir_index(path)
+        return dict((identifier, entry[2])
+                    for identifier, entry in entries.items())
+
+
+def get_record_from_dir(identifier, output_dir):
+    """Return a harvested record from the indexes of a directory output.
+
+    The most recently written file holding the record is used.
+
+    :param identifier: The OAI identifier of the record.
+    :param output_dir: The directory where the output has been sent.
+    :return: The record as XML, or None if it is not found.
+    :rtype: str
+    """
+    default = cfg['OAIHARVESTER_STORAGEDIR']
+    path = os.path.join(default, output_dir)
+    if not os.path.isdir(path):
+        return None
+
+    with _dir_indexes_lock:
+        entry = _load_dir_index(path).get(identifier)
+    if entry is None:
+        return None
+    dummy, record_path, dummy, offset, length = entry
+    return read_record(record_path, offset, length)
+
+
+def send_to_workflow(records, workflow_name, batch_size=None,
+                     flush_interval=None, checkpoint=None):
+    """Send the raw information of the records to a workflow, in batches.
+
+    Each batch is a single workflow run (and a single broker message). A
+    batch is sent once full, or once it is older than ``flush_interval``
+    seconds, even while the harvest waits for the next page. Before
+    sending, the harvest waits while the workflow queue is longer than
+    OAIHARVESTER_WORKFLOW_MAX_QUEUE_LENGTH.
+
+    :param records: An iterator of harvested records.
+    :param workflow_name: The workflow that should process the output.
+    :param batch_size: The number of records per workflow run
+                       (defaults to OAIHARVESTER_WORKFLOW_BATCH_SIZE).
+    :param flush_interval: The maximum age in seconds of a batch
+                           (defaults to OAIHARVESTER_WORKFLOW_FLUSH_INTERVAL).
+    :param checkpoint: An OaiHARVESTCHECKPOINT object to register with (optional).
+    :return: The total number of records sent.
+    :raises: The error of a batch which failed to be sent by the timer, on
+             the next record or flush.
+    """
+    from invenio.modules.workflows.api import start_delayed
+
+    if batch_size is None:
+        batch_size = cfg.get("OAIHARVESTER_WORKFLOW_BATCH_SIZE", 1)
+    if flush_interval is None:
+        flush_interval = cfg.get("OAIHARVESTER_WORKFLOW_FLUSH_INTERVAL")
+    queue = cfg.get("OAIHARVESTER_WORKFLOW_QUEUE", "celery")
+    max_queue_length = cfg.get("OAIHARVESTER_WORKFLOW_MAX_QUEUE_LENGTH")
+
+    batch = []
+    state = {'started': None, 'total': 0, 'error': None}
+    lock = threading.Lock()
+
+    def send():
+        if state['error'] is not None:
+            # The batch failed to be sent by the timer, it is still there.
+            error, state['error'] = state['error'], None
+            raise error
+        if not batch:
+            return
+        if max_queue_length is not None:
+            wait_for_queue(queue, max_queue_length)
+        start_delayed(workflow_name, list(batch))
+        state['total'] += len(batch)
+        del batch[:]
+
+    def is_due():
+        return flush_interval is not None and batch and \
+            time.time() - state['started'] >= flush_interval
+
+    def flush():
+        with lock:
+            send()
+
+    if checkpoint is not None:
+        checkpoint.flush_callbacks.append(flush)
+
+    stop = threading.Event()
+    timer = None
+    if flush_interval:
+        # Sends the batches which get too old while no record arrives.
+        app = current_app._get_current_object()
+
+        def flush_when_due():
+            with app.app_context():
+                while not stop.wait(min(flush_interval, 1)):
+                    with lock:
+                        if is_due():
+                            try:
+                                send()
+                            except Exception as e:
+                                app.logger.exception(
+                                    "Sending a batch to {0} failed.".format(
+                                        workflow_name))
+                                state['error'] = e
+                                return
+
+        timer = threading.Thread(target=flush_when_due)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for record in records:
+            with lock:
+                if not batch:
+                    state['started'] = time.time()
+                batch.append(record.raw)
+                if len(batch) >= batch_size or is_due():
+                    send()
+        flush()
+    finally:
+        stop.set()
+        if timer is not None:
+            timer.join()
+    return state['total']
+
+
+def ingest_records(records, batch_size=None, checkpoint=None,
+                   on_rejected=None):
+    """Convert harvested records to JSON and create them in bulk.
+
+    MARCXML records are converted in batches, OAI_DC records with
+    ``oai_dc_to_json``. Deleted records are skipped, and so are the
+    records in another format, which are reported.
+
+    :param records: An iterator of harvested records.
+    :param batch_size: The number of records converted and created at once
+                       (defaults to OAIHARVESTER_INGEST_BATCH_SIZE).
+    :param checkpoint: An OaiHARVESTCHECKPOINT object to register with (optional).
+    :param on_rejected: A function called with the (identifier, datestamp)
+                        of the records which failed or were skipped, as soon
+                        as they are known (optional).
+    :return: A tuple with the number of records created, and the
+             (identifier, datestamp) of the records that failed and of the
+             records in an unsupported format.
+    """
+    from invenio_oaiharvester.tasks.records import (
+        OAI_DC_NAMESPACE,
+        bulk_create_records,
+        marcxml_records_to_json,
+        oai_dc_to_json
+    )
+
+    if batch_size is None:
+        batch_size = cfg.get("OAIHARVESTER_INGEST_BATCH_SIZE", 500)
+
+    marcxml_batch = []
+    oai_dc_batch = []
+    state = {'created': 0}
+    failed = []
+    skipped = []
+
+    def reject(keys, rejected):
+        rejected.extend(keys)
+        if on_rejected is not None:
+            on_rejected(keys)
+
+    def convert_oai_dc(xml):
+        try:
+            return oai_dc_to_json(xml)
+        except Exception:
+            logger.exception("Converting a record to JSON failed.")
+            return None
+
+    def flush():
+        if not marcxml_batch and not oai_dc_batch:
+            return
+        converted = list(zip(
+            [key for key, dummy in marcxml_batch],
+            marcxml_records_to_json([xml for dummy, xml in marcxml_batch])
+        )) + [(key, convert_oai_dc(xml)) for key, xml in oai_dc_batch]
+        keys = {}
+        for key, record in converted:
+            if record is not None:
+                keys[id(record)] = key
+        reject([key for key, record in converted if record is None], failed)
+        created, errors = bulk_create_records(
+            (record for key, record in converted if record is not None),
+            batch_size)
+        state['created'] += created
+        reject([keys[id(record)] for record, dummy in errors], failed)
+        del marcxml_batch[:]
+        del oai_dc_batch[:]
+
+    if checkpoint is not None:
+        checkpoint.flush_callbacks.append(flush)
+
+    for record in records:
+        if record.header.deleted:
+            continue
+        key = (record.header.identifier, record.header.datestamp)
+        marcxml = record.xml.find('.//{%s}record' % MARC_NAMESPACE)
+        if marcxml is not None:
+            marcxml_batch.append((key, etree.tostring(marcxml)))
+        elif record.xml.find('.//{%s}dc' % OAI_DC_NAMESPACE) is not None:
+            oai_dc_batch.append((key, record.xml))
+        else:
+            reject([key], skipped)
+            continue
+        if len(marcxml_batch) + len(oai_dc_batch) >= batch_size:
+            flush()
+    flush()
+    return state['created'], failed, skipped
+
+
+def wait_for_queue(queue, max_length, poll_interval=5):
+    """Wait while a broker queue holds more than ``max_length`` messages.
+
+    :param queue: The name of the broker queue.
+    :param max_length: The number of messages above which to wait.
+    :param poll_interval: The number of seconds between two checks.
+    """
+    from invenio.celery import celery
+
+    while True:
+        with celery.connection_or_acquire() as connection:
+            length = connection.default_channel.queue_declare(
+                queue=queue, passive=True
+            ).message_count
+        if length <= max_length:
+            return
+        time.sleep(poll_interval)
 
 
 def print_to_stdout(records):
@@ -25,12 +25,13 @@ from invenio.modules.workflows.tasks.logic_tasks import (
     workflow_else,
     workflow_if,
 )
-from invenio.modules.workflows.tasks.marcxml_tasks import convert_record
 from invenio.modules.workflows.tasks.workflows_tasks import log_info
 
 from ..tasks.records import (
     convert_record_to_json,
+    convert_records,
     create_record,
+    match_records,
     quick_match_record
 )
 
@@ -48,13 +49,15 @@ class oaiharvest_record(object):
     object_type = "OAI harvest"
 
     workflow = [
-        # Convert OAI_DC XML -> MARCXML
-        # FIXME Remove this step when we have one-step OAI_DC -> JSON
-        convert_record("oaidc2marcxml.xsl"),
-        # Convert MARCXML -> JSON
+        # Convert OAI_DC XML -> MARCXML -> JSON, for all the records of the
+        # run at once. See the "_dc" variant of this workflow for one-step
+        # OAI_DC -> JSON
+        convert_records("oaidc2marcxml.xsl"),
+        # Convert one by one the records left as MARCXML
         convert_record_to_json,
-        # Try to match the record with the database
+        # Try to match the records of the run with the database at once
         # FIXME Add more identifiers to match. By default only control_number.
+        match_records(),
         workflow_if(quick_match_record(), True),
         [
             # Create record in the database using invenio_records
@@ -29,7 +29,6 @@ from invenio.modules.workflows.tasks.logic_tasks import (
 )
 from invenio.modules.workflows.tasks.marcxml_tasks import (
     approve_record,
-    convert_record,
     was_approved
 )
 from invenio.modules.workflows.tasks.workflows_tasks import log_info
@@ -40,7 +39,9 @@ import six
 
 from ..tasks.records import (
     convert_record_to_json,
+    convert_records,
     create_record,
+    match_records,
     quick_match_record
 )
 
@@ -64,13 +65,15 @@ class oaiharvest_record_approval(object):
     }
 
     workflow = [
-        # Convert OAI_DC XML -> MARCXML
-        # FIXME Remove this step when we have one-step OAI_DC -> JSON
-        convert_record("oaidc2marcxml.xsl"),
-        # Convert MARCXML -> JSON
+        # Convert OAI_DC XML -> MARCXML -> JSON, for all the records of the
+        # run at once. See the "_dc" variant of this workflow for one-step
+        # OAI_DC -> JSON
+        convert_records("oaidc2marcxml.xsl"),
+        # Convert one by one the records left as MARCXML
         convert_record_to_json,
-        # Try to match the record with the database
+        # Try to match the records of the run with the database at once
         # FIXME Add more identifiers to match. By default only control_number.
+        match_records(),
         workflow_if(quick_match_record(), True),
         [
             # Halt this record to be approved in the Holding Pen
@@ -92,26 +95,29 @@ class oaiharvest_record_approval(object):
         ],
     ]
 
-    @staticmethod
-    def get_title(bwo, **kwargs):
+    @classmethod
+    def get_title(cls, bwo, **kwargs):
         """Return the value to put in the title column of HoldingPen."""
         if isinstance(bwo.data, six.string_types):
             # Probably XML, nothing to do here
             return "No title extracted"
         record = Record(bwo.data)
-        return record[oaiharvest_record_approval.mapping["title"]][0]
+        return record[cls.mapping["title"]][0]
 
-    @staticmethod
-    def get_description(bwo, **kwargs):
+    @classmethod
+    def get_description(cls, bwo, **kwargs):
         """Return the value to put in the description column of HoldingPen."""
         if isinstance(bwo.data, six.string_types):
             # Probably XML, nothing to do here
             return "Unformatted: <pre>{0}</pre>".format(bwo.data[:100])
         record = Record(bwo.data)
 
-        abstract = record[oaiharvest_record_approval.mapping["abstract"]][0][0]
-        categories = record[oaiharvest_record_approval.mapping["subject"]][0]
-        identifiers = record[oaiharvest_record_approval.mapping["ids"]][0]
+        abstract = record[cls.mapping["abstract"]][0][0]
+        categories = record[cls.mapping["subject"]][0]
+        identifiers = record[cls.mapping["ids"]]
+        if identifiers and not isinstance(identifiers[0], six.string_types):
+            # The identifiers of the first field.
+            identifiers = identifiers[0]
 
         return render_template(
             'oaiharvester/holdingpen/oai_record.html',
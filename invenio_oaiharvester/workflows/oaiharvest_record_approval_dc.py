@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Record processing with approval step, converting OAI_DC directly to JSON."""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from .oaiharvest_record_approval import oaiharvest_record_approval
+from ..tasks.records import convert_oai_dc_to_json
+
+
+class oaiharvest_record_approval_dc(oaiharvest_record_approval):
+
+    """Sample workflow for OAI harvesting with oai_dc metadataprefix.
+
+    Same as oaiharvest_record_approval, but converts OAI_DC XML to JSON in
+    one step.
+
+    NOTE: This workflow makes use of Holding Pen for record approval.
+    """
+
+    mapping = dict(oaiharvest_record_approval.mapping,
+                   ids="system_control_number.value")
+
+    workflow = [
+        # Convert OAI_DC XML -> JSON
+        convert_oai_dc_to_json,
+    ] + oaiharvest_record_approval.workflow[2:]
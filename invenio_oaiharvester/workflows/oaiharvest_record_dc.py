@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Generic record processing, converting OAI_DC directly to JSON."""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from .oaiharvest_record import oaiharvest_record
+from ..tasks.records import convert_oai_dc_to_json
+
+
+class oaiharvest_record_dc(oaiharvest_record):
+
+    """Sample workflow for OAI harvesting with oai_dc metadataprefix.
+
+    Same as oaiharvest_record, but converts OAI_DC XML to JSON in one step.
+
+    NOTE: This workflow blindly inserts records into the database.
+    """
+
+    workflow = [
+        # Convert OAI_DC XML -> JSON
+        convert_oai_dc_to_json,
+    ] + oaiharvest_record.workflow[2:]
@@ -37,6 +37,7 @@ requirements = [
     'Flask>=0.10.1',
     'six>=1.7.2',
     'invenio-records>=0.2.0',
+    'requests>=2.4.0',
     'sickle>=0.4',  # FIXME grab next release for full arXiv.org support
     # FIXME 'Invenio>=2.0.3',
 ]
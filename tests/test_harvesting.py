@@ -20,10 +20,68 @@
 import os
 import httpretty
 
-from invenio_oaiharvester.api import get_records
+from invenio_oaiharvester.api import (
+    checkpointed_records,
+    get_records,
+    list_changed_records,
+    list_records,
+    list_records_in_sets,
+    list_records_in_windows,
+)
+from invenio_oaiharvester.client import get_session
 from invenio.testsuite import InvenioTestCase, make_test_suite, run_test_suite
 
 
+def oai_header(identifier, datestamp, setspecs=(), deleted=False):
+    """Return the XML of an OAI-PMH record header."""
+    return (
+        '<header{0}><identifier>{1}</identifier>'
+        '<datestamp>{2}</datestamp>{3}</header>'.format(
+            ' status="deleted"' if deleted else '', identifier, datestamp,
+            ''.join('<setSpec>{0}</setSpec>'.format(setspec)
+                    for setspec in setspecs)))
+
+
+def oai_record(identifier, datestamp, setspecs=(), metadata=''):
+    """Return the XML of an OAI-PMH record with OAI_DC metadata."""
+    return (
+        '<record xmlns="http://www.openarchives.org/OAI/2.0/">{0}'
+        '<metadata><dc xmlns="http://www.openarchives.org/OAI/2.0/oai_dc/">{1}</dc>'
+        '</metadata></record>'.format(
+            oai_header(identifier, datestamp, setspecs), metadata))
+
+
+def make_record(identifier, datestamp, setspecs=(), metadata=''):
+    """Return a harvested record, as Sickle returns them."""
+    from lxml import etree
+    from sickle.models import Record
+    return Record(etree.fromstring(
+        oai_record(identifier, datestamp, setspecs, metadata)))
+
+
+def oai_response(verb, content='', resumption_token=None):
+    """Return an OAI-PMH response of the arXiv endpoint."""
+    if resumption_token is not None:
+        content += '<resumptionToken>{0}</resumptionToken>'.format(
+            resumption_token)
+    return (
+        '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+        '<responseDate>2015-07-14T10:00:00Z</responseDate>'
+        '<request verb="{0}">http://export.arxiv.org/oai2</request>'
+        '<{0}>{1}</{0}>'
+        '</OAI-PMH>'.format(verb, content))
+
+
+def oai_error(verb, code, message=''):
+    """Return an OAI-PMH error response of the arXiv endpoint."""
+    return (
+        '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+        '<responseDate>2015-07-14T10:00:00Z</responseDate>'
+        '<request verb="{0}">http://export.arxiv.org/oai2</request>'
+        '<error code="{1}">{2}</error>'
+        '</OAI-PMH>'.format(verb, code, message))
+
+
 class OaiHarvesterTests(InvenioTestCase):
 
     @httpretty.activate
@@ -65,6 +123,486 @@ class OaiHarvesterTests(InvenioTestCase):
             self.assertEqual(identifier_in_request,
                              "1507.03011")
 
+    @httpretty.activate
+    def test_get_from_identifiers_concurrently(self):
+        raw_xml = open(os.path.join(
+            os.path.dirname(__file__), "data/sample_oai_dc_response.xml"
+        )).read()
+
+        httpretty.register_uri(httpretty.GET,
+                               'http://export.arxiv.org/oai2',
+                               body=raw_xml,
+                               content_type='text/xml')
+        identifiers = ['oai:arXiv.org:1507.03011'] * 3
+        records = list(get_records(identifiers,
+                                   url='http://export.arxiv.org/oai2',
+                                   concurrency=2,
+                                   ordered=False))
+        self.assertEqual(len(records), 3)
+        for rec in records:
+            self.assertEqual(rec.header.identifier,
+                             'oai:arXiv.org:1507.03011')
+
+    @httpretty.activate
+    def test_list_records_prefetch(self):
+        def page(identifier, token):
+            return oai_response('ListRecords',
+                                oai_record(identifier, '2015-07-14'), token)
+
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://export.arxiv.org/oai2',
+            responses=[
+                httpretty.Response(body=page('oai:arXiv.org:1', 'token'),
+                                   content_type='text/xml'),
+                httpretty.Response(body=page('oai:arXiv.org:2', ''),
+                                   content_type='text/xml'),
+            ]
+        )
+        records = list_records(url='http://export.arxiv.org/oai2',
+                               from_date='2015-07-14', prefetch=1)
+        self.assertEqual([rec.header.identifier for rec in records],
+                         ['oai:arXiv.org:1', 'oai:arXiv.org:2'])
+        self.assertEqual(httpretty.last_request().querystring['resumptionToken'],
+                         ['token'])
+
+    @httpretty.activate
+    def test_list_records_prefetch_raises_on_call(self):
+        from sickle.oaiexceptions import NoRecordsMatch
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://export.arxiv.org/oai2',
+            body=oai_error('ListRecords', 'noRecordsMatch'),
+            content_type='text/xml'
+        )
+        self.assertRaises(NoRecordsMatch, list_records,
+                          url='http://export.arxiv.org/oai2',
+                          from_date='2015-07-14', prefetch=1)
+
+    @httpretty.activate
+    def test_list_changed_records(self):
+        identifiers = oai_response(
+            'ListIdentifiers',
+            oai_header('oai:arXiv.org:1', '2015-07-14') +
+            oai_header('oai:arXiv.org:2', '2015-07-15') +
+            oai_header('oai:arXiv.org:3', '2015-07-15', deleted=True))
+        record = oai_record('oai:arXiv.org:2', '2015-07-15')
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://export.arxiv.org/oai2',
+            responses=[
+                httpretty.Response(body=identifiers, content_type='text/xml'),
+                httpretty.Response(body=oai_response('GetRecord', record),
+                                   content_type='text/xml'),
+            ]
+        )
+        ledger = {'oai:arXiv.org:1': '2015-07-14',
+                  'oai:arXiv.org:2': '2015-07-14'}
+        records = list(list_changed_records(url='http://export.arxiv.org/oai2',
+                                            ledger=ledger))
+        self.assertEqual([(rec.header.identifier, rec.deleted) for rec in records],
+                         [('oai:arXiv.org:3', True), ('oai:arXiv.org:2', False)])
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        self.assertEqual(httpretty.last_request().querystring['identifier'],
+                         ['oai:arXiv.org:2'])
+
+        # Without any record harvested yet, they are listed at once.
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://export.arxiv.org/oai2',
+            body=oai_response('ListRecords', record),
+            content_type='text/xml'
+        )
+        records = list(list_changed_records(url='http://export.arxiv.org/oai2',
+                                            ledger={}))
+        self.assertEqual([rec.header.identifier for rec in records],
+                         ['oai:arXiv.org:2'])
+        self.assertEqual(httpretty.last_request().querystring['verb'],
+                         ['ListRecords'])
+
+    def test_ledger_skips_unchanged_records(self):
+        from mock import patch
+        from invenio_oaiharvester.ledger import (
+            OutputFlush,
+            RecordLedger,
+            get_record_hash,
+        )
+
+        def record(identifier, datestamp, title):
+            return make_record(identifier, datestamp, metadata=title)
+
+        stored = {}
+
+        class FakeLedgerModel(object):
+            @staticmethod
+            def get_entries(id_oaiHARVEST, identifiers):
+                return dict((identifier, stored[identifier])
+                            for identifier in identifiers
+                            if identifier in stored)
+
+            @staticmethod
+            def update_entries(id_oaiHARVEST, entries):
+                stored.update(entries)
+
+        unchanged = record('oai:1', '2015-07-14', 'A')
+        stored['oai:1'] = ('2015-07-14', get_record_hash(unchanged))
+        stored['oai:2'] = ('2015-07-14', get_record_hash(unchanged))
+        records = [unchanged,
+                   record('oai:2', '2015-07-14', 'B'),
+                   record('oai:3', '2015-07-15', 'C')]
+        with patch('invenio_oaiharvester.models.OaiHARVESTLEDGER',
+                   FakeLedgerModel):
+            ledger = RecordLedger(1, batch_size=2)
+            self.assertEqual([rec.header.identifier
+                              for rec in ledger.filter(iter(records))],
+                             ['oai:2', 'oai:3'])
+            self.assertEqual(ledger.skipped, 1)
+            self.assertFalse('oai:3' in stored)
+            ledger.commit()
+        self.assertEqual(stored['oai:3'][0], '2015-07-15')
+        self.assertEqual(stored['oai:2'][1], get_record_hash(records[1]))
+
+        # Without a checkpoint, a batch is committed once the output has
+        # consumed and flushed it.
+        stored.clear()
+        output = OutputFlush()
+        flushed = []
+        output.flush_callbacks.append(lambda: flushed.append(len(stored)))
+        with patch('invenio_oaiharvester.models.OaiHARVESTLEDGER',
+                   FakeLedgerModel):
+            ledger = RecordLedger(1, batch_size=1)
+            changed = ledger.filter(iter(records), output=output)
+            next(changed)
+            self.assertEqual((flushed, stored), ([], {}))
+            next(changed)
+            self.assertEqual(flushed, [0])
+            self.assertEqual(sorted(stored), ['oai:1'])
+            self.assertEqual(sorted(ledger.pending), ['oai:2'])
+
+        # With a checkpoint, each page is looked up at once.
+        class Checkpoint(object):
+            def __init__(self):
+                self.flush_callbacks = []
+                self.page_filters = []
+
+        checkpoint = Checkpoint()
+        with patch('invenio_oaiharvester.models.OaiHARVESTLEDGER',
+                   FakeLedgerModel):
+            ledger = RecordLedger(1)
+            self.assertIs(ledger.filter(records, checkpoint), records)
+            page = checkpoint.page_filters[0](
+                records + [record('oai:4', '2015-07-16', 'D')])
+            self.assertEqual([rec.header.identifier for rec in page],
+                             ['oai:4'])
+            self.assertEqual(ledger.skipped, 3)
+            self.assertEqual(checkpoint.flush_callbacks, [ledger.commit])
+
+            # Forced, the unchanged records are passed on as well.
+            ledger = RecordLedger(1, force=True)
+            self.assertEqual(len(list(ledger.filter(iter(records)))), 3)
+            self.assertEqual(ledger.skipped, 0)
+
+        # The records the ingest output could not create are not remembered.
+        from invenio_oaiharvester import tasks
+
+        def ingest(records, checkpoint=None, on_rejected=None):
+            records = list(records)
+            failed = [(records[0].header.identifier,
+                       records[0].header.datestamp)]
+            on_rejected(failed)
+            return len(records) - 1, failed, []
+
+        stored.clear()
+        with patch('invenio_oaiharvester.models.OaiHARVESTLEDGER',
+                   FakeLedgerModel), \
+                patch.object(tasks, 'ingest_records', side_effect=ingest), \
+                patch.object(tasks, 'print_total_records'):
+            tasks.schedule_harvest('ingest', None, None, 'arXiv',
+                                   iter(records), ledger=RecordLedger(1))
+        self.assertEqual(sorted(stored), ['oai:2', 'oai:3'])
+
+    def test_watermark_only_moved_by_list_harvests_from_it(self):
+        from mock import MagicMock, patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester import tasks
+        from invenio_oaiharvester.ledger import HighWaterMark
+
+        records = [make_record('oai:1', '2015-07-15T10:00:00Z', ['physics']),
+                   make_record('oai:2', '2015-07-14T12:00:00Z',
+                               ['physics', 'cs']),
+                   make_record('oai:3', '2015-07-16T08:30:00Z', ['math'])]
+
+        def harvest(task, *args):
+            with patch.object(HighWaterMark, 'commit',
+                              autospec=True) as commit:
+                task(*args)
+            return [call[0][0].latest for call in commit.call_args_list]
+
+        config = {"OAIHARVESTER_WATERMARKS": True,
+                  "OAIHARVESTER_LEDGER": False,
+                  "OAIHARVESTER_CHECKPOINTS": False}
+        with patch.dict(cfg, config), \
+                patch.object(tasks, 'get_oaiharvest_object',
+                             return_value=MagicMock(id=1)), \
+                patch.object(tasks, 'list_records', return_value=records), \
+                patch.object(tasks, 'get_records', return_value=records), \
+                patch.object(tasks, 'print_to_stdout',
+                             side_effect=lambda records: len(list(records))), \
+                patch.object(tasks, 'print_total_records'):
+            latest = harvest(tasks.list_records_from_dates, None, None, None,
+                             None, 'arXiv', None, 'stdout', None, None)
+            self.assertEqual([item[''][1] for item in latest],
+                             ['2015-07-16T08:30:00Z'])
+
+            # An explicit from date may be later than the watermark.
+            self.assertEqual(harvest(tasks.list_records_from_dates, None,
+                                     '2015-07-10', None, None, 'arXiv', None,
+                                     'stdout', None, None), [])
+            # Records fetched by identifier say nothing of the others.
+            self.assertEqual(harvest(tasks.get_specific_records, 'oai:1',
+                                     None, None, 'arXiv', 'stdout', None,
+                                     None), [])
+
+        watermark = HighWaterMark(1, sets=['physics', 'cs'])
+        list(watermark.track(iter(records)))
+        self.assertEqual(sorted(watermark.latest), ['cs', 'physics'])
+        watermark = HighWaterMark(1)
+        list(watermark.track(iter(records)))
+        self.assertEqual(watermark.latest[''][1], '2015-07-16T08:30:00Z')
+
+    def test_watermark_held_back_by_ingest_failures(self):
+        from mock import patch
+        from invenio_oaiharvester import tasks
+        from invenio_oaiharvester.ledger import HighWaterMark
+
+        # The harvest started from the watermark, at the first record.
+        records = [make_record('oai:1', '2015-07-14T12:00:00Z'),
+                   make_record('oai:2', '2015-07-15T10:00:00Z'),
+                   make_record('oai:3', '2015-07-16T08:30:00Z')]
+
+        def harvest(failing):
+            def ingest(records, checkpoint=None, on_rejected=None):
+                records = list(records)
+                failed = [(rec.header.identifier, rec.header.datestamp)
+                          for rec in records
+                          if rec.header.identifier in failing]
+                on_rejected(failed)
+                return len(records) - len(failed), failed, []
+
+            with patch('invenio_oaiharvester.models.OaiHARVESTWATERMARK') \
+                    as model, \
+                    patch.object(tasks, 'ingest_records',
+                                 side_effect=ingest), \
+                    patch.object(tasks, 'print_total_records'):
+                tasks.schedule_harvest('ingest', None, None, 'arXiv',
+                                       iter(records),
+                                       watermark=HighWaterMark(1))
+            return model.advance.call_args[0][1]
+
+        self.assertEqual(harvest([]), {'': '2015-07-16T08:30:00Z'})
+        # The watermark stays where it was, the next harvest retries all.
+        self.assertEqual(harvest(['oai:1', 'oai:3']),
+                         {'': '2015-07-14T12:00:00Z'})
+        self.assertEqual(harvest(['oai:3', 'oai:2']),
+                         {'': '2015-07-15T10:00:00Z'})
+
+    def test_watermark_of_hierarchical_sets(self):
+        from mock import MagicMock, patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester import tasks
+        from invenio_oaiharvester.ledger import HighWaterMark
+
+        records = [make_record('oai:1', '2015-07-15', ['physics:hep-th']),
+                   make_record('oai:2', '2015-07-16', ['physicsx']),
+                   make_record('oai:3', '2015-07-14', ['cs'])]
+        watermark = HighWaterMark(1, sets=['physics', 'cs'])
+        list(watermark.track(iter(records)))
+        self.assertEqual(dict((key, datestamp) for key, (dummy, datestamp)
+                              in watermark.latest.items()),
+                         {'physics': '2015-07-15', 'cs': '2015-07-14'})
+
+        # Harvesting every set only moves the watermarks of the sets listed,
+        # not of the other sets the records belong to.
+        config = {"OAIHARVESTER_WATERMARKS": True,
+                  "OAIHARVESTER_LEDGER": False}
+        with patch.dict(cfg, config), \
+                patch.object(tasks, 'get_oaiharvest_object',
+                             return_value=MagicMock(id=1)), \
+                patch.object(tasks, 'get_harvested_sets',
+                             return_value=['cs', 'math']), \
+                patch.object(tasks, 'list_records_in_sets',
+                             return_value=records), \
+                patch.object(tasks, 'print_to_stdout',
+                             side_effect=lambda records: len(list(records))), \
+                patch.object(tasks, 'print_total_records'), \
+                patch.object(HighWaterMark, 'commit',
+                             autospec=True) as commit:
+            tasks.list_records_from_dates(None, None, None, None, 'arXiv',
+                                          None, 'stdout', None, None,
+                                          all_sets=True)
+        self.assertEqual(list(commit.call_args[0][0].latest), ['cs'])
+
+    @httpretty.activate
+    def test_list_records_in_windows(self):
+        identify = oai_response(
+            'Identify',
+            '<repositoryName>arXiv</repositoryName>'
+            '<earliestDatestamp>2015-07-01</earliestDatestamp>'
+            '<granularity>YYYY-MM-DD</granularity>')
+
+        def callback(request, uri, headers):
+            if request.querystring['verb'] == ['Identify']:
+                return (200, headers, identify)
+            from_date = request.querystring['from'][0]
+            return (200, headers, oai_response(
+                'ListRecords',
+                oai_record('oai:arXiv.org:' + from_date, from_date)))
+
+        httpretty.register_uri(httpretty.GET,
+                               'http://export.arxiv.org/oai2',
+                               body=callback,
+                               content_type='text/xml')
+        records = list_records_in_windows(url='http://export.arxiv.org/oai2',
+                                          from_date='2015-07-01',
+                                          until_date='2015-07-04',
+                                          windows=2)
+        self.assertEqual(
+            sorted(rec.header.identifier for rec in records),
+            ['oai:arXiv.org:2015-07-01', 'oai:arXiv.org:2015-07-03'])
+
+    @httpretty.activate
+    def test_list_records_in_sets(self):
+        list_sets = oai_response(
+            'ListSets',
+            '<set><setSpec>cs</setSpec><setName>Computer Science</setName></set>'
+            '<set><setSpec>physics</setSpec><setName>Physics</setName></set>')
+
+        def record(number):
+            return oai_record('oai:arXiv.org:' + number, '2015-07-14')
+
+        records_by_set = {
+            'cs': record('1') + record('2'),
+            'physics': record('2') + record('3'),
+        }
+
+        def callback(request, uri, headers):
+            if request.querystring['verb'] == ['ListSets']:
+                return (200, headers, list_sets)
+            return (200, headers, oai_response(
+                'ListRecords',
+                records_by_set[request.querystring['set'][0]]))
+
+        httpretty.register_uri(httpretty.GET,
+                               'http://export.arxiv.org/oai2',
+                               body=callback,
+                               content_type='text/xml')
+        records = list_records_in_sets(url='http://export.arxiv.org/oai2')
+        self.assertEqual(
+            sorted(rec.header.identifier for rec in records),
+            ['oai:arXiv.org:1', 'oai:arXiv.org:2', 'oai:arXiv.org:3'])
+
+    @httpretty.activate
+    def test_checkpointed_records(self):
+        def page(number, token):
+            return oai_response(
+                'ListRecords',
+                oai_record('oai:arXiv.org:' + number, '2015-07-1' + number),
+                token)
+
+        def callback(request, uri, headers):
+            if request.querystring.get('resumptionToken') == ['expired']:
+                return (200, headers, oai_error('ListRecords',
+                                                'badResumptionToken',
+                                                'Expired'))
+            if request.querystring.get('resumptionToken') == ['token']:
+                return (200, headers, page('2', ''))
+            return (200, headers, page('1', 'token'))
+
+        httpretty.register_uri(httpretty.GET,
+                               'http://export.arxiv.org/oai2',
+                               body=callback,
+                               content_type='text/xml')
+
+        class Checkpoint(object):
+            baseurl = 'http://export.arxiv.org/oai2'
+            metadataprefix = 'oai_dc'
+            setspec = None
+            from_date = '2015-07-10'
+            until_date = None
+            resumption_token = None
+            last_datestamp = None
+            finished = False
+
+            def __init__(self):
+                self.progress = []
+                self.page_filters = []
+
+            def update_progress(self, token, datestamp, records):
+                self.progress.append((token, datestamp, records))
+                self.resumption_token = token
+
+            def finish(self):
+                self.finished = True
+
+        checkpoint = Checkpoint()
+        records = checkpointed_records(checkpoint)
+        self.assertEqual(next(records).header.identifier, 'oai:arXiv.org:1')
+        self.assertEqual(checkpoint.progress, [])
+        self.assertEqual(next(records).header.identifier, 'oai:arXiv.org:2')
+        self.assertEqual(checkpoint.progress, [('token', '2015-07-11', 1)])
+        self.assertEqual(list(records), [])
+        self.assertEqual(checkpoint.progress[-1], (None, '2015-07-12', 1))
+        self.assertTrue(checkpoint.finished)
+
+        # An interrupted harvest continues from the stored token.
+        checkpoint = Checkpoint()
+        checkpoint.resumption_token = 'token'
+        self.assertEqual([rec.header.identifier
+                          for rec in checkpointed_records(checkpoint)],
+                         ['oai:arXiv.org:2'])
+
+        # An expired token restarts the harvest from its first date.
+        checkpoint = Checkpoint()
+        checkpoint.resumption_token = 'expired'
+        checkpoint.last_datestamp = '2015-07-11'
+        self.assertEqual([rec.header.identifier
+                          for rec in checkpointed_records(checkpoint,
+                                                          prefetch=1)],
+                         ['oai:arXiv.org:1', 'oai:arXiv.org:2'])
+        self.assertEqual(checkpoint.progress[0], ('token', '2015-07-11', 1))
+
+    def test_checkpoint_claimed_by_live_run(self):
+        from datetime import datetime, timedelta
+        from invenio_oaiharvester.models import OaiHARVESTCHECKPOINT
+
+        checkpoint = OaiHARVESTCHECKPOINT(owner='run-1',
+                                          modified=datetime.now())
+        self.assertTrue(checkpoint.is_claimed('run-2', 3600))
+        self.assertFalse(checkpoint.is_claimed('run-1', 3600))
+        self.assertFalse(checkpoint.claim('run-2', 3600))
+        # A run which stopped saving its progress has lost its claim.
+        checkpoint.modified = datetime.now() - timedelta(hours=2)
+        self.assertFalse(checkpoint.is_claimed('run-2', 3600))
+        checkpoint.owner = None
+        self.assertFalse(checkpoint.is_claimed('run-2', 3600))
+
+    @httpretty.activate
+    def test_get_records_shared_compressed_session(self):
+        raw_xml = open(os.path.join(
+            os.path.dirname(__file__), "data/sample_oai_dc_response.xml"
+        )).read()
+
+        httpretty.register_uri(httpretty.GET,
+                               'http://export.arxiv.org/oai2',
+                               body=raw_xml,
+                               content_type='text/xml')
+        list(get_records(['oai:arXiv.org:1507.03011'],
+                         url='http://export.arxiv.org/oai2'))
+        self.assertIn('gzip',
+                      httpretty.last_request().headers['Accept-Encoding'])
+        self.assertIs(get_session('http://export.arxiv.org/oai2'),
+                      get_session('http://export.arxiv.org/oai2'))
+
 TEST_SUITE = make_test_suite(OaiHarvesterTests)
 
 if __name__ == "__main__":
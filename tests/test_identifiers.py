@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Test for the local index of ingested identifiers."""
+
+import os
+import shutil
+import tempfile
+
+from invenio.testsuite import InvenioTestCase, make_test_suite, run_test_suite
+
+
+class OAIHarvesterIdentifierIndex(InvenioTestCase):
+
+    """Class to test the local index of ingested identifiers."""
+
+    def setUp(self):
+        """Setup tests."""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "identifiers.db")
+
+    def tearDown(self):
+        """Clean up created files."""
+        shutil.rmtree(self.directory)
+
+    def test_index_persistence(self):
+        """Test adding identifiers and reading them from another index."""
+        from invenio_oaiharvester.identifiers import IdentifierIndex
+
+        index = IdentifierIndex(self.path, capacity=100)
+        other = IdentifierIndex(self.path, capacity=100)
+        index.add(["control_number:1", "control_number:2"])
+        self.assertTrue("control_number:1" in index)
+        self.assertFalse("control_number:3" in index)
+        # Identifiers added by another process are seen as well.
+        self.assertEqual(other.filter(["control_number:2",
+                                       "control_number:3"]),
+                         set(["control_number:2"]))
+        index.close()
+        other.close()
+
+        reopened = IdentifierIndex(self.path, capacity=100)
+        self.assertEqual(reopened.last_rowid, 2)
+        self.assertTrue("control_number:2" in reopened)
+        self.assertFalse(reopened.complete)
+        reopened.mark_complete()
+        reopened.close()
+        self.assertTrue(IdentifierIndex(self.path, capacity=100).complete)
+
+    def test_quick_match_skips_unknown_identifiers(self):
+        """Test only searching for identifiers found in the index."""
+        import sys
+        import types
+        from mock import MagicMock, patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester import identifiers
+        from invenio_oaiharvester.tasks.records import quick_match_record
+
+        class FakeObject(object):
+            def __init__(self, data):
+                self.data = data
+                self.extra_data = {}
+
+        # Records created by other means since the index was filled.
+        created = []
+        models = types.ModuleType(str("invenio_records.models"))
+        models.RecordMetadata = MagicMock()
+        models.RecordMetadata.query.filter.return_value.order_by \
+            .return_value.yield_per.side_effect = lambda size: list(created)
+
+        query = MagicMock()
+        query.return_value.search.return_value = [1]
+        with patch.dict(cfg, {"OAIHARVESTER_IDENTIFIER_INDEX": self.path}), \
+                patch.dict(sys.modules, {"invenio_records.models": models}), \
+                patch("invenio_records.api.Record", dict), \
+                patch("invenio.modules.search.api.Query", query):
+            index = identifiers.get_identifier_index()
+            index.add(["control_number:1"])
+            # Records ingested before the index was filled may be missing.
+            self.assertTrue(quick_match_record()(
+                FakeObject({"control_number": "2"}), None))
+            query.reset_mock()
+            index.mark_complete()
+            self.assertFalse(quick_match_record()(
+                FakeObject({"control_number": "2"}), None))
+            self.assertFalse(query.called)
+            self.assertTrue(quick_match_record()(
+                FakeObject({"control_number": "1"}), None))
+            query.assert_called_once_with('control_number:"1"')
+
+            query.reset_mock()
+            created.append(MagicMock(id=7, json={"control_number": "3"}))
+            self.assertTrue(quick_match_record()(
+                FakeObject({"control_number": "3"}), None))
+            query.assert_called_once_with('control_number:"3"')
+            self.assertEqual(index.get_setting("last_record_id"), "7")
+        identifiers._index.close()
+        identifiers._index = None
+
+    def test_rebuild_index(self):
+        """Test filling the index with the records of the database."""
+        import sys
+        import types
+        from mock import MagicMock, patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester import identifiers
+        from invenio_oaiharvester.tasks.records import \
+            rebuild_identifier_index
+
+        models = types.ModuleType(str("invenio_records.models"))
+        models.RecordMetadata = MagicMock()
+        models.RecordMetadata.query.order_by.return_value.yield_per \
+            .return_value = [MagicMock(id=i + 1,
+                                       json={"control_number": str(i)})
+                             for i in range(5)]
+        with patch.dict(cfg, {"OAIHARVESTER_IDENTIFIER_INDEX": self.path}), \
+                patch.dict(sys.modules, {"invenio_records.models": models}), \
+                patch("invenio_records.api.Record", dict):
+            self.assertEqual(rebuild_identifier_index(batch_size=2), 5)
+            index = identifiers.get_identifier_index()
+            self.assertTrue(index.complete)
+            self.assertEqual(index.last_rowid, 5)
+            self.assertTrue("control_number:4" in index)
+            self.assertEqual(index.get_setting("last_record_id"), "5")
+        identifiers._index.close()
+        identifiers._index = None
+
+
+TEST_SUITE = make_test_suite(OAIHarvesterIdentifierIndex)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -19,9 +19,36 @@
 
 """Test for workflow tasks used by OAI harvester."""
 
+import os
+import shutil
+import tempfile
+
+import httpretty
+
 from invenio.modules.workflows.testsuite.test_workflows import \
     WorkflowTasksTestCase
-from invenio.testsuite import make_test_suite, run_test_suite
+from invenio.testsuite import InvenioTestCase, make_test_suite, \
+    run_test_suite
+
+
+class FakeObject(object):
+
+    """Workflow object, with only what the tasks use."""
+
+    def __init__(self, data):
+        self.data = data
+        self.extra_data = {}
+
+
+class FakeEngine(object):
+
+    """Workflow engine, running the given objects."""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def getObjects(self):
+        return enumerate(self.objects)
 
 
 class OAIHarvesterTasks(WorkflowTasksTestCase):
@@ -39,7 +66,394 @@ class OAIHarvesterTasks(WorkflowTasksTestCase):
         self.cleanup_registries()
 
 
-TEST_SUITE = make_test_suite(OAIHarvesterTasks)
+class OAIHarvesterArxivCache(InvenioTestCase):
+
+    """Class to test the cache of files downloaded from arXiv."""
+
+    def setUp(self):
+        """Setup tests."""
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Clean up created files."""
+        shutil.rmtree(self.cache_dir)
+
+    def _download(self, arxiv_id, extract_path):
+        path = os.path.join(extract_path, arxiv_id.replace("/", "_") + ".pdf")
+        with open(path, "wb") as fd:
+            fd.write(b"x" * 10)
+        return path
+
+    def test_download_once_and_evict(self):
+        """Test sharing downloads and evicting the least recently used."""
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.arxiv import get_arxiv_file
+
+        cache_dir = os.path.join(self.cache_dir, "cache")
+        workflow_dir = os.path.join(self.cache_dir, "workflow")
+        config = {"OAIHARVESTER_ARXIV_CACHE_DIR": cache_dir,
+                  "OAIHARVESTER_ARXIV_CACHE_MAX_SIZE": 25}
+        with patch.dict(cfg, config), patch(
+                "invenio.utils.plotextractor.api.get_pdf_from_arxiv",
+                side_effect=self._download) as download:
+            first = get_arxiv_file("hep-th/9901001v1", "pdf", workflow_dir)
+            self.assertEqual(os.path.dirname(first), workflow_dir)
+            self.assertEqual(
+                get_arxiv_file("hep-th/9901001v1", "pdf", workflow_dir),
+                first)
+            self.assertEqual(download.call_count, 1)
+
+            cached = os.path.join(cache_dir, "pdf", "hep-th_9901001v1")
+            os.utime(cached, (0, 0))
+            get_arxiv_file("1507.03011v2", "pdf", workflow_dir)
+            get_arxiv_file("1507.03012v1", "pdf", workflow_dir)
+            self.assertEqual(download.call_count, 3)
+            self.assertFalse(os.path.exists(cached))
+            # The file of the workflow outlives its cache entry.
+            self.assertTrue(os.path.isfile(first))
+            self.assertEqual(sorted(os.listdir(cache_dir)), ["pdf"])
+
+            # Identifiers which cannot be resolved are not cached.
+            get_arxiv_file("not-an-arxiv-id", "pdf", workflow_dir)
+            get_arxiv_file("not-an-arxiv-id", "pdf", workflow_dir)
+            self.assertEqual(download.call_count, 5)
+            self.assertEqual(sorted(os.listdir(os.path.join(cache_dir, "pdf"))),
+                             ["1507.03011v2", "1507.03012v1"])
+
+    @httpretty.activate
+    def test_cache_unversioned_identifiers(self):
+        """Test caching the files of identifiers as harvested."""
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.arxiv import get_arxiv_file
+
+        httpretty.register_uri(
+            httpretty.GET, "http://export.arxiv.org/api/query",
+            body='<feed xmlns="http://www.w3.org/2005/Atom"><entry>'
+                 '<id>http://arxiv.org/abs/1507.03011v2</id>'
+                 '</entry></feed>',
+            content_type="application/atom+xml")
+
+        cache_dir = os.path.join(self.cache_dir, "cache")
+        workflow_dir = os.path.join(self.cache_dir, "workflow")
+        config = {"OAIHARVESTER_ARXIV_CACHE_DIR": cache_dir,
+                  "OAIHARVESTER_ARXIV_API_URL":
+                  "http://export.arxiv.org/api/query"}
+        with patch.dict(cfg, config), patch(
+                "invenio.utils.plotextractor.api.get_pdf_from_arxiv",
+                side_effect=self._download) as download:
+            first = get_arxiv_file("oai:arXiv.org:1507.03011", "pdf",
+                                   workflow_dir)
+            self.assertEqual(
+                get_arxiv_file("oai:arXiv.org:1507.03011", "pdf",
+                               workflow_dir),
+                first)
+            self.assertEqual(download.call_count, 1)
+            self.assertEqual(download.call_args[0][0], "1507.03011v2")
+            self.assertEqual(httpretty.last_request().querystring["id_list"],
+                             ["1507.03011"])
+            self.assertTrue(os.path.isdir(
+                os.path.join(cache_dir, "pdf", "1507.03011v2")))
+
+    @httpretty.activate
+    def test_resolve_version_once_per_object(self):
+        """Test asking the arXiv API once for all the tasks of a record."""
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.arxiv import get_object_arxiv_id
+
+        requests = []
+
+        def callback(request, uri, headers):
+            requests.append(uri)
+            return (200, headers,
+                    '<feed xmlns="http://www.w3.org/2005/Atom"><entry>'
+                    '<id>http://arxiv.org/abs/1507.03011v2</id>'
+                    '</entry></feed>')
+
+        httpretty.register_uri(
+            httpretty.GET, "http://export.arxiv.org/api/query",
+            body=callback, content_type="application/atom+xml")
+
+        obj = FakeObject({"system_control_number": [
+            {"value": "oai:arXiv.org:1507.03011"}]})
+        config = {"OAIHARVESTER_ARXIV_API_URL":
+                  "http://export.arxiv.org/api/query",
+                  "OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP":
+                  "system_control_number.value"}
+        with patch.dict(cfg, config):
+            self.assertEqual(get_object_arxiv_id(obj), "1507.03011v2")
+            self.assertEqual(get_object_arxiv_id(obj), "1507.03011v2")
+        self.assertEqual(len(requests), 1)
+
+    def test_find_authorlist_in_tarball(self):
+        """Test streaming a tarball for the member with an author list."""
+        import io
+        import tarfile
+        from invenio_oaiharvester.tasks.arxiv import \
+            find_authorlist_in_tarball
+
+        authorlist = (b'<?xml version="1.0"?>\n' + b" " * 100 +
+                      b"<collaborationauthorlist>A</collaborationauthorlist>")
+        members = [("paper.tex", b"\\documentclass{article}"),
+                   ("figure.xml", b"<?xml version='1.0'?><svg/>"),
+                   ("authors", authorlist)]
+        tarball = os.path.join(self.cache_dir, "source.tar.gz")
+        with tarfile.open(tarball, "w:gz") as archive:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+
+        self.assertEqual(find_authorlist_in_tarball(tarball, chunk_size=16),
+                         authorlist)
+
+        plain = os.path.join(self.cache_dir, "source.pdf")
+        with open(plain, "wb") as fd:
+            fd.write(b"%PDF-1.4")
+        self.assertRaises(tarfile.ReadError,
+                          find_authorlist_in_tarball, plain)
+
+    def test_extraction_timeout(self):
+        """Test aborting a slow extraction running in the pool."""
+        import time
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio.utils.shell import Timeout
+        from invenio_oaiharvester.tasks import arxiv
+
+        config = {"OAIHARVESTER_EXTRACTION_PROCESSES": 1,
+                  "OAIHARVESTER_EXTRACTION_TIMEOUT": 1,
+                  "OAIHARVESTER_EXTRACTION_MEMORY_LIMIT": None}
+        extractors = {"slow": lambda path: time.sleep(5),
+                      "fast": lambda path: path.upper()}
+        with patch.dict(cfg, config), \
+                patch.dict(arxiv._EXTRACTORS, extractors):
+            try:
+                self.assertRaises(Timeout, arxiv.run_extraction,
+                                  "slow", "paper.pdf")
+                self.assertEqual(arxiv.run_extraction("fast", "paper.pdf"),
+                                 "PAPER.PDF")
+            finally:
+                arxiv.reset_extraction_pool()
+
+    def test_prefetched_extractions(self):
+        """Test claiming and forgetting prefetched extractions."""
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks import arxiv
+
+        config = {"OAIHARVESTER_EXTRACTION_PROCESSES": 1,
+                  "OAIHARVESTER_EXTRACTION_TIMEOUT": 10,
+                  "OAIHARVESTER_EXTRACTION_MEMORY_LIMIT": None}
+        extractors = {"fast": lambda path: path.upper()}
+        with patch.dict(cfg, config), \
+                patch.dict(arxiv._EXTRACTORS, extractors), \
+                patch.object(arxiv, "EXTRACTION_RESULT_TTL", -1):
+            try:
+                pool, result = arxiv.submit_extraction("fast", "a.pdf")
+                self.assertEqual(arxiv.submit_extraction("fast", "a.pdf"),
+                                 (pool, result))
+                self.assertEqual(arxiv.run_extraction("fast", "a.pdf"),
+                                 "A.PDF")
+                self.assertEqual(arxiv._pending_extractions, {})
+
+                # Nobody claims this one.
+                arxiv.submit_extraction("fast", "b.pdf")[1].wait()
+                with arxiv._extraction_lock:
+                    arxiv._prune_extractions()
+                    self.assertTrue(("fast", "b.pdf")
+                                    in arxiv._pending_extractions)
+                    arxiv._prune_extractions()
+                self.assertEqual(arxiv._pending_extractions, {})
+            finally:
+                arxiv.reset_extraction_pool()
+
+
+class OAIHarvesterRecordTasks(InvenioTestCase):
+
+    """Class to test the record related workflow tasks."""
+
+    def test_batch_match_records(self):
+        """Test matching several records with few queries."""
+        from mock import patch
+        from invenio_oaiharvester.tasks.records import (
+            batch_match_records,
+            match_records,
+            quick_match_record
+        )
+
+        class FakeQuery(object):
+            queries = []
+
+            def __init__(self, query_string):
+                self.queries.append(query_string)
+                self.query_string = query_string
+
+            def search(self, collection=None):
+                return [1] if '"2"' in self.query_string else []
+
+        objects = [FakeObject({"control_number": str(i)}) for i in range(8)]
+        with patch("invenio_records.api.Record", dict), \
+                patch("invenio.modules.search.api.Query", FakeQuery), \
+                patch("invenio_oaiharvester.tasks.records._get_records_json",
+                      return_value=[{"control_number": "2"}]) as records:
+            self.assertEqual(batch_match_records(objects),
+                             [i == 2 for i in range(8)])
+            # The matching values are read from the records found.
+            self.assertEqual(len(FakeQuery.queries), 1)
+            records.assert_called_once_with([1])
+
+            del FakeQuery.queries[:]
+            self.assertTrue(quick_match_record()(objects[2], None))
+            self.assertFalse(quick_match_record()(objects[3], None))
+            self.assertEqual(FakeQuery.queries, [])
+
+            # The step matches the converted records of the run, from the
+            # current one on, and leaves the duplicates to the search.
+            run = [FakeObject({"control_number": "9"}),
+                   FakeObject({"control_number": "2"}),
+                   FakeObject("<record/>"),
+                   FakeObject({"control_number": "2"})]
+            del FakeQuery.queries[:]
+            match_records()(run[1], FakeEngine(run))
+            self.assertEqual(len(FakeQuery.queries), 1)
+            self.assertEqual(run[0].extra_data, {})
+            self.assertEqual(run[2].extra_data, {})
+            self.assertEqual(run[3].extra_data, {})
+            self.assertTrue(quick_match_record()(run[1], None))
+            self.assertEqual(len(FakeQuery.queries), 1)
+
+    def test_oai_dc_to_json(self):
+        """Test converting an OAI_DC record straight to JSON."""
+        from invenio_oaiharvester.tasks.records import oai_dc_to_json
+
+        path = os.path.join(os.path.dirname(__file__),
+                            "data/sample_oai_dc_response.xml")
+        with open(path, "rb") as fd:
+            record = oai_dc_to_json(fd.read())
+        self.assertTrue(record["title_statement"][0]["title"].startswith(
+            "The Distribution of Star Formation"))
+        self.assertEqual(record["main_entry_personal_name"],
+                         [{"personal_name": "Young, J. E."}])
+        self.assertEqual(len(record["added_entry_personal_name"]), 2)
+        self.assertEqual(
+            record["subject_added_entry_topical_term"][0][
+                "topical_term_or_geographic_name_entry_element"],
+            ["Astrophysics - Astrophysics of Galaxies"])
+        self.assertEqual(record["system_control_number"][0],
+                         {"value": "oai:arXiv.org:1507.03011"})
+        self.assertTrue(record["summary"][0]["summary"][0].startswith(
+            "We introduce the MUSCEL Program"))
+
+    def test_oai_dc_to_json_arxiv_id(self):
+        """Test looking up the arXiv ID of a record converted from OAI_DC."""
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.arxiv import get_arxiv_id
+        from invenio_oaiharvester.tasks.records import oai_dc_to_json
+
+        path = os.path.join(os.path.dirname(__file__),
+                            "data/sample_oai_dc_response.xml")
+        with open(path, "rb") as fd:
+            record = oai_dc_to_json(fd.read())
+        config = {"OAIHARVESTER_RECORD_ARXIV_ID_LOOKUP":
+                  "system_control_number.value"}
+        with patch.dict(cfg, config):
+            self.assertEqual(get_arxiv_id(record), "oai:arXiv.org:1507.03011")
+            self.assertIsNone(get_arxiv_id({"title_statement": []}))
+
+    def test_convert_records_to_json(self):
+        """Test converting the MARCXML of several objects at once."""
+        from lxml import etree
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.records import (
+            convert_record_to_json,
+            convert_records_to_json
+        )
+
+        calls = []
+
+        def processor(source):
+            calls.append(source)
+            for record in etree.parse(source).getroot():
+                yield {"control_number": record[0].text}
+
+        objects = [FakeObject(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<collection xmlns="http://www.loc.gov/MARC21/slim">'
+            '<record><controlfield tag="001">{0}</controlfield></record>'
+            '</collection>'.format(i)) for i in range(3)]
+        with patch.dict(cfg, {"RECORD_PROCESSORS": {"marcxml": processor}}):
+            convert_records_to_json(objects)
+            convert_record_to_json(objects[0], None)
+        self.assertEqual([obj.data for obj in objects],
+                         [{"control_number": str(i)} for i in range(3)])
+        self.assertEqual(len(calls), 1)
+
+    def test_convert_records_of_the_run(self):
+        """Test converting all the records of a workflow run at once."""
+        from lxml import etree
+        from mock import patch
+        from invenio.base.globals import cfg
+        from invenio_oaiharvester.tasks.records import convert_records
+
+        calls = []
+
+        def processor(source):
+            calls.append(source)
+            for record in etree.parse(source).getroot():
+                yield {"control_number": record[0].text}
+
+        def xslt_convert(xml, stylesheet):
+            if xml == "<dc>bad</dc>":
+                raise ValueError("Not OAI_DC")
+            return ('<record xmlns="http://www.loc.gov/MARC21/slim">'
+                    '<controlfield tag="001">{0}</controlfield>'
+                    '</record>'.format(xml[4:-5]))
+
+        objects = [FakeObject("<dc>{0}</dc>".format(i))
+                   for i in ("0", "1", "bad", "3")]
+        eng = FakeEngine(objects)
+        with patch.dict(cfg, {"RECORD_PROCESSORS": {"marcxml": processor}}), \
+                patch("invenio_oaiharvester.utils.xslt_convert",
+                      xslt_convert):
+            convert_records("oaidc2marcxml.xsl")(objects[1], eng)
+        self.assertEqual([obj.data for obj in objects],
+                         ["<dc>0</dc>", {"control_number": "1"},
+                          "<dc>bad</dc>", {"control_number": "3"}])
+        self.assertEqual(len(calls), 1)
+
+    def test_bulk_create_records(self):
+        """Test creating records in batches, isolating failing records."""
+        from mock import MagicMock, patch
+        from invenio_oaiharvester.tasks.records import bulk_create_records
+
+        def create(record):
+            if record["title"] == "bad":
+                raise ValueError(record["title"])
+            return record
+
+        records = [{"title": "good"}, {"title": "bad"}, {"title": "good"},
+                   {"title": "good"}]
+        db = MagicMock()
+        with patch("invenio.ext.sqlalchemy.db", db), \
+                patch("invenio_records.api.create_record",
+                      side_effect=create):
+            created, failed = bulk_create_records(iter(records),
+                                                  batch_size=2)
+        self.assertEqual(created, 3)
+        self.assertEqual([record for record, error in failed],
+                         [{"title": "bad"}])
+        # One transaction for the good batch, one per record of the bad one.
+        self.assertEqual(db.session.commit.call_count, 2)
+        self.assertEqual(db.session.rollback.call_count, 2)
+
+
+TEST_SUITE = make_test_suite(OAIHarvesterTasks, OAIHarvesterArxivCache,
+                             OAIHarvesterRecordTasks)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
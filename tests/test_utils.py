@@ -25,6 +25,31 @@ import tempfile
 from invenio.testsuite import InvenioTestCase, make_test_suite, run_test_suite
 
 
+class FakeHeader(object):
+
+    """Header of a harvested record."""
+
+    def __init__(self, identifier, datestamp="2015-07-14"):
+        self.identifier = identifier
+        self.datestamp = datestamp
+
+
+class FakeRecord(object):
+
+    """Harvested record, with only what the outputs use."""
+
+    def __init__(self, raw, identifier=None):
+        self.raw = raw
+        self.header = FakeHeader(identifier)
+
+
+def fake_records(count):
+    """Return harvested records numbered from 0."""
+    return [FakeRecord(u"<record>{0}</record>".format(i),
+                       "oai:example.org:{0}".format(i))
+            for i in range(count)]
+
+
 class OAIHarvesterUtils(InvenioTestCase):
 
     """Class to test the OAI XML utils tasks."""
@@ -193,6 +218,361 @@ class OAIHarvesterUtils(InvenioTestCase):
 
         self.assertEqual(len(record_extraction_from_file(path_tmp)), 1)
 
+    def test_records_extraction_iterator(self):
+        """Test streaming records out of OAI XML one at a time."""
+        from io import BytesIO
+        from invenio_oaiharvester.utils import record_extraction_iterator
+        xml_sample = (
+            b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+            b'<responseDate>2014-11-05T09:30:08Z</responseDate>'
+            b'<request verb="ListRecords">http://inspirehep.net/oai2d</request>'
+            b'<ListRecords>'
+            b'<record><header><identifier>oai:inspirehep.net:1</identifier>'
+            b'<datestamp>2014-05-02T12:22:51Z</datestamp></header></record>'
+            b'<record><header><identifier>oai:inspirehep.net:2</identifier>'
+            b'<datestamp>2014-05-02T12:22:47Z</datestamp></header></record>'
+            b'</ListRecords>'
+            b'</OAI-PMH>'
+        )
+        records = record_extraction_iterator(BytesIO(xml_sample))
+        self.assertFalse(isinstance(records, list))
+        records = list(records)
+        self.assertEqual(len(records), 2)
+        self.assertTrue(b"responseDate" in records[1])
+        self.assertTrue(b"oai:inspirehep.net:2" in records[1])
+        self.assertFalse(b"oai:inspirehep.net:1" in records[1])
+
+    def test_split_date_range(self):
+        """Test splitting a date range into harvesting windows."""
+        from invenio_oaiharvester.utils import split_date_range
+        self.assertEqual(split_date_range("2015-01-01", "2015-01-10", 3),
+                         [("2015-01-01", "2015-01-03"),
+                          ("2015-01-04", "2015-01-06"),
+                          ("2015-01-07", "2015-01-10")])
+        self.assertEqual(split_date_range("2015-01-01", "2015-01-02", 5),
+                         [("2015-01-01", "2015-01-01"),
+                          ("2015-01-02", "2015-01-02")])
+        self.assertEqual(
+            split_date_range("2015-01-01T00:00:00Z", "2015-01-01T00:00:03Z",
+                             2, "YYYY-MM-DDThh:mm:ssZ"),
+            [("2015-01-01T00:00:00Z", "2015-01-01T00:00:01Z"),
+             ("2015-01-01T00:00:02Z", "2015-01-01T00:00:03Z")])
+
+    def test_set_names(self):
+        """Test splitting stored setspecs into set names."""
+        from invenio_oaiharvester.utils import get_set_names
+        self.assertEqual(get_set_names("cs, physics:hep-th"),
+                         ["cs", "physics:hep-th"])
+        self.assertEqual(get_set_names("cs physics"), ["cs", "physics"])
+        self.assertEqual(get_set_names(""), [])
+
+    def test_xslt_cache(self):
+        """Test compiling a stylesheet once until it is modified."""
+        from invenio_oaiharvester.utils import get_xslt, xslt_convert
+
+        stylesheet = ('<xsl:stylesheet version="1.0" '
+                      'xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+                      '<xsl:output method="text"/>'
+                      '<xsl:template match="/">{0}<xsl:value-of select="."/>'
+                      '</xsl:template></xsl:stylesheet>')
+        fd, path = tempfile.mkstemp(suffix=".xsl")
+        try:
+            os.write(fd, stylesheet.format("a:").encode("utf-8"))
+            os.close(fd)
+            xslt = get_xslt(path)
+            self.assertTrue(get_xslt(path) is xslt)
+            self.assertEqual(xslt_convert("<r>1</r>", path), "a:1")
+
+            with open(path, "wb") as stylesheet_fd:
+                stylesheet_fd.write(stylesheet.format("b:").encode("utf-8"))
+            os.utime(path, (0, 0))
+            self.assertFalse(get_xslt(path) is xslt)
+            self.assertEqual(xslt_convert("<r>1</r>", path), "b:1")
+        finally:
+            os.remove(path)
+
+    def test_send_to_workflow_in_batches(self):
+        """Test sending harvested records to a workflow in batches."""
+        from mock import patch
+        from invenio_oaiharvester.utils import send_to_workflow
+
+        records = [FakeRecord("<record>{0}</record>".format(i))
+                   for i in range(5)]
+        with patch("invenio.modules.workflows.api.start_delayed") as start:
+            total = send_to_workflow(iter(records), "oaiharvest_record",
+                                     batch_size=2)
+        self.assertEqual(total, 5)
+        self.assertEqual([len(call[0][1]) for call in start.call_args_list],
+                         [2, 2, 1])
+
+    def test_send_to_workflow_flushes_while_waiting(self):
+        """Test sending an old batch while no record arrives."""
+        import time
+        from mock import patch
+        from invenio_oaiharvester.utils import send_to_workflow
+
+        sent_while_waiting = []
+
+        def slow_records():
+            yield FakeRecord("<record>0</record>")
+            time.sleep(1.5)
+            sent_while_waiting.append(start.call_count)
+            yield FakeRecord("<record>1</record>")
+
+        with patch("invenio.modules.workflows.api.start_delayed") as start:
+            total = send_to_workflow(slow_records(), "oaiharvest_record",
+                                     batch_size=10, flush_interval=0.2)
+        self.assertEqual(total, 2)
+        self.assertEqual(sent_while_waiting, [1])
+        self.assertEqual(start.call_count, 2)
+
+    def test_send_to_workflow_raises_timer_errors(self):
+        """Test raising the error of a batch sent while no record arrives."""
+        import time
+        from mock import patch
+        from invenio_oaiharvester.utils import send_to_workflow
+
+        def slow_records():
+            yield FakeRecord("<record>0</record>")
+            time.sleep(1.5)
+            yield FakeRecord("<record>1</record>")
+
+        with patch("invenio.modules.workflows.api.start_delayed",
+                   side_effect=[IOError("broker down"), None]) as start:
+            self.assertRaises(IOError, send_to_workflow, slow_records(),
+                              "oaiharvest_record", batch_size=10,
+                              flush_interval=0.2)
+        # The batch was kept for the next attempt, not sent again silently.
+        self.assertEqual(start.call_count, 1)
+
+    def test_ingest_records(self):
+        """Test counting the records created, failed and skipped."""
+        from lxml import etree
+        from mock import patch
+        from sickle.models import Record
+        from invenio_oaiharvester.utils import ingest_records
+
+        def record(identifier, metadata, deleted=False):
+            return Record(etree.fromstring(
+                '<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+                '<header{0}><identifier>{1}</identifier>'
+                '<datestamp>2015-07-14</datestamp></header>'
+                '<metadata>{2}</metadata></record>'.format(
+                    ' status="deleted"' if deleted else '', identifier,
+                    metadata)))
+
+        marcxml = ('<record xmlns="http://www.loc.gov/MARC21/slim">'
+                   '<controlfield tag="001">{0}</controlfield></record>')
+        oai_dc = ('<oai_dc:dc xmlns:oai_dc='
+                  '"http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                  'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                  '<dc:title>{0}</dc:title></oai_dc:dc>')
+        records = [record('oai:1', marcxml.format(1)),
+                   record('oai:2', marcxml.format(2)),
+                   record('oai:3', oai_dc.format('Title')),
+                   record('oai:4', '<other xmlns="urn:other"/>'),
+                   record('oai:5', '', deleted=True)]
+
+        def create(records, batch_size):
+            records = list(records)
+            return len(records) - 1, [(records[0], ValueError())]
+
+        with patch("invenio_oaiharvester.tasks.records."
+                   "marcxml_records_to_json",
+                   side_effect=lambda batch: [None, {"control_number": "2"}]), \
+                patch("invenio_oaiharvester.tasks.records."
+                      "bulk_create_records", side_effect=create) as bulk:
+            created, failed, skipped = ingest_records(iter(records))
+        self.assertEqual(created, 1)
+        # oai:1 could not be converted, oai:2 could not be created.
+        self.assertEqual(sorted(failed), [('oai:1', '2015-07-14'),
+                                          ('oai:2', '2015-07-14')])
+        self.assertEqual(skipped, [('oai:4', '2015-07-14')])
+        self.assertEqual(bulk.call_count, 1)
+
+    def test_write_to_dir_rotation_and_compression(self):
+        """Test rotating and compressing the files of a directory output."""
+        import gzip
+        import shutil
+        from invenio_oaiharvester.utils import write_to_dir
+
+        records = fake_records(5)
+        output_dir = tempfile.mkdtemp()
+        try:
+            files_created, total = write_to_dir(iter(records), output_dir,
+                                                max_records=2,
+                                                compression="gzip",
+                                                index=False)
+            self.assertEqual(total, 5)
+            self.assertEqual(len(files_created), 3)
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             sorted(os.path.basename(path)
+                                    for path in files_created))
+            contents = []
+            for path in files_created:
+                self.assertTrue(path.endswith(".xml.gz"))
+                with gzip.open(path) as f:
+                    contents.append(f.read())
+            self.assertEqual([content.count(b"<record>") for content in contents],
+                             [2, 2, 1])
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_write_to_dir_failure_keeps_flushed_records(self):
+        """Test that a failed harvest only completes the flushed records."""
+        import gzip
+        import shutil
+        from invenio_oaiharvester.utils import read_index, write_to_dir
+
+        class Checkpoint(object):
+            def __init__(self):
+                self.flush_callbacks = []
+                self.files = []
+
+            def add_files(self, paths):
+                self.files.extend(paths)
+
+        def failing_records(checkpoint):
+            for record in fake_records(5):
+                if record.header.identifier.endswith(":2"):
+                    # The end of a page, the output is asked to persist it.
+                    for callback in checkpoint.flush_callbacks:
+                        callback()
+                if record.header.identifier.endswith(":4"):
+                    raise IOError("Connection reset")
+                yield record
+
+        for compression in (None, "gzip"):
+            output_dir = tempfile.mkdtemp()
+            try:
+                checkpoint = Checkpoint()
+                self.assertRaises(IOError, write_to_dir,
+                                  failing_records(checkpoint), output_dir,
+                                  checkpoint=checkpoint,
+                                  compression=compression, index=True)
+                self.assertEqual(len(checkpoint.files), 1)
+                path = checkpoint.files[0]
+                self.assertFalse([filename for filename in os.listdir(output_dir)
+                                  if filename.endswith(".part")])
+                opener = gzip.open if compression else open
+                with opener(path, "rb") as f:
+                    self.assertEqual(f.read(),
+                                     b"<record>0</record><record>1</record>")
+                self.assertEqual(
+                    [entry[0] for entry in read_index(path + ".idx")],
+                    ["oai:example.org:0", "oai:example.org:1"])
+            finally:
+                shutil.rmtree(output_dir)
+
+        # Without anything flushed, the file keeps its temporary name.
+        output_dir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(IOError, write_to_dir,
+                              failing_records(Checkpoint()), output_dir)
+            self.assertTrue(all(filename.endswith(".part")
+                                for filename in os.listdir(output_dir)))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_get_record_from_dir(self):
+        """Test reading a single record back through the file indexes."""
+        import shutil
+        from invenio_oaiharvester.utils import (
+            get_record_from_dir,
+            write_to_dir,
+        )
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            write_to_dir(iter(fake_records(5)), output_dir, max_records=2,
+                         index=True)
+            self.assertEqual(
+                get_record_from_dir("oai:example.org:3", output_dir),
+                u"<record>3</record>")
+            self.assertEqual(
+                get_record_from_dir("oai:example.org:4", output_dir),
+                u"<record>4</record>")
+            self.assertIsNone(
+                get_record_from_dir("oai:example.org:5", output_dir))
+
+            # The files written since the last lookup are indexed too.
+            write_to_dir(iter([FakeRecord(u"<record>new</record>",
+                                          "oai:example.org:4")]),
+                         output_dir, index=True)
+            self.assertEqual(
+                get_record_from_dir("oai:example.org:4", output_dir),
+                u"<record>new</record>")
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_collect_identifiers(self):
+        """Test collecting the OAI identifiers of harvested files."""
+        from invenio_oaiharvester.utils import collect_identifiers
+        paths = []
+        for identifiers in (["oai:example.org:1", "oai:example.org:2"], []):
+            fd_tmp, path_tmp = tempfile.mkstemp()
+            for identifier in identifiers:
+                os.write(fd_tmp, "<record><header><identifier>{0}</identifier>"
+                         "</header></record>".format(identifier).encode("utf-8"))
+            os.close(fd_tmp)
+            paths.append(path_tmp)
+        expected = [["oai:example.org:1", "oai:example.org:2"], []]
+        self.assertEqual(collect_identifiers(paths, processes=1), expected)
+        self.assertEqual(collect_identifiers(paths, processes=2), expected)
+        for path in paths:
+            os.remove(path)
+
+    def test_find_matching_files(self):
+        """Test finding files by sniffed type and extension."""
+        import shutil
+        from invenio_oaiharvester.utils import find_matching_files
+        basedir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(basedir, "sub"))
+            contents = {
+                "authors": b'<?xml version="1.0"?><collaborationauthorlist/>',
+                "sub/main.tex": b"\\documentclass{article}",
+                "sub/paper": b"%PDF-1.4",
+                "sub/list.xml": b"not really xml",
+            }
+            for filename, content in contents.items():
+                with open(os.path.join(basedir, filename), "wb") as f:
+                    f.write(content)
+
+            for threshold in (100, 0):
+                self.assertEqual(
+                    sorted(find_matching_files(basedir, ["xml"],
+                                               parallel_threshold=threshold)),
+                    [os.path.join(basedir, "authors"),
+                     os.path.join(basedir, "sub/list.xml")])
+            self.assertEqual(find_matching_files(basedir, ["pdf"]),
+                             [os.path.join(basedir, "sub/paper")])
+        finally:
+            shutil.rmtree(basedir)
+
+    def test_sniff_file_type(self):
+        """Test describing files like ``file`` does."""
+        from invenio_oaiharvester.utils import sniff_file_type
+        contents = [
+            (b"%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 10 10",
+             "postscript document text, type eps"),
+            (b"%!PS-Adobe-3.0\n", "postscript document text"),
+            (b"<?xml version='1.0'?><a/>", "xml document text"),
+            (b"\n<collaborationauthorlist xmlns:foaf='x'>",
+             "xml document text"),
+            (b"<<<<<<< HEAD\n", "ascii text"),
+            (b"<= 3 is a bound", "ascii text"),
+        ]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for content, description in contents:
+                with open(path, "wb") as f:
+                    f.write(content)
+                self.assertEqual(sniff_file_type(path), description)
+        finally:
+            os.remove(path)
+
     def test_identifier_filter(self):
         """oaiharvest - testing identifier filter."""
         from invenio_oaiharvester.utils import get_identifier_names